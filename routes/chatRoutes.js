@@ -51,8 +51,8 @@ router.post('/chat', authenticate, async (req, res) => {
 
 router.post('/rag', authenticate, async (req, res) => {
     try {
-        const { query, rag_db, user_id, model, num_docs, session_id } = req.body;
-        const response = await ChatService.handleRagRequest({ query, rag_db, num_docs, user_id, model, session_id });
+        const { query, rag_db, user_id, model, num_docs, session_id, filters = null } = req.body;
+        const response = await ChatService.handleRagRequest({ query, rag_db, num_docs, user_id, model, session_id, filters });
         res.status(200).json(response);
     } catch (error) {
         console.error('Error:', error);
@@ -418,7 +418,7 @@ async function handleChatRequest({ query, model, session_id, user_id, system_pro
   }
 }
 
-async function handleRagRequest({ query, rag_db, user_id, model, num_docs, session_id, save_chat = true, include_history = false }) {
+async function handleRagRequest({ query, rag_db, user_id, model, num_docs, session_id, save_chat = true, include_history = false, filters = null }) {
   try {
     const modelData = await getModelData(model);
     const chatSession = await getChatSession(session_id);
@@ -431,7 +431,7 @@ async function handleRagRequest({ query, rag_db, user_id, model, num_docs, sessi
     const embedding_apiKey = config['embedding_apiKey'];
 
     // embedding created in distllm
-    var { documents, embedding: user_embedding } = await queryRag(query, rag_db, user_id, model, num_docs, session_id);
+    var { documents, embedding: user_embedding } = await queryRag(query, rag_db, user_id, model, num_docs, session_id, filters);
 
     if (!documents || documents.length === 0) {
       documents = ['No documents found'];
@@ -267,7 +267,7 @@ async function queryRequestEmbeddingTfidf(query, vectorizer, endpoint) {
 // Specialized Service Functions
 // ========================================
 
-async function queryRag(query, rag_db, user_id, model, num_docs, session_id) {
+async function queryRag(query, rag_db, user_id, model, num_docs, session_id, filters = null) {
     try {
         if (!query || !rag_db || !user_id || !model) {
             const missingParams = [];
@@ -284,7 +284,8 @@ async function queryRag(query, rag_db, user_id, model, num_docs, session_id) {
             user_id, 
             model, 
             num_docs, 
-            session_id 
+            session_id,
+            filters
         });
 
         if (!res) {
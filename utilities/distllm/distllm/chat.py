@@ -7,12 +7,15 @@ import os
 from argparse import ArgumentParser
 from datetime import datetime
 from pathlib import Path
+from typing import Any
+from typing import Callable
 
 import requests
 from pydantic import Field
 
 from distllm.generate.prompts import IdentityPromptTemplate
 from distllm.generate.prompts import IdentityPromptTemplateConfig
+from distllm.rag.packing import mmr_pack
 from distllm.rag.search import Retriever
 from distllm.rag.search import RetrieverConfig
 from distllm.rag.search import RemoteRetriever
@@ -202,12 +205,14 @@ class RagGenerator:
         retrieval_score_threshold: float = 0.0,
         max_tokens: int = 1024,
         temperature: float = 0.0,
+        retrieval_filters: dict[str, Any] | None = None,
     ) -> list[str]:
         """
         Generate responses to the given queries.
 
         If a retriever is present,
         the retrieved context is appended to the prompt.
+        Retrieval can be restricted to documents matching metadata filters.
         """
         if isinstance(texts, str):
             texts = [texts]  # unify type
@@ -225,6 +230,7 @@ class RagGenerator:
                 texts,  # retrieve on just the latest user query
                 top_k=retrieval_top_k,
                 score_threshold=retrieval_score_threshold,
+                filters=retrieval_filters,
             )
             # if the filepath exists, add it to the context
             if self.retriever.check_key_exists('path'):
@@ -245,6 +251,7 @@ class RagGenerator:
         else:
             contexts = None
             embeddings = None
+            results = None
         # Build the final prompts
         # currently all 20 returned docs are added to the prompt
         # prompts = prompt_template.preprocess(texts, contexts, scores)
@@ -264,7 +271,7 @@ class RagGenerator:
         # Return as list (matching the function signature)
         # Result
         # contexts[0] is the top-k retrieval results for this query
-        return (contexts, embeddings)
+        return (contexts, embeddings, results)
 
 
 # -----------------------------------------------------------------------------
@@ -320,7 +327,15 @@ class ChatAppConfig(BaseConfig):
 # -----------------------------------------------------------------------------
 # Main Chat Function
 # -----------------------------------------------------------------------------
-def chat_with_model(config: ChatAppConfig, query: str, extra_context: Optional[str] = None) -> None:
+def chat_with_model(  # noqa: PLR0913
+    config: ChatAppConfig,
+    query: str,
+    extra_context: Optional[str] = None,
+    filters: dict[str, Any] | None = None,
+    token_budget: int | None = None,
+    count_tokens: Callable[[list[str]], list[int]] | None = None,
+    mmr_lambda: float = 0.5,
+) -> None:
     """
     Driver function for the chat application.
 
@@ -330,6 +345,9 @@ def chat_with_model(config: ChatAppConfig, query: str, extra_context: Optional[s
     3) Upon exit, save the conversation to a local text file with timestamp.
     4) Use only the latest user input for retrieval, but preserve full context
     in the prompt generation so the assistant can handle follow-up queries.
+
+    If a token budget is given, the retrieved documents are packed into it
+    by maximal marginal relevance, using `count_tokens` to measure them.
     """
 
     rag_model = config.rag_configs.get_rag_model()
@@ -353,22 +371,90 @@ def chat_with_model(config: ChatAppConfig, query: str, extra_context: Optional[s
 
     # Ask the RAG model to generate a response
     # CopilotAPI: disabling generation, only retrieval
-    documents, embeddings = rag_model.generate(
+    documents, embeddings, results = rag_model.generate(
         texts=[user_input],  # retrieve only on the new user input
         prompt_template=conversation_template,
         retrieval_top_k=20,
         retrieval_score_threshold=0.1,
+        retrieval_filters=filters,
     )
-    return documents, embeddings
 
-def distllm_chat(query: str, rag_db: str, data_path: str, faiss_index_path: str, extra_context: Optional[str] = None) -> dict:
-    data = get_data(rag_db, data_path, faiss_index_path)
+    # Describe each retrieved document so that callers can fuse and
+    # dedupe the results with other retrievers
+    hits = []
+    if results is not None:
+        retriever = rag_model.retriever
+        indices = results.total_indices[0]
+        texts = retriever.get_texts(indices)
+        id_keys = [
+            key
+            for key in ('doc_id', 'chunk_index')
+            if retriever.check_key_exists(key)
+        ]
+        ids = {key: retriever.get(indices, key) for key in id_keys}
+        for rank, (index, score) in enumerate(
+            zip(indices, results.total_scores[0]),
+        ):
+            hit = {'index': int(index), 'score': float(score)}
+            hit['text'] = texts[rank]
+            hit.update({key: ids[key][rank] for key in id_keys})
+            hits.append(hit)
+
+        # Keep the most relevant, least redundant documents that fit
+        if token_budget is not None and count_tokens is not None:
+            selected = mmr_pack(
+                scores=results.total_scores[0],
+                embeddings=retriever.get_embeddings(indices),
+                token_counts=count_tokens(documents),
+                token_budget=token_budget,
+                mmr_lambda=mmr_lambda,
+            )
+            documents = [documents[i] for i in selected]
+            hits = [hits[i] for i in selected]
+
+    return documents, embeddings, hits
+
+def distllm_chat(  # noqa: PLR0913
+    query: str,
+    rag_db: str,
+    data_path: str,
+    faiss_index_path: str,
+    extra_context: Optional[str] = None,
+    filters: dict[str, Any] | None = None,
+    token_budget: int | None = None,
+    count_tokens: Callable[[list[str]], list[int]] | None = None,
+    query_encoder: dict[str, Any] | None = None,
+) -> dict:
+    # Only the filtered metadata columns are encoded when loading the index
+    filter_fields = sorted(filters) if filters else None
+    data = get_data(
+        rag_db,
+        data_path,
+        faiss_index_path,
+        filter_fields,
+        query_encoder,
+    )
     config = ChatAppConfig.from_dict(data)
-    documents, embeddings = chat_with_model(config, query, extra_context)
+    documents, embeddings, hits = chat_with_model(
+        config,
+        query,
+        extra_context,
+        filters,
+        token_budget,
+        count_tokens,
+    )
     embeddings = embeddings.tolist() # only one embedding per query
-    return json.dumps({'documents': documents, 'embedding': embeddings[0]})
+    return json.dumps(
+        {'documents': documents, 'embedding': embeddings[0], 'results': hits},
+    )
 
-def get_data(rag_db: str, data_path: str, faiss_index_path: str) -> dict:
+def get_data(
+    rag_db: str,
+    data_path: str,
+    faiss_index_path: str,
+    filter_fields: list[str] | None = None,
+    query_encoder: dict[str, Any] | None = None,
+) -> dict:
     # TODO: get rid of the save_conversation_path logic
     tmp_path = Path("/home/ac.cucinell/bvbrc-dev/Copilot/test_distllm_output")
     data = {
@@ -388,7 +474,8 @@ def get_data(rag_db: str, data_path: str, faiss_index_path: str) -> dict:
                     'precision': 'float32',
                     'search_algorithm': 'exact',
                     'rescore_multiplier': 2,
-                    'num_quantization_workers': 1
+                    'num_quantization_workers': 1,
+                    'filter_fields': filter_fields
                 },
                 'encoder_config': {
                     'name': 'auto',
@@ -399,6 +486,11 @@ def get_data(rag_db: str, data_path: str, faiss_index_path: str) -> dict:
         },
         "save_conversation_path": str(tmp_path)
     }
+    # Embed the queries in process with a warm encoder instead of the
+    # remote embedding service (a QueryEncoderConfig)
+    if query_encoder is not None:
+        retriever_config = data['rag_configs']['retriever_config']
+        retriever_config['query_encoder_config'] = query_encoder
     return data
 
 '''
@@ -4,6 +4,8 @@ from __future__ import annotations
 
 from pathlib import Path
 from typing import Any
+from typing import Callable
+from typing import Optional
 
 import typer
 from tqdm import tqdm
@@ -18,7 +20,7 @@ def embed(  # noqa: PLR0913
         '--encoder_name',
         '-mn',
         help='The name of the encoder architecture to use for '
-        ' generating the embeddings [auto, esm2].',
+        ' generating the embeddings [auto, esm2, cpu].',
     ),
     pretrained_model_name_or_path: str = typer.Option(
         ...,
@@ -65,6 +67,28 @@ def embed(  # noqa: PLR0913
         help='The batch size to use for chunked text within semantic '
         'chunking.',
     ),
+    chunk_embedding: str = typer.Option(
+        'encode',
+        '--chunk_embedding',
+        '-ce',
+        help='How to embed the semantic chunks [encode, mean, '
+        'length_weighted_mean], the mean options pool the buffer embeddings '
+        'instead of re-encoding the chunks.',
+    ),
+    length_bucketing: bool = typer.Option(
+        False,
+        '--length_bucketing',
+        '-lb',
+        help='Batch sequences of similar token length together to '
+        'minimize padding.',
+    ),
+    max_tokens_per_batch: Optional[int] = typer.Option(  # noqa: UP007
+        None,
+        '--max_tokens_per_batch',
+        '-mtb',
+        help='Pack batches up to this number of (padded) tokens instead '
+        'of batch_size sequences (also applies to the semantic chunks).',
+    ),
     buffer_size: int = typer.Option(
         1,
         '--buffer_size',
@@ -98,6 +122,40 @@ def embed(  # noqa: PLR0913
         '-hp',
         help='Use half precision for the model.',
     ),
+    output_dtype: Optional[str] = typer.Option(  # noqa: UP007
+        None,
+        '--output_dtype',
+        '-od',
+        help='The storage precision of the embeddings [float32, float16, '
+        'bfloat16], by default the precision of the model.',
+    ),
+    cache_dir: Optional[Path] = typer.Option(  # noqa: B008, UP007
+        None,
+        '--cache_dir',
+        '-cd',
+        help='A directory to cache the embeddings by the hash of their text, '
+        'so that unchanged texts are not re-embedded.',
+    ),
+    manifest_dir: Optional[Path] = typer.Option(  # noqa: B008, UP007
+        None,
+        '--manifest_dir',
+        '-md',
+        help='A directory to record the output of each data file, so that '
+        'a rerun skips the files that were already embedded.',
+    ),
+    checksum_outputs: bool = typer.Option(
+        False,
+        '--checksum_outputs',
+        help='Record the checksums of the output files in the manifest, '
+        'which reads each output back once it is written.',
+    ),
+    incremental_write: bool = typer.Option(
+        False,
+        '--incremental_write',
+        '-iw',
+        help='Write the embeddings batch by batch as they are computed, '
+        'to bound the memory used for large files.',
+    ),
     eval_mode: bool = typer.Option(
         False,
         '--eval_mode',
@@ -114,7 +172,8 @@ def embed(  # noqa: PLR0913
         False,
         '--quantization',
         '-q',
-        help='Quantize the model for faster inference.',
+        help='Quantize the model for faster inference (4-bit on GPU for '
+        'the auto encoder, dynamic int8 for the cpu encoder).',
     ),
 ) -> None:
     """Generate embeddings for a single file."""
@@ -126,6 +185,10 @@ def embed(  # noqa: PLR0913
         'name': dataset_name,
         # The batch size to use for generating the embeddings
         'batch_size': batch_size,
+        # Batch sequences of similar length together
+        'length_bucketing': length_bucketing,
+        # Pack the batches up to a token budget
+        'max_tokens_per_batch': max_tokens_per_batch,
     }
 
     # If the dataset is jsonl_chunk, set the buffer size
@@ -160,11 +223,15 @@ def embed(  # noqa: PLR0913
     embedder_kwargs: dict[str, Any] = {
         # The name of the embedder to use
         'name': embedder_name,
+        # The storage precision of the embeddings
+        'output_dtype': output_dtype,
     }
 
     if embedder_name == 'semantic_chunk':
         # Set the batch size to use for chunked text within semantic chunking
         embedder_kwargs['chunk_batch_size'] = chunk_batch_size
+        # Set how to embed the chunks (re-encode or pool the buffers)
+        embedder_kwargs['chunk_embedding'] = chunk_embedding
 
     # The writer kwargs
     writer_kwargs = {
@@ -189,17 +256,29 @@ def embed(  # noqa: PLR0913
             pooler_kwargs=pooler_kwargs,
             embedder_kwargs=embedder_kwargs,
             writer_kwargs=writer_kwargs,
+            cache_dir=cache_dir,
+            manifest_dir=manifest_dir,
+            checksum_outputs=checksum_outputs,
+            incremental_write=incremental_write,
         )
 
 
 @app.command()
-def merge(
+def merge(  # noqa: PLR0913
     writer_name: str = typer.Option(
         'huggingface',
         '--writer_name',
         '-wn',
         help='The name of the writer to use for saving datasets '
-        '[huggingface, numpy].',
+        '[huggingface, numpy] for embed, [huggingface, amp_jsonl] for '
+        'generate.',
+    ),
+    source: str = typer.Option(
+        'embed',
+        '--source',
+        '-s',
+        help='The command that output the datasets, which selects '
+        'its writers [embed, generate].',
     ),
     num_proc: int = typer.Option(
         None,
@@ -221,9 +300,47 @@ def merge(
         '-o',
         help='The dataset directory to save the merged datasets to.',
     ),
+    dedup: bool = typer.Option(
+        False,
+        '--dedup',
+        help='Remove near-duplicate texts, keeping one representative '
+        'with a back-reference list. Only works with huggingface writer.',
+    ),
+    dedup_threshold: float = typer.Option(
+        0.8,
+        '--dedup_threshold',
+        help='The minimum estimated Jaccard similarity of near-duplicate '
+        'texts.',
+    ),
+    manifest_dir: Optional[Path] = typer.Option(  # noqa: B008, UP007
+        None,
+        '--manifest_dir',
+        '-md',
+        help='The run manifest, only the datasets it records as committed '
+        'are merged (defaults to the manifest next to dataset_dir, if any).',
+    ),
+    verify_checksums: bool = typer.Option(
+        False,
+        '--verify_checksums',
+        help='Verify the file sizes (and checksums, if recorded) of the '
+        'committed datasets and skip those that do not match the manifest.',
+    ),
 ) -> None:
-    """Merge datasets from multiple directories output by `generate`."""
-    from distllm.generate import get_writer
+    """Merge the datasets output by `embed` or `generate`."""
+    from distllm.embed import get_writer as get_embed_writer
+    from distllm.generate import get_writer as get_generate_writer
+    from distllm.manifest import filter_committed
+
+    # The writers of the command that output the datasets
+    writer_factories: dict[str, Callable[[dict[str, Any]], Any]] = {
+        'embed': get_embed_writer,
+        'generate': get_generate_writer,
+    }
+    if source not in writer_factories:
+        raise ValueError(
+            f'Unknown source: {source}.'
+            f' Available: {set(writer_factories.keys())}',
+        )
 
     # The writer kwargs
     writer_kwargs: dict[str, Any] = {
@@ -234,17 +351,70 @@ def merge(
     # If the writer is huggingface, set the number of processes
     if writer_name == 'huggingface':
         writer_kwargs['num_proc'] = num_proc
+        writer_kwargs['dedup'] = dedup
+        writer_kwargs['dedup_threshold'] = dedup_threshold
 
     # Initialize the writer
-    writer = get_writer(writer_kwargs)
+    writer = writer_factories[source](writer_kwargs)
 
     # Get the dataset directories
     dataset_dirs = list(dataset_dir.glob('*'))
 
+    # Only merge the datasets committed in the run manifest
+    dataset_dirs = filter_committed(
+        dataset_dirs,
+        dataset_dir,
+        manifest_dir,
+        verify=verify_checksums,
+    )
+
     # Merge the datasets
     writer.merge(dataset_dirs, output_dir)
 
 
+@app.command()
+def virtual_merge(
+    dataset_dir: Path = typer.Option(  # noqa: B008
+        ...,
+        '--dataset_dir',
+        '-d',
+        help='The directory containing the dataset subdirectories '
+        'to view as one corpus (will glob * this directory).',
+    ),
+    output_path: Path = typer.Option(  # noqa: B008
+        ...,
+        '--output_path',
+        '-o',
+        help='The JSON manifest of the virtual dataset to write, which can '
+        'be used as the dataset_dir of the faiss_index_v2 index.',
+    ),
+    manifest_dir: Optional[Path] = typer.Option(  # noqa: B008, UP007
+        None,
+        '--manifest_dir',
+        '-md',
+        help='The run manifest, only the datasets it records as committed '
+        'are included (defaults to the manifest next to dataset_dir, if any).',
+    ),
+) -> None:
+    """View the datasets output by `embed` as one corpus without merging."""
+    from distllm.manifest import filter_committed
+    from distllm.rag.search import VirtualDataset
+
+    # Get the dataset directories, in a fixed order
+    dataset_dirs = sorted(dataset_dir.glob('*'))
+
+    # Only include the datasets committed in the run manifest
+    dataset_dirs = filter_committed(dataset_dirs, dataset_dir, manifest_dir)
+
+    # Write the manifest of the virtual dataset
+    dataset = VirtualDataset([d.resolve() for d in dataset_dirs])
+    dataset.save(output_path)
+    print(
+        f'Wrote a virtual dataset of {len(dataset)} rows from '
+        f'{len(dataset_dirs)} datasets to {output_path}',
+    )
+
+
 @app.command()
 def generate(  # noqa: PLR0913
     input_dir: Path = typer.Option(  # noqa: B008
@@ -495,23 +665,29 @@ def chunk_fasta_file(
     ),
 ) -> None:
     """Chunk a fasta file into smaller fasta files."""
-    from distllm.embed.datasets.fasta import read_fasta
+    import itertools
+
+    from distllm.embed.datasets.fasta import iter_fasta
     from distllm.embed.datasets.fasta import write_fasta
-    from distllm.utils import batch_data
 
-    # Read the fasta file
-    sequences = read_fasta(input_file)
+    # Count the sequences without reading them into memory
+    with open(input_file, 'rb') as fp:
+        num_sequences = sum(line.startswith(b'>') for line in fp)
 
     # Chunk the sequences
-    chunks = batch_data(sequences, len(sequences) // num_chunks)
+    chunk_size = max(num_sequences // num_chunks, 1)
+    chunks = itertools.groupby(
+        enumerate(iter_fasta(input_file)),
+        key=lambda item: item[0] // chunk_size,
+    )
 
     # Make the output directory
     output_dir.mkdir(parents=True)
 
-    # Save the chunked fasta files
-    for i, chunk in tqdm(enumerate(chunks), desc='Writing chunks'):
+    # Stream the sequences into the chunked fasta files
+    for i, chunk in tqdm(chunks, desc='Writing chunks'):
         filename = f'{input_file.stem}_{i:04}{input_file.suffix}'
-        write_fasta(chunk, output_dir / filename)
+        write_fasta((seq for _, seq in chunk), output_dir / filename)
 
 
 def main() -> None:
@@ -0,0 +1,226 @@
+"""Near-duplicate text suppression with MinHash locality sensitive hashing."""
+
+from __future__ import annotations
+
+import re
+import zlib
+from typing import Any
+
+import numpy as np
+from datasets import Dataset
+from datasets import Sequence
+from datasets import Value
+
+# A prime just below 2**32 so that (a * hash + b) fits in a uint64
+_MERSENNE_PRIME = np.uint64(4294967291)
+
+
+def _permutations(num_perm: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    """Get the (a, b) coefficients of the MinHash permutations."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signature(
+    text: str,
+    num_perm: int = 128,
+    ngram_size: int = 5,
+    seed: int = 0,
+    permutations: tuple[np.ndarray, np.ndarray] | None = None,
+) -> np.ndarray:
+    """Compute the MinHash signature of the character n-grams of a text.
+
+    Parameters
+    ----------
+    text : str
+        The text to hash, whitespace and case are normalized.
+    num_perm : int, optional
+        The number of hash permutations, by default 128.
+    ngram_size : int, optional
+        The number of characters per shingle, by default 5.
+    seed : int, optional
+        The seed of the hash permutations, by default 0.
+    permutations : tuple[np.ndarray, np.ndarray], optional
+        The precomputed (a, b) coefficients of the hash permutations, to
+        avoid recomputing them for every text, by default computed from
+        `num_perm` and `seed`.
+
+    Returns
+    -------
+    np.ndarray
+        The uint32 signature (shape: [num_perm]).
+    """
+    # Normalize the text so that formatting differences are ignored
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+
+    # Hash the character shingles
+    shingles = {
+        text[i : i + ngram_size]
+        for i in range(max(len(text) - ngram_size + 1, 1))
+    }
+    hashes = np.fromiter(
+        (zlib.crc32(s.encode('utf-8')) for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+
+    # Take the minimum of each permuted hash
+    if permutations is None:
+        permutations = _permutations(num_perm, seed)
+    a, b = permutations
+    permuted = (np.outer(a, hashes) + b[:, None]) % _MERSENNE_PRIME
+    return permuted.min(axis=1).astype(np.uint32)
+
+
+def find_near_duplicates(
+    signatures: np.ndarray,
+    threshold: float = 0.8,
+    rows_per_band: int = 8,
+) -> np.ndarray:
+    """Cluster near-duplicate rows by banded MinHash LSH.
+
+    Rows that share a band of their signatures are candidates, and are
+    merged if their estimated Jaccard similarity is at least `threshold`.
+    Each candidate is only compared against the first row of its bucket,
+    so repeated boilerplate costs O(n) rather than O(n^2) comparisons.
+
+    Parameters
+    ----------
+    signatures : np.ndarray
+        The MinHash signatures (shape: [num_rows, num_perm]).
+    threshold : float, optional
+        The minimum estimated Jaccard similarity of near duplicates,
+        by default 0.8.
+    rows_per_band : int, optional
+        The number of signature values per LSH band, by default 8.
+
+    Returns
+    -------
+    np.ndarray
+        The representative (the first row of its cluster) of each row.
+    """
+    num_rows, num_perm = signatures.shape
+    parent = np.arange(num_rows)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for start in range(0, num_perm - rows_per_band + 1, rows_per_band):
+        # Group the rows by the bytes of their band
+        band = np.ascontiguousarray(
+            signatures[:, start : start + rows_per_band],
+        )
+        keys = band.view(np.dtype((np.void, band.itemsize * rows_per_band)))
+        _, first, inverse = np.unique(
+            keys.ravel(),
+            return_index=True,
+            return_inverse=True,
+        )
+        candidates = first[inverse]
+
+        # Verify the candidates against the first row of their bucket
+        rows = np.flatnonzero(candidates != np.arange(num_rows))
+        similarity = np.mean(
+            signatures[rows] == signatures[candidates[rows]],
+            axis=1,
+        )
+        rows = rows[similarity >= threshold]
+        for i, j in zip(rows, candidates[rows]):
+            root_i, root_j = find(int(i)), find(int(j))
+            if root_i != root_j:
+                # Keep the first occurrence as the representative
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(num_rows)])
+
+
+def deduplicate_dataset(
+    dataset: Dataset,
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    num_proc: int | None = None,
+    text_field: str = 'text',
+) -> Dataset:
+    """Keep one representative of each cluster of near-duplicate texts.
+
+    The representative gets a `duplicates` column listing the row indices
+    (in the input dataset) of the near duplicates it replaces, and a
+    `duplicate_paths` column if the dataset has a `path` column.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        The dataset to deduplicate.
+    threshold : float, optional
+        The minimum estimated Jaccard similarity of near duplicates,
+        by default 0.8.
+    num_perm : int, optional
+        The number of MinHash permutations, by default 128.
+    num_proc : int, optional
+        The number of processes used to compute the signatures,
+        by default None.
+    text_field : str, optional
+        The column containing the text, by default 'text'.
+
+    Returns
+    -------
+    Dataset
+        The deduplicated dataset.
+    """
+    # Draw the hash permutations once for all the texts
+    permutations = _permutations(num_perm, seed=0)
+
+    def _signatures(batch: dict[str, list[Any]]) -> dict[str, list[Any]]:
+        return {
+            'minhash': [
+                minhash_signature(text, permutations=permutations)
+                for text in batch[text_field]
+            ],
+        }
+
+    # Compute the signatures in parallel
+    signatures = dataset.select_columns([text_field]).map(
+        _signatures,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=[text_field],
+        desc='Computing MinHash signatures',
+    )
+    signatures.set_format('numpy')
+    representatives = find_near_duplicates(
+        signatures['minhash'].astype(np.uint32),
+        threshold=threshold,
+    )
+
+    # Collect the back references of each representative
+    keep = np.flatnonzero(representatives == np.arange(len(dataset)))
+    duplicates: dict[int, list[int]] = {int(i): [] for i in keep}
+    for row in np.flatnonzero(representatives != np.arange(len(dataset))):
+        duplicates[int(representatives[row])].append(int(row))
+
+    print(
+        f'Removed {len(dataset) - len(keep)} near-duplicate rows, '
+        f'keeping {len(keep)} of {len(dataset)}',
+    )
+
+    # Keep the representatives and add the back references
+    deduplicated = dataset.select(keep)
+    deduplicated = deduplicated.add_column(
+        'duplicates',
+        [duplicates[int(i)] for i in keep],
+        feature=Sequence(Value('int64')),
+    )
+    if 'path' in dataset.column_names:
+        paths = dataset['path']
+        deduplicated = deduplicated.add_column(
+            'duplicate_paths',
+            [[paths[j] for j in duplicates[int(i)]] for i in keep],
+            feature=Sequence(Value('string')),
+        )
+
+    return deduplicated
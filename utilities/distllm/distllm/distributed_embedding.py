@@ -6,6 +6,7 @@ import functools
 from argparse import ArgumentParser
 from pathlib import Path
 from typing import Any
+from typing import Optional
 
 from parsl.concurrent import ParslPoolExecutor
 from pydantic import Field
@@ -16,6 +17,8 @@ from distllm.embed import EmbedderConfigs
 from distllm.embed import EncoderConfigs
 from distllm.embed import PoolerConfigs
 from distllm.embed import WriterConfigs
+from distllm.embed.cache import EmbeddingCache
+from distllm.manifest import RunManifest
 from distllm.parsl import ComputeConfigs
 from distllm.utils import BaseConfig
 
@@ -28,17 +31,34 @@ def embedding_worker(  # noqa: PLR0913
     pooler_kwargs: dict[str, Any],
     embedder_kwargs: dict[str, Any],
     writer_kwargs: dict[str, Any],
+    cache_dir: Path | None = None,
+    manifest_dir: Path | None = None,
+    checksum_outputs: bool = False,
+    incremental_write: bool = False,
 ) -> None:
     """Embed a single file and save a numpy array with embeddings."""
     # Imports are here since this function is called in a parsl process
 
     from uuid import uuid4
 
+    from distllm.manifest import RunManifest
+    from distllm.threads import configure_thread_budget
+
+    # Skip the file if the run manifest has its committed embeddings
+    manifest = RunManifest(manifest_dir) if manifest_dir else None
+    if manifest is not None and manifest.is_committed(input_path):
+        print(f'Skipping {input_path}, its embeddings are committed')
+        return
+
+    # Share the CPUs with the other workers before loading torch
+    configure_thread_budget()
+
     from distllm.embed import get_dataset
     from distllm.embed import get_embedder
     from distllm.embed import get_encoder
     from distllm.embed import get_pooler
     from distllm.embed import get_writer
+    from distllm.embed.cache import EmbeddingCache
     from distllm.timer import Timer
 
     # Time the worker function
@@ -60,21 +80,51 @@ def embedding_worker(  # noqa: PLR0913
     # Initialize the writer
     writer = get_writer(writer_kwargs)
 
+    # Open the embedding cache of the encoder and pooler settings
+    cache = None
+    if cache_dir is not None:
+        with Timer('loaded-cache', input_path):
+            cache = EmbeddingCache(
+                cache_dir,
+                {'encoder': encoder_kwargs, 'pooler': pooler_kwargs},
+            )
+
     # Initialize the dataloader
     with Timer('loaded-dataset', input_path):
         dataloader = dataset.get_dataloader(input_path, encoder)
 
-    # Compute the embeddings
-    with Timer('computed-embeddings', input_path):
-        result = embedder.embed(dataloader, encoder, pooler)
-
     # Create the output directory for the embedding dataset
     dataset_dir = output_dir / f'{uuid4()}'
     dataset_dir.mkdir(parents=True, exist_ok=True)
 
-    # Write the result to disk
-    with Timer('wrote-embeddings', input_path):
-        writer.write(dataset_dir, result)
+    # Record the output directory of the file before writing to it, so
+    # that a partially written directory is never mistaken as complete
+    if manifest is not None:
+        manifest.start(input_path, dataset_dir)
+
+    # Write the embeddings batch by batch as they are computed
+    if incremental_write:
+        with Timer('computed-and-wrote-embeddings', input_path):
+            batches = embedder.embed_batches(
+                dataloader,
+                encoder,
+                pooler,
+                cache=cache,
+            )
+            writer.write_batches(dataset_dir, batches)
+
+    else:
+        # Compute the embeddings
+        with Timer('computed-embeddings', input_path):
+            result = embedder.embed(dataloader, encoder, pooler, cache=cache)
+
+        # Write the result to disk
+        with Timer('wrote-embeddings', input_path):
+            writer.write(dataset_dir, result)
+
+    # Commit the output directory with the sizes of its files
+    if manifest is not None:
+        manifest.commit(input_path, dataset_dir, checksum=checksum_outputs)
 
     # Stop the timer to log the worker time
     timer.stop()
@@ -101,12 +151,22 @@ class Config(BaseConfig):
     writer_config: WriterConfigs
     # Settings for the parsl compute backend.
     compute_config: ComputeConfigs
-
-    @field_validator('input_dir', 'output_dir')
+    # A directory to cache the embeddings by the hash of their text, so
+    # that unchanged texts are not re-embedded when the corpus is refreshed.
+    cache_dir: Optional[Path] = None  # noqa: UP007
+    # Whether to record the checksums of the embedding files in the run
+    # manifest, which reads each file back once it is written.
+    checksum_outputs: bool = False
+    # Whether to write the embeddings batch by batch as they are computed,
+    # rather than holding the embeddings of a whole file in memory (the
+    # rows are then written in the order they are embedded).
+    incremental_write: bool = False
+
+    @field_validator('input_dir', 'output_dir', 'cache_dir')
     @classmethod
-    def resolve_path(cls, value: Path) -> Path:
+    def resolve_path(cls, value: Path | None) -> Path | None:
         """Resolve the path to an absolute path."""
-        return value.resolve()
+        return value.resolve() if value is not None else None
 
 
 if __name__ == '__main__':
@@ -132,6 +192,10 @@ if __name__ == '__main__':
     # Log the configuration
     config.write_yaml(config.output_dir / 'config.yaml')
 
+    # The run manifest maps the input files to their embedding directories
+    manifest_dir = config.output_dir / 'manifest'
+    manifest = RunManifest(manifest_dir)
+
     # Set the static arguments of the worker function
     worker_fn = functools.partial(
         embedding_worker,
@@ -141,6 +205,10 @@ if __name__ == '__main__':
         pooler_kwargs=config.pooler_config.model_dump(),
         embedder_kwargs=config.embedder_config.model_dump(),
         writer_kwargs=config.writer_config.model_dump(),
+        cache_dir=config.cache_dir,
+        manifest_dir=manifest_dir,
+        checksum_outputs=config.checksum_outputs,
+        incremental_write=config.incremental_write,
     )
 
     # Collect all input files
@@ -148,8 +216,15 @@ if __name__ == '__main__':
     for pattern in config.glob_patterns:
         input_files.extend(list(config.input_dir.glob(pattern)))
 
+    # Skip the input files already embedded by a previous run
+    num_files = len(input_files)
+    input_files = [f for f in input_files if not manifest.is_committed(f)]
+
     # Log the input files to stdout
-    print(f'Found {len(input_files)} input files to embed')
+    print(
+        f'Found {num_files} input files, {num_files - len(input_files)} '
+        f'already embedded, {len(input_files)} left to embed',
+    )
 
     # Set the parsl compute settings
     parsl_config = config.compute_config.get_config(
@@ -159,3 +234,14 @@ if __name__ == '__main__':
     # Distribute the input files across processes
     with ParslPoolExecutor(parsl_config) as pool:
         list(pool.map(worker_fn, input_files))
+
+    # Merge the cache shards written by the workers into a single shard
+    if config.cache_dir is not None:
+        cache = EmbeddingCache(
+            config.cache_dir,
+            {
+                'encoder': config.encoder_config.model_dump(),
+                'pooler': config.pooler_config.model_dump(),
+            },
+        )
+        cache.compact()
@@ -50,11 +50,15 @@ def tokenizer_worker(
     """Tokenize a jsonl file and save the dataset to disk."""
     # Imports are here since this function is called in a parsl process
 
-    import json
     import os
     import time
     from uuid import uuid4
 
+    from distllm.threads import configure_thread_budget
+
+    # Share the CPUs with the other workers before loading the tokenizers
+    configure_thread_budget()
+
     import datasets
     from datasets import Dataset
     from dotenv import load_dotenv
@@ -62,6 +66,7 @@ def tokenizer_worker(
     from transformers import AutoTokenizer
 
     from distllm.distributed_tokenization import TokenizerConfig
+    from distllm.utils import iter_jsonl
 
     # Time the worker function
     start = time.time()
@@ -79,12 +84,8 @@ def tokenizer_worker(
     # Login to the huggingface hub
     login(os.getenv('HF_TOKEN'))
 
-    # Read the jsonl file
-    lines = input_path.read_text().strip().split('\n')
-    content = [json.loads(line) for line in lines]
-
-    # Extract the text data
-    data = [item[config.text_field] for item in content]
+    # Extract the text data, parsing the jsonl file lazily
+    data = [item[config.text_field] for item in iter_jsonl(input_path)]
 
     print(
         f'[timer] [Loaded dataset] [{input_path}]'
@@ -0,0 +1,202 @@
+"""Content-addressed store of computed embeddings.
+
+Embeddings are keyed by the hash of their text, so that a corpus refresh
+only encodes the texts that changed. The store is a directory per model
+configuration (encoder and pooler settings) holding shards written by
+the embedding workers. Each shard is a pair of numpy files (the keys
+and the embeddings), written atomically, so that concurrent workers
+never see a partial shard and can share the same store.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any
+from uuid import uuid4
+
+import numpy as np
+
+# The size of a key, i.e., a sha256 digest
+KEY_SIZE = 32
+
+
+class EmbeddingCache:
+    """Content-addressed store of computed embeddings."""
+
+    def __init__(self, cache_dir: Path, model_config: dict[str, Any]) -> None:
+        """Open the store of a model configuration.
+
+        Parameters
+        ----------
+        cache_dir : Path
+            The root directory of the store, shared by all model
+            configurations.
+        model_config : dict[str, Any]
+            The settings that determine the embeddings (e.g., the encoder
+            and pooler configurations), embeddings computed with different
+            settings are stored separately.
+        """
+        fingerprint = hashlib.sha256(
+            json.dumps(model_config, sort_keys=True, default=str).encode(),
+        ).hexdigest()
+        self.cache_dir = cache_dir / fingerprint[:16]
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # Index the rows of the existing shards, shards that are being
+        # written by other workers are picked up by the next run
+        self._shards: list[Path] = []
+        self._embeddings: dict[int, np.ndarray] = {}
+        self._index: dict[bytes, tuple[int, int]] = {}
+        for keys_path in sorted(self.cache_dir.glob('*.keys.npy')):
+            shard = len(self._shards)
+            self._shards.append(keys_path)
+            for row, key in enumerate(np.load(keys_path)):
+                self._index[key.tobytes()] = (shard, row)
+
+    def __len__(self) -> int:
+        """Get the number of stored embeddings."""
+        return len(self._index)
+
+    @staticmethod
+    def keys(texts: list[str], normalize: bool = False) -> np.ndarray:
+        """Get the keys of the texts.
+
+        Parameters
+        ----------
+        texts : list[str]
+            The texts to key.
+        normalize : bool, optional
+            Whether the embeddings are normalized, by default False.
+
+        Returns
+        -------
+        np.ndarray
+            The sha256 digests of the texts (shape: [num_texts, KEY_SIZE]).
+        """
+        prefix = b'normalized\0' if normalize else b'\0'
+        keys = np.empty((len(texts), KEY_SIZE), dtype=np.uint8)
+        for i, text in enumerate(texts):
+            digest = hashlib.sha256(prefix + text.encode('utf-8')).digest()
+            keys[i] = np.frombuffer(digest, dtype=np.uint8)
+        return keys
+
+    def _shard_embeddings(self, shard: int) -> np.ndarray:
+        """Memory-map the embeddings of a shard."""
+        if shard not in self._embeddings:
+            keys_path = self._shards[shard]
+            embeddings_path = keys_path.with_name(
+                keys_path.name.replace('.keys.npy', '.embeddings.npy'),
+            )
+            self._embeddings[shard] = np.load(embeddings_path, mmap_mode='r')
+        return self._embeddings[shard]
+
+    def get(self, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Look up the embeddings of the keys.
+
+        Parameters
+        ----------
+        keys : np.ndarray
+            The keys to look up (shape: [num_keys, KEY_SIZE]).
+
+        Returns
+        -------
+        np.ndarray
+            Whether each key was found (shape: [num_keys]).
+        np.ndarray
+            The embeddings of the keys that were found, in key order
+            (shape: [num_found, embedding_size]).
+        """
+        locations = [self._index.get(key.tobytes()) for key in keys]
+        found = np.array([loc is not None for loc in locations], dtype=bool)
+        embeddings = [
+            self._shard_embeddings(shard)[row]
+            for shard, row in filter(None, locations)
+        ]
+        return found, np.array(embeddings)
+
+    def put(self, keys: np.ndarray, embeddings: np.ndarray) -> None:
+        """Store the embeddings of the keys as a new shard.
+
+        Parameters
+        ----------
+        keys : np.ndarray
+            The keys of the embeddings (shape: [num_keys, KEY_SIZE]).
+        embeddings : np.ndarray
+            The embeddings (shape: [num_keys, embedding_size]).
+        """
+        if not len(keys):
+            return
+
+        # Write the embeddings before the keys, since the keys mark a
+        # complete shard, and move each file in place atomically
+        name = f'{uuid4()}'
+        for suffix, array in (('embeddings', embeddings), ('keys', keys)):
+            path = self.cache_dir / f'{name}.{suffix}.npy'
+            tmp_path = path.with_name(f'.{path.name}.tmp')
+            with open(tmp_path, 'wb') as fp:
+                np.save(fp, array)
+            os.replace(tmp_path, path)
+
+        # Index the new shard
+        shard = len(self._shards)
+        self._shards.append(self.cache_dir / f'{name}.keys.npy')
+        for row, key in enumerate(keys):
+            self._index[key.tobytes()] = (shard, row)
+
+    def compact(self) -> None:
+        """Merge the shards into a single shard.
+
+        Each run of the embedding workers adds shards to the store, which
+        are all read to index the store. Compacting them keeps opening the
+        store fast, and drops the rows of keys stored more than once. The
+        store must not be used by other workers while it is compacted.
+        """
+        if len(self._shards) <= 1:
+            return
+
+        # Get the keys and their locations in the existing shards
+        keys = np.frombuffer(b''.join(self._index), dtype=np.uint8)
+        keys = keys.reshape(-1, KEY_SIZE)
+        shards, rows = np.array(list(self._index.values())).T
+
+        # Copy the embeddings shard by shard into a memory-mapped file,
+        # so that the store is never loaded into memory at once
+        name = f'{uuid4()}'
+        embeddings_path = self.cache_dir / f'{name}.embeddings.npy'
+        tmp_path = embeddings_path.with_name(f'.{embeddings_path.name}.tmp')
+        first = self._shard_embeddings(0)
+        embeddings = np.lib.format.open_memmap(
+            tmp_path,
+            mode='w+',
+            dtype=first.dtype,
+            shape=(len(keys), first.shape[1]),
+        )
+        for shard in range(len(self._shards)):
+            mask = shards == shard
+            embeddings[mask] = self._shard_embeddings(shard)[rows[mask]]
+        embeddings.flush()
+        del embeddings
+        os.replace(tmp_path, embeddings_path)
+
+        # Write the keys, which mark the new shard as complete
+        keys_path = self.cache_dir / f'{name}.keys.npy'
+        tmp_path = keys_path.with_name(f'.{keys_path.name}.tmp')
+        with open(tmp_path, 'wb') as fp:
+            np.save(fp, keys)
+        os.replace(tmp_path, keys_path)
+
+        # Remove the old shards, the keys first so that a shard is never
+        # indexed without its embeddings
+        self._embeddings = {}
+        for old_keys_path in self._shards:
+            old_keys_path.unlink()
+            old_keys_path.with_name(
+                old_keys_path.name.replace('.keys.npy', '.embeddings.npy'),
+            ).unlink()
+
+        # Index the new shard
+        self._shards = [keys_path]
+        self._index = {key: (0, row) for row, key in enumerate(self._index)}
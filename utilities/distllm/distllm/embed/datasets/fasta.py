@@ -2,17 +2,25 @@
 
 from __future__ import annotations
 
-import re
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import Iterable
+from typing import Iterator
 from typing import Literal
 
+import numpy as np
 from torch.utils.data import DataLoader
 
+from distllm.embed.datasets.utils import batching_kwargs
+from distllm.embed.datasets.utils import BatchingConfig
 from distllm.embed.datasets.utils import DataCollator
 from distllm.embed.datasets.utils import InMemoryDataset
+from distllm.embed.datasets.utils import StreamingDataCollator
+from distllm.embed.datasets.utils import StreamingDataset
 from distllm.embed.encoders.base import Encoder
-from distllm.utils import BaseConfig
 from distllm.utils import PathLike
 
 
@@ -26,25 +34,114 @@ class Sequence:
     """Sequence description tag."""
 
 
+def _parse_record(header: bytes, lines: list[bytes]) -> Sequence:
+    """Parse the header and sequence lines of a fasta record."""
+    sequence = b''.join(lines).replace(b'\r', b'').replace(b'\n', b'')
+    return Sequence(
+        sequence=sequence.decode(),
+        tag=header[1:].rstrip(b'\r\n').decode(),
+    )
+
+
+def _iter_records(
+    fp: BinaryIO,
+    start: int = 0,
+    end: int | None = None,
+) -> Iterator[tuple[int, Sequence]]:
+    """Parse the records whose header starts in [start, end).
+
+    Yields each record with the byte offset of its header. The last
+    record is parsed in full, even if it extends past the end.
+    """
+    # Skip to the first line that starts in the byte range
+    fp.seek(max(start - 1, 0))
+    if start > 0 and fp.read(1) != b'\n':
+        fp.readline()
+    offset = fp.tell()
+
+    lines: list[bytes] = []
+    header_offset, header = offset, None
+    for line in fp:
+        if line.startswith(b'>'):
+            if header is not None:
+                yield header_offset, _parse_record(header, lines)
+            # Stop at the first record that starts past the byte range
+            if end is not None and offset >= end:
+                return
+            header_offset, header, lines = offset, line, []
+        elif header is not None:
+            lines.append(line)
+        offset += len(line)
+
+    if header is not None:
+        yield header_offset, _parse_record(header, lines)
+
+
+def iter_fasta(
+    fasta_file: PathLike,
+    start: int = 0,
+    end: int | None = None,
+) -> Iterator[Sequence]:
+    """Lazily parse the sequences of a fasta file.
+
+    Only one record is held in memory at a time. Given a byte range, only
+    the records whose header starts in [start, end) are parsed, so that
+    any split of the file into byte ranges splits its records exactly.
+
+    Parameters
+    ----------
+    fasta_file : PathLike
+        The path to the fasta file.
+    start : int, optional
+        The start of the byte range, by default 0.
+    end : int, optional
+        The end of the byte range, by default the end of the file.
+
+    Yields
+    ------
+    Sequence
+        The sequences, in file order.
+    """
+    with open(fasta_file, 'rb') as fp:
+        for _, sequence in _iter_records(fp, start, end):
+            yield sequence
+
+
+def iter_fasta_shard(
+    fasta_file: PathLike,
+    num_shards: int,
+    shard_index: int,
+) -> Iterator[tuple[int, Sequence]]:
+    """Parse the sequences of one contiguous byte range of a fasta file.
+
+    Parameters
+    ----------
+    fasta_file : PathLike
+        The path to the fasta file.
+    num_shards : int
+        The number of equal byte ranges the file is split into.
+    shard_index : int
+        The index of the byte range to parse.
+
+    Yields
+    ------
+    tuple[int, Sequence]
+        The byte offset of each sequence in the file and the sequence.
+    """
+    size = Path(fasta_file).stat().st_size
+    start = size * shard_index // num_shards
+    end = size * (shard_index + 1) // num_shards
+    with open(fasta_file, 'rb') as fp:
+        yield from _iter_records(fp, start, end)
+
+
 def read_fasta(fasta_file: PathLike) -> list[Sequence]:
     """Read fasta file sequences and description tags into dataclass."""
-    text = Path(fasta_file).read_text()
-    pattern = re.compile('^>', re.MULTILINE)
-    non_parsed_seqs = re.split(pattern, text)[1:]
-    lines = [
-        line.replace('\n', '')
-        for seq in non_parsed_seqs
-        for line in seq.split('\n', 1)
-    ]
-
-    return [
-        Sequence(sequence=seq, tag=tag)
-        for seq, tag in zip(lines[1::2], lines[::2])
-    ]
+    return list(iter_fasta(fasta_file))
 
 
 def write_fasta(
-    sequences: Sequence | list[Sequence],
+    sequences: Sequence | Iterable[Sequence],
     fasta_file: PathLike,
     mode: str = 'w',
 ) -> None:
@@ -55,7 +152,100 @@ def write_fasta(
             f.write(f'>{seq.tag}\n{seq.sequence}\n')
 
 
-class FastaDatasetConfig(BaseConfig):
+def index_fasta(fasta_file: PathLike, index_file: PathLike) -> None:
+    """Write the samtools faidx index of a fasta file.
+
+    Each line of the index holds the name (the first word of the tag),
+    the length of the sequence, the byte offset of the sequence, and the
+    number of bases and bytes in each of its lines, which samtools and
+    pyfaidx expect to be the same across the lines of a record.
+    """
+    with open(fasta_file, 'rb') as fp, open(index_file, 'w') as fout:
+        offset = 0
+        record: list[Any] | None = None
+        for line in fp:
+            offset += len(line)
+            if line.startswith(b'>'):
+                if record is not None:
+                    fout.write('\t'.join(map(str, record)) + '\n')
+                name = line[1:].split(maxsplit=1)[:1] or [b'']
+                record = [name[0].decode(), 0, offset, 0, 0]
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if not record[3]:
+                    record[3], record[4] = bases, len(line)
+                record[1] += bases
+
+        if record is not None:
+            fout.write('\t'.join(map(str, record)) + '\n')
+
+
+class FastaIndex:
+    """Random access to the sequences of a fasta file by their index.
+
+    The byte offsets of the sequences are read from a samtools faidx
+    index next to the file (`<fasta_file>.fai`), which is written with
+    one streaming pass over the file when it is missing or older than the
+    file. Only the offsets and lengths of the sequences are held in
+    memory, and each lookup parses a single record.
+    """
+
+    def __init__(
+        self,
+        fasta_file: PathLike,
+        index_file: PathLike | None = None,
+    ) -> None:
+        """Initialize the index.
+
+        Parameters
+        ----------
+        fasta_file : PathLike
+            The path to the fasta file.
+        index_file : PathLike, optional
+            The path to the index, by default `<fasta_file>.fai`.
+        """
+        self.fasta_file = Path(fasta_file)
+        self.index_file = Path(index_file or f'{fasta_file}.fai')
+
+        # Build the index if it is missing or stale
+        if (
+            not self.index_file.exists()
+            or self.index_file.stat().st_mtime
+            < self.fasta_file.stat().st_mtime
+        ):
+            index_fasta(self.fasta_file, self.index_file)
+
+        # Load the names, lengths and sequence offsets of the records
+        with open(self.index_file) as fp:
+            fields = [line.split('\t')[:3] for line in fp]
+        self.names = [field[0] for field in fields]
+        self.lengths = np.array([int(f[1]) for f in fields], dtype=np.int64)
+        self.offsets = np.array([int(f[2]) for f in fields], dtype=np.int64)
+
+    def __len__(self) -> int:
+        """Get the number of sequences."""
+        return len(self.offsets)
+
+    def __getitem__(self, idx: int) -> Sequence:
+        """Get the sequence at the index."""
+        offset = int(self.offsets[idx])
+        with open(self.fasta_file, 'rb') as fp:
+            # Find the start of the header line ending before the sequence
+            start = end = offset - 1
+            while start > 0:
+                start = max(end - 4096, 0)
+                fp.seek(start)
+                newline = fp.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    start += newline + 1
+                    break
+                end = start
+
+            _, sequence = next(_iter_records(fp, start))
+        return sequence
+
+
+class FastaDatasetConfig(BatchingConfig):
     """Configuration for the FastaDataset."""
 
     name: Literal['fasta'] = 'fasta'  # type: ignore[assignment]
@@ -66,6 +256,9 @@ class FastaDatasetConfig(BaseConfig):
     batch_size: int = 8
     # Whether to pin memory for the dataloader.
     pin_memory: bool = True
+    # Whether to parse the file lazily in the data workers instead of
+    # reading it into memory (each worker parses a byte range of the file).
+    streaming: bool = False
 
 
 class FastaDataset:
@@ -75,6 +268,15 @@ class FastaDataset:
         """Initialize the dataset."""
         self.config = config
 
+    def _items(
+        self,
+        data_file: Path,
+        record: Sequence,
+    ) -> list[tuple[str, dict[str, Any]]]:
+        """Get the (text, metadata) items of a streamed record."""
+        metadata = {'tags': record.tag, 'paths': str(data_file)}
+        return [(record.sequence.upper(), metadata)]
+
     def get_dataloader(
         self,
         data_file: Path,
@@ -94,6 +296,20 @@ class FastaDataset:
         DataLoader
             The dataloader instance.
         """
+        # Stream the fasta file through the data workers
+        if self.config.streaming:
+            return DataLoader(
+                pin_memory=self.config.pin_memory,
+                batch_size=self.config.batch_size,
+                num_workers=self.config.num_data_workers,
+                dataset=StreamingDataset(
+                    data_file,
+                    partial(self._items, data_file),
+                    reader=iter_fasta_shard,
+                ),
+                collate_fn=StreamingDataCollator(encoder.tokenizer),
+            )
+
         # Read the sequences from the fasta file
         sequences = read_fasta(data_file)
 
@@ -108,8 +324,14 @@ class FastaDataset:
         # Instantiate the dataloader
         return DataLoader(
             pin_memory=self.config.pin_memory,
-            batch_size=self.config.batch_size,
             num_workers=self.config.num_data_workers,
             dataset=InMemoryDataset(data, metadata),
             collate_fn=DataCollator(encoder.tokenizer),
+            **batching_kwargs(
+                data,
+                encoder.tokenizer,
+                self.config.batch_size,
+                self.config.length_bucketing,
+                self.config.max_tokens_per_batch,
+            ),
         )
@@ -9,13 +9,14 @@ from datasets import Dataset
 from pydantic import Field
 from torch.utils.data import DataLoader
 
+from distllm.embed.datasets.utils import batching_kwargs
+from distllm.embed.datasets.utils import BatchingConfig
 from distllm.embed.datasets.utils import DataCollator
 from distllm.embed.datasets.utils import InMemoryDataset
 from distllm.embed.encoders.base import Encoder
-from distllm.utils import BaseConfig
 
 
-class HuggingFaceDatasetConfig(BaseConfig):
+class HuggingFaceDatasetConfig(BatchingConfig):
     """Configuration for the hugging face dataset."""
 
     name: Literal['huggingface'] = 'huggingface'  # type: ignore[assignment]
@@ -76,8 +77,14 @@ class HuggingFaceDataset:
         # Instantiate the dataloader
         return DataLoader(
             pin_memory=self.config.pin_memory,
-            batch_size=self.config.batch_size,
             num_workers=self.config.num_data_workers,
             dataset=InMemoryDataset(texts, metadatas),
             collate_fn=DataCollator(encoder.tokenizer),
+            **batching_kwargs(
+                texts,
+                encoder.tokenizer,
+                self.config.batch_size,
+                self.config.length_bucketing,
+                self.config.max_tokens_per_batch,
+            ),
         )
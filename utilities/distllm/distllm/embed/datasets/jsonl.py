@@ -2,19 +2,23 @@
 
 from __future__ import annotations
 
-import json
 from pathlib import Path
+from typing import Any
 from typing import Literal
 
 from torch.utils.data import DataLoader
 
+from distllm.embed.datasets.utils import batching_kwargs
+from distllm.embed.datasets.utils import BatchingConfig
 from distllm.embed.datasets.utils import DataCollator
 from distllm.embed.datasets.utils import InMemoryDataset
+from distllm.embed.datasets.utils import StreamingDataCollator
+from distllm.embed.datasets.utils import StreamingDataset
 from distllm.embed.encoders.base import Encoder
-from distllm.utils import BaseConfig
+from distllm.utils import iter_jsonl
 
 
-class JsonlDatasetConfig(BaseConfig):
+class JsonlDatasetConfig(BatchingConfig):
     """Configuration for the JsonlDataset."""
 
     # The name of the dataset
@@ -28,6 +32,9 @@ class JsonlDatasetConfig(BaseConfig):
     batch_size: int = 8
     # Whether to pin memory for the dataloader.
     pin_memory: bool = True
+    # Whether to parse the file lazily in the data workers instead of
+    # reading it into memory (supports .jsonl.gz and .jsonl.zst files).
+    streaming: bool = False
 
 
 class JsonlDataset:
@@ -37,6 +44,10 @@ class JsonlDataset:
         """Initialize the dataset."""
         self.config = config
 
+    def _items(self, record: dict[str, Any]) -> list[tuple[str, None]]:
+        """Get the (text, metadata) items of a streamed record."""
+        return [(record[self.config.text_field], None)]
+
     def get_dataloader(
         self,
         data_file: Path,
@@ -56,18 +67,30 @@ class JsonlDataset:
         DataLoader
             The dataloader instance.
         """
-        # Read the jsonl file
-        lines = data_file.read_text().strip().split('\n')
-        content = [json.loads(line) for line in lines]
-
-        # Extract the text data
-        data = [item[self.config.text_field] for item in content]
+        # Stream the jsonl file through the data workers
+        if self.config.streaming:
+            return DataLoader(
+                pin_memory=self.config.pin_memory,
+                batch_size=self.config.batch_size,
+                num_workers=self.config.num_data_workers,
+                dataset=StreamingDataset(data_file, self._items),
+                collate_fn=StreamingDataCollator(encoder.tokenizer),
+            )
+
+        # Extract the text data from the jsonl file
+        data = [item[self.config.text_field] for item in iter_jsonl(data_file)]
 
         # Instantiate the dataloader
         return DataLoader(
             pin_memory=self.config.pin_memory,
-            batch_size=self.config.batch_size,
             num_workers=self.config.num_data_workers,
             dataset=InMemoryDataset(data),
             collate_fn=DataCollator(encoder.tokenizer),
+            **batching_kwargs(
+                data,
+                encoder.tokenizer,
+                self.config.batch_size,
+                self.config.length_bucketing,
+                self.config.max_tokens_per_batch,
+            ),
         )
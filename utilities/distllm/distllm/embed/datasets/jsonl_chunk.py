@@ -6,7 +6,8 @@ https://github.com/run-llama/llama_index/blob/main/llama-index-core/llama_index/
 
 from __future__ import annotations
 
-import json
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Any
 from typing import Callable
@@ -15,50 +16,64 @@ from typing import Literal
 from pydantic import Field
 from torch.utils.data import DataLoader
 
+from distllm.embed.datasets.utils import batching_kwargs
+from distllm.embed.datasets.utils import BatchingConfig
 from distllm.embed.datasets.utils import DataCollator
 from distllm.embed.datasets.utils import InMemoryDataset
+from distllm.embed.datasets.utils import StreamingDataCollator
+from distllm.embed.datasets.utils import StreamingDataset
 from distllm.embed.encoders.base import Encoder
-from distllm.utils import BaseConfig
+from distllm.threads import available_cpus
+from distllm.utils import iter_jsonl
 
 
-def split_by_sentence_tokenizer() -> Callable[[str], list[str]]:
-    """Split the text into sentences using nltk."""
-    import nltk
+class PunktSentenceSplitter:
+    """Split the text into sentences using nltk.
+
+    A class rather than a closure so that it can be sent to the worker
+    processes that split documents in parallel.
+    """
 
-    tokenizer = nltk.tokenize.PunktSentenceTokenizer()
+    def __init__(self) -> None:
+        """Initialize the Punkt sentence tokenizer."""
+        import nltk
 
-    # get the spans and then return the sentences
-    # using the start index of each span
-    # instead of using end, use the start of the next span if available
-    def split(text: str) -> list[str]:
-        spans = list(tokenizer.span_tokenize(text))
-        sentences = []
-        for i, span in enumerate(spans):
-            start = span[0]
-            end = spans[i + 1][0] if i < len(spans) - 1 else len(text)
-            sentences.append(text[start:end])
+        self.tokenizer = nltk.tokenize.PunktSentenceTokenizer()
 
-        return sentences
+    def __call__(self, text: str) -> list[str]:
+        """Split the text into sentences."""
+        # get the spans and then return the sentences
+        # using the start index of each span
+        # instead of using end, use the start of the next span if available
+        starts = [start for start, _ in self.tokenizer.span_tokenize(text)]
+        ends = [*starts[1:], len(text)]
+        return [text[start:end] for start, end in zip(starts, ends)]
 
-    return split
+
+def split_by_sentence_tokenizer() -> Callable[[str], list[str]]:
+    """Split the text into sentences using nltk."""
+    return PunktSentenceSplitter()
 
 
 def sentences_to_buffers(split: list[str], buffer_size: int) -> list[str]:
-    """Group split into buffers."""
+    """Group split into buffers.
+
+    Each buffer is the window of sentences `[i - buffer_size, i +
+    buffer_size]` around sentence `i`. The sentences are joined once and
+    each window is sliced using the prefix sum of the sentence lengths,
+    rather than re-joining the overlapping windows.
+    """
+    text = ''.join(split)
+    offsets = [0, *itertools.accumulate(len(sentence) for sentence in split)]
     buffers = []
     for i in range(len(split)):
-        combined = ''.join(
-            split[j]
-            for j in range(
-                max(0, i - buffer_size),
-                min(i + 1 + buffer_size, len(split)),
-            )
-        )
-        buffers.append(combined)
+        start = offsets[max(0, i - buffer_size)]
+        end = offsets[min(i + 1 + buffer_size, len(split))]
+        buffers.append(text[start:end])
     return buffers
 
 
-class JsonlChunkDatasetConfig(BaseConfig):
+class JsonlChunkDatasetConfig(BatchingConfig):
     """Configuration for the JsonlChunkDatasetConfig."""
 
     # The name of the dataset
@@ -72,6 +87,14 @@ class JsonlChunkDatasetConfig(BaseConfig):
     batch_size: int = 8
     # Whether to pin memory for the dataloader.
     pin_memory: bool = True
+    # Whether to parse and split the file lazily in the data workers
+    # instead of reading it into memory (supports .jsonl.gz and .jsonl.zst).
+    streaming: bool = False
+    # The number of processes that split the documents into sentences when
+    # the file is read into memory, by default the documents are split in
+    # this process (avoids forking, e.g., from inside Parsl workers, which
+    # costs more than it saves on small files).
+    num_split_workers: int = 1
 
     # The length threshold to filter out small buffers
     # (number of characters in the buffer)
@@ -104,6 +127,49 @@ class JsonlChunkDataset:
         # TODO: In the future we may want a splitter abstraction.
         self.splitter = split_by_sentence_tokenizer()
 
+    def _buffers(
+        self,
+        record: dict[str, Any],
+    ) -> list[tuple[str, dict[str, Any]]]:
+        """Split a document into its (buffer, metadata) items.
+
+        Parameters
+        ----------
+        record : dict[str, Any]
+            The jsonl record of the document.
+
+        Returns
+        -------
+        list[tuple[str, dict[str, Any]]]
+            The windowed sentence buffers that pass the length filter,
+            and their metadata.
+
+        Raises
+        ------
+        ValueError
+            If the metadata is empty.
+        """
+        # Extract the text data
+        text = record.pop(self.config.text_field)
+
+        # The metadata is a dictionary of all the other fields in the
+        # jsonl file except for the text field since that is extracted.
+        if not record:
+            raise ValueError('Metadata is empty. Please check the jsonl file.')
+
+        # Split the text into sentences and group them into windowed buffers
+        split = self.splitter(text)
+        buffers = sentences_to_buffers(split, self.config.buffer_size)
+
+        # Add the split to the metadata to be able to unpack the
+        # semantic chunks properly, and apply a length filter to remove
+        # any small buffers
+        return [
+            (buffer, {**record, 'sentence': sentence})
+            for buffer, sentence in zip(buffers, split)
+            if len(buffer) > self.config.min_buffer_length
+        ]
+
     def get_dataloader(
         self,
         data_file: Path,
@@ -128,52 +194,42 @@ class JsonlChunkDataset:
         ValueError
             If the metadata is empty.
         """
-        # Read the jsonl file
-        lines = data_file.read_text().strip().split('\n')
-        content: list[dict[str, Any]] = [json.loads(line) for line in lines]
-
-        # Extract the text data
-        data = [item.pop(self.config.text_field) for item in content]
-
-        # Extract the metadata if needed, note that the metadata is
-        # is a dictionary of all the other fields in the jsonl file
-        # except for the text field since that is already extracted.
-        metadata = content
-
-        # Check if metadata is empty
-        if not metadata or any(not item for item in metadata):
-            raise ValueError('Metadata is empty. Please check the jsonl file.')
+        # Stream the jsonl file through the data workers, which also
+        # split the text into buffers
+        if self.config.streaming:
+            return DataLoader(
+                pin_memory=self.config.pin_memory,
+                batch_size=self.config.batch_size,
+                num_workers=self.config.num_data_workers,
+                dataset=StreamingDataset(data_file, self._buffers),
+                collate_fn=StreamingDataCollator(encoder.tokenizer),
+            )
 
-        # Split the data based on the split criteria
-        # Each input text is split into a list of str.
-        splits = [self.splitter(text) for text in data]
-
-        # Group each text split into windowed buffers
-        buffers, metadatas = [], []
-        for idx, split in enumerate(splits):
-            bufs = sentences_to_buffers(split, self.config.buffer_size)
-            buffers.extend(bufs)
-            # Add the split to the metadata to be able to unpack the
-            # semantic chunks properly
-            for sentence in split:
-                mdata = metadata[idx].copy()
-                mdata['sentence'] = sentence
-                metadatas.append(mdata)
-
-        # Apply a length filter to remove any small buffers
-        filter_indices = [
-            i
-            for i, buf in enumerate(buffers)
-            if len(buf) > self.config.min_buffer_length
-        ]
-        buffers = [buffers[i] for i in filter_indices]
-        metadatas = [metadatas[i] for i in filter_indices]
+        # Split the documents of the jsonl file into buffers, optionally in
+        # parallel since the data workers are idle until the dataloader is
+        # built
+        records = iter_jsonl(data_file)
+        num_workers = min(self.config.num_split_workers, available_cpus())
+        if num_workers > 1:
+            with ProcessPoolExecutor(num_workers) as pool:
+                documents = list(pool.map(self._buffers, records, chunksize=8))
+        else:
+            documents = [self._buffers(record) for record in records]
+        items = [item for document in documents for item in document]
+        buffers = [text for text, _ in items]
+        metadatas = [metadata for _, metadata in items]
 
         # Instantiate the dataloader
         return DataLoader(
             pin_memory=self.config.pin_memory,
-            batch_size=self.config.batch_size,
             num_workers=self.config.num_data_workers,
             dataset=InMemoryDataset(buffers, metadatas),
             collate_fn=DataCollator(encoder.tokenizer),
+            **batching_kwargs(
+                buffers,
+                encoder.tokenizer,
+                self.config.batch_size,
+                self.config.length_bucketing,
+                self.config.max_tokens_per_batch,
+            ),
         )
@@ -7,13 +7,14 @@ from typing import Literal
 
 from torch.utils.data import DataLoader
 
+from distllm.embed.datasets.utils import batching_kwargs
+from distllm.embed.datasets.utils import BatchingConfig
 from distllm.embed.datasets.utils import DataCollator
 from distllm.embed.datasets.utils import InMemoryDataset
 from distllm.embed.encoders.base import Encoder
-from distllm.utils import BaseConfig
 
 
-class SequencePerLineDatasetConfig(BaseConfig):
+class SequencePerLineDatasetConfig(BatchingConfig):
     """Configuration for the SequencePerLineDataset."""
 
     # The name of the dataset
@@ -61,8 +62,14 @@ class SequencePerLineDataset:
         # Instantiate the dataloader
         return DataLoader(
             pin_memory=self.config.pin_memory,
-            batch_size=self.config.batch_size,
             num_workers=self.config.num_data_workers,
             dataset=InMemoryDataset(data),
             collate_fn=DataCollator(encoder.tokenizer),
+            **batching_kwargs(
+                data,
+                encoder.tokenizer,
+                self.config.batch_size,
+                self.config.length_bucketing,
+                self.config.max_tokens_per_batch,
+            ),
         )
@@ -2,11 +2,76 @@
 
 from __future__ import annotations
 
+from pathlib import Path
 from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
 
+import numpy as np
+from pydantic import model_validator
+from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
+from torch.utils.data import get_worker_info
+from torch.utils.data import IterableDataset
+from torch.utils.data import Sampler
+from torch.utils.data import Subset
 from transformers import BatchEncoding
 from transformers import PreTrainedTokenizer
+from typing_extensions import Self
+
+from distllm.utils import BaseConfig
+from distllm.utils import iter_jsonl
+
+
+class BatchingConfig(BaseConfig):
+    """Settings for how the datasets batch their sequences."""
+
+    # Whether to batch sequences of similar token length together to
+    # minimize padding (the embeddings keep the order of the data).
+    length_bucketing: bool = False
+    # The maximum number of (padded) tokens per batch, if set the batches
+    # are packed up to this budget instead of batch_size sequences.
+    max_tokens_per_batch: Optional[int] = None  # noqa: UP007
+
+    @model_validator(mode='after')
+    def check_streaming(self) -> Self:
+        """Reject the batching options that streaming datasets ignore."""
+        # Streamed items are batched as they are parsed, since the token
+        # lengths of the whole file are not known up front
+        streaming = getattr(self, 'streaming', False)
+        if streaming and (
+            self.length_bucketing or self.max_tokens_per_batch is not None
+        ):
+            raise ValueError(
+                'length_bucketing and max_tokens_per_batch are not '
+                'supported with streaming=True.',
+            )
+        return self
+
+
+# The items of a streaming dataset: (position, text, metadata)
+StreamingItem = Tuple[Tuple[int, int], str, Optional[Dict[str, Any]]]
+
+# Parses the (position, record) pairs of one shard of a file, given the
+# file, the number of shards and the index of the shard
+ShardReader = Callable[[Path, int, int], Iterator[Tuple[int, Any]]]
+
+
+def iter_jsonl_shard(
+    data_file: Path,
+    num_shards: int,
+    shard_index: int,
+) -> Iterator[tuple[int, dict[str, Any]]]:
+    """Parse every `num_shards`-th record of a jsonl file with its index."""
+    records = iter_jsonl(data_file, num_shards, shard_index)
+    for k, record in enumerate(records):
+        yield k * num_shards + shard_index, record
 
 
 class InMemoryDataset(Dataset):
@@ -33,6 +98,244 @@ class InMemoryDataset(Dataset):
         return self.data[idx]
 
 
+class StreamingDataset(IterableDataset):
+    """Streams the records of a file, sharded across data workers.
+
+    Each DataLoader worker parses one shard of the records of the file
+    (by default every `num_workers`-th record of a jsonl file), so the
+    file is never held in memory and the first batch is ready as soon as
+    its records are parsed. Since the workers interleave their batches,
+    each item carries its position in the file, i.e., the position of the
+    record and the index of the item within the record.
+    """
+
+    def __init__(
+        self,
+        data_file: Path,
+        transform: Callable[
+            [Any],
+            Sequence[tuple[str, dict[str, Any] | None]],
+        ],
+        reader: ShardReader = iter_jsonl_shard,
+    ) -> None:
+        """Initialize the dataset.
+
+        Parameters
+        ----------
+        data_file : Path
+            The file to read, by default a jsonl file (.jsonl, .jsonl.gz or
+            .jsonl.zst).
+        transform : Callable
+            Maps a record of the reader to its (text, metadata) items.
+        reader : ShardReader, optional
+            Parses the (position, record) pairs of a shard of the file,
+            where the positions sort the records in file order, by default
+            the records of a jsonl file with their indices.
+        """
+        self.data_file = data_file
+        self.transform = transform
+        self.reader = reader
+
+    def __iter__(self) -> Iterator[StreamingItem]:
+        """Iterate over the items of this worker's records."""
+        # Shard the records across the DataLoader workers
+        worker = get_worker_info()
+        num_shards = worker.num_workers if worker else 1
+        shard_index = worker.id if worker else 0
+
+        records = self.reader(self.data_file, num_shards, shard_index)
+        for position, record in records:
+            for i, (text, metadata) in enumerate(self.transform(record)):
+                yield (position, i), text, metadata
+
+
+class StreamingBatch(NamedTuple):
+    """A batch of a streaming dataset with the items it was built from."""
+
+    # The tokenized text
+    encoding: BatchEncoding
+    # The position of each item in the file
+    positions: list[tuple[int, int]]
+    # The original text
+    text: list[str]
+    # The optional metadata
+    metadata: list[dict[str, Any] | None]
+
+
+def token_lengths(
+    data: list[str],
+    tokenizer: PreTrainedTokenizer,
+    chunk_size: int = 1024,
+) -> np.ndarray:
+    """Count the tokens of each sequence as the data collator would.
+
+    Parameters
+    ----------
+    data : list[str]
+        The sequences to count.
+    tokenizer : PreTrainedTokenizer
+        The tokenizer of the encoder.
+    chunk_size : int, optional
+        The number of sequences to tokenize at once, by default 1024.
+
+    Returns
+    -------
+    np.ndarray
+        The number of tokens of each sequence (after truncation).
+    """
+    lengths = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        input_ids = tokenizer(
+            data[start : start + chunk_size],
+            truncation=True,
+        )['input_ids']
+        lengths[start : start + len(input_ids)] = [len(x) for x in input_ids]
+    return lengths
+
+
+class LengthBucketBatchSampler(Sampler[List[int]]):
+    """Batches sequences of similar length to minimize padding.
+
+    The sequences are sorted by their token length (longest first, so
+    that out-of-memory errors surface on the first batch) and split into
+    batches of `batch_size`, or, if `max_tokens` is set, into batches
+    whose padded size (number of sequences times the longest length)
+    fits in the token budget. A sequence longer than the budget gets a
+    batch of its own. The batches hold dataset indices, so the
+    embeddings can be put back in the dataset order.
+    """
+
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        batch_size: int,
+        max_tokens: int | None = None,
+    ) -> None:
+        """Initialize the sampler.
+
+        Parameters
+        ----------
+        lengths : np.ndarray
+            The number of tokens of each sequence in the dataset.
+        batch_size : int
+            The number of sequences per batch, ignored if `max_tokens`
+            is set.
+        max_tokens : int, optional
+            The maximum number of (padded) tokens per batch, by default
+            None.
+        """
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+
+        # Form the batches once, since the lengths do not change
+        order = np.argsort(-lengths, kind='stable')
+        if max_tokens is None:
+            bounds = range(0, len(order), batch_size)
+            self.batches = [
+                order[start : start + batch_size].tolist() for start in bounds
+            ]
+        else:
+            self.batches = []
+            start = 0
+            while start < len(order):
+                # The first sequence is the longest of the batch
+                size = max(max_tokens // max(lengths[order[start]], 1), 1)
+                self.batches.append(order[start : start + size].tolist())
+                start += size
+
+    def __iter__(self) -> Iterator[list[int]]:
+        """Iterate over the batches of dataset indices."""
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        """Get the number of batches."""
+        return len(self.batches)
+
+
+def batching_kwargs(
+    data: list[str],
+    tokenizer: PreTrainedTokenizer,
+    batch_size: int,
+    length_bucketing: bool = False,
+    max_tokens_per_batch: int | None = None,
+) -> dict[str, Any]:
+    """Get the DataLoader arguments that control the batching.
+
+    Parameters
+    ----------
+    data : list[str]
+        The sequences of the dataset.
+    tokenizer : PreTrainedTokenizer
+        The tokenizer of the encoder.
+    batch_size : int
+        The number of sequences per batch.
+    length_bucketing : bool, optional
+        Whether to batch sequences of similar length together,
+        by default False, in which case batches follow the data order.
+    max_tokens_per_batch : int, optional
+        Pack the batches up to this number of (padded) tokens instead of
+        `batch_size` sequences, by default None. Implies length bucketing.
+
+    Returns
+    -------
+    dict[str, Any]
+        Either the `batch_size` or the `batch_sampler` of the DataLoader.
+    """
+    if not length_bucketing and max_tokens_per_batch is None:
+        return {'batch_size': batch_size}
+
+    # Tokenize the data once to get the lengths of the sequences
+    lengths = token_lengths(data, tokenizer)
+    sampler = LengthBucketBatchSampler(
+        lengths,
+        batch_size,
+        max_tokens_per_batch,
+    )
+    return {'batch_sampler': sampler}
+
+
+def subset_dataloader(
+    dataloader: DataLoader,
+    indices: np.ndarray,
+) -> DataLoader:
+    """Get a dataloader over a subset of the data, batched the same way.
+
+    Parameters
+    ----------
+    dataloader : DataLoader
+        The dataloader of the full (in-memory) dataset.
+    indices : np.ndarray
+        The dataset indices of the subset.
+
+    Returns
+    -------
+    DataLoader
+        The dataloader of the subset, its batch sampler yields indices
+        into `indices`.
+    """
+    sampler = dataloader.batch_sampler
+    batching: dict[str, Any]
+    if isinstance(sampler, LengthBucketBatchSampler):
+        batching = {
+            'batch_sampler': LengthBucketBatchSampler(
+                sampler.lengths[indices],
+                sampler.batch_size,
+                sampler.max_tokens,
+            ),
+        }
+    else:
+        batching = {'batch_size': dataloader.batch_size}
+
+    return DataLoader(
+        pin_memory=dataloader.pin_memory,
+        num_workers=dataloader.num_workers,
+        dataset=Subset(dataloader.dataset, indices.tolist()),
+        collate_fn=dataloader.collate_fn,
+        **batching,
+    )
+
+
 class DataCollator:
     """Data collator for batching sequences."""
 
@@ -48,3 +351,20 @@ class DataCollator:
             truncation=True,
             return_tensors='pt',
         )
+
+
+class StreamingDataCollator(DataCollator):
+    """Data collator for batching the items of a streaming dataset."""
+
+    def __call__(  # type: ignore[override]
+        self,
+        batch: list[StreamingItem],
+    ) -> StreamingBatch:
+        """Collate the batch of items, keeping their text and metadata."""
+        positions, text, metadata = map(list, zip(*batch))
+        return StreamingBatch(
+            encoding=super().__call__(text),
+            positions=positions,
+            text=text,
+            metadata=metadata,
+        )
@@ -4,11 +4,13 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from typing import Any
+from typing import Iterator
 from typing import Protocol
 
 import numpy as np
 from torch.utils.data import DataLoader
 
+from distllm.embed.cache import EmbeddingCache
 from distllm.embed.encoders.base import Encoder
 from distllm.embed.poolers.base import Pooler
 from distllm.utils import BaseConfig
@@ -38,6 +40,7 @@ class Embedder(Protocol):
         dataloader: DataLoader,
         encoder: Encoder,
         pooler: Pooler,
+        cache: EmbeddingCache | None = None,
     ) -> EmbedderResult:
         """Embed the sequences.
 
@@ -49,6 +52,9 @@ class Embedder(Protocol):
             The encoder to use for inference.
         pooler : Pooler
             The pooler to use for pooling the embeddings.
+        cache : EmbeddingCache, optional
+            A store of previously computed embeddings, by default None.
+            Only the texts missing from the store are encoded.
 
         Returns
         -------
@@ -56,3 +62,31 @@ class Embedder(Protocol):
             Dataclass with the embeddings, text, and optional metadata.
         """
         ...
+
+    def embed_batches(
+        self,
+        dataloader: DataLoader,
+        encoder: Encoder,
+        pooler: Pooler,
+        cache: EmbeddingCache | None = None,
+    ) -> Iterator[EmbedderResult]:
+        """Embed the sequences, yielding the result batch by batch.
+
+        Parameters
+        ----------
+        dataloader : DataLoader
+            The dataloader to use for batching the data.
+        encoder : Encoder
+            The encoder to use for inference.
+        pooler : Pooler
+            The pooler to use for pooling the embeddings.
+        cache : EmbeddingCache, optional
+            A store of previously computed embeddings, by default None.
+            Only the texts missing from the store are encoded.
+
+        Yields
+        ------
+        EmbedderResult
+            The embeddings, text, and optional metadata of each batch.
+        """
+        ...
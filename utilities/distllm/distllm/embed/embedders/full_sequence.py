@@ -2,20 +2,56 @@
 
 from __future__ import annotations
 
+from typing import Iterator
 from typing import Literal
+from typing import Optional
 
 import numpy as np
 import torch
 import torch.nn.functional as F  # noqa: N812
 from pydantic import Field
 from torch.utils.data import DataLoader
+from torch.utils.data import IterableDataset
 from tqdm import tqdm
+from transformers import BatchEncoding
 
+from distllm.embed.cache import EmbeddingCache
+from distllm.embed.datasets.utils import StreamingBatch
+from distllm.embed.datasets.utils import subset_dataloader
 from distllm.embed.embedders.base import EmbedderResult
 from distllm.embed.encoders.base import Encoder
 from distllm.embed.poolers.base import Pooler
+from distllm.embed.precision import cast_embeddings
+from distllm.embed.precision import OutputDtype
 from distllm.utils import BaseConfig
 
+# The number of newly computed embeddings gathered before they are
+# stored in the cache when embedding incrementally
+CACHE_SHARD_SIZE = 65536
+
+
+def _embed_batch(
+    batch: BatchEncoding,
+    encoder: Encoder,
+    pooler: Pooler,
+    normalize: bool,
+) -> torch.Tensor:
+    """Compute the pooled embeddings of a batch on the host."""
+    # Move the batch to the model device
+    inputs = batch.to(encoder.device)
+
+    # Get the model outputs with a forward pass
+    embeddings = encoder.encode(inputs)
+
+    # Compute the pooled embeddings
+    pooled_embeds = pooler.pool(embeddings, inputs.attention_mask)
+
+    # Normalize the embeddings
+    if normalize:
+        pooled_embeds = F.normalize(pooled_embeds, p=2, dim=-1)
+
+    return pooled_embeds.cpu()
+
 
 @torch.no_grad()
 def compute_embeddings(
@@ -23,6 +59,7 @@ def compute_embeddings(
     encoder: Encoder,
     pooler: Pooler,
     normalize: bool = False,
+    cache: EmbeddingCache | None = None,
 ) -> np.ndarray:
     """Compute pooled hidden embeddings.
 
@@ -36,6 +73,9 @@ def compute_embeddings(
         The pooler to use for pooling the embeddings.
     normalize : bool, optional
         Whether to normalize the embeddings, by default False.
+    cache : EmbeddingCache, optional
+        A store of previously computed embeddings, by default None. Only
+        the texts missing from the store are encoded (and then stored).
 
     Returns
     -------
@@ -51,33 +91,241 @@ def compute_embeddings(
         dtype=encoder.dtype,
     )
 
-    # Index for storing embeddings
-    idx = 0
+    # Fill in the cached embeddings and only encode the missing texts
+    indices_map = np.arange(num_embeddings)
+    if cache is not None:
+        keys = cache.keys(dataloader.dataset.data, normalize)
+        found, cached = cache.get(keys)
+        if found.any():
+            all_embeddings[torch.from_numpy(found)] = torch.as_tensor(
+                cached,
+                dtype=encoder.dtype,
+            )
+        indices_map = np.flatnonzero(~found)
+        dataloader = subset_dataloader(dataloader, indices_map)
+
+    # The batch sampler yields the dataset indices of each batch, which
+    # may be reordered (e.g., to batch sequences of similar length)
+    for batch, indices in zip(tqdm(dataloader), dataloader.batch_sampler):
+        # Compute the pooled embeddings
+        pooled_embeds = _embed_batch(batch, encoder, pooler, normalize)
+
+        # Store the pooled embeddings in the dataset order
+        all_embeddings[indices_map[indices], :] = pooled_embeds
+
+    # Store the newly computed embeddings
+    if cache is not None:
+        cache.put(keys[indices_map], all_embeddings[indices_map].numpy())
+
+    return all_embeddings.numpy()
+
+
+def _embed_cached_batch(  # noqa: PLR0913
+    encoding: BatchEncoding,
+    text: list[str],
+    encoder: Encoder,
+    pooler: Pooler,
+    normalize: bool,
+    cache: EmbeddingCache | None,
+) -> tuple[torch.Tensor, np.ndarray | None, np.ndarray]:
+    """Compute the pooled embeddings of a batch, looking up the cache first.
+
+    Returns the pooled embeddings, the cache keys of the batch (None
+    without a cache) and which rows of the batch were encoded.
+    """
+    # Look up the cached embeddings of the batch
+    pooled_embeds = torch.empty(
+        (len(text), encoder.embedding_size),
+        dtype=encoder.dtype,
+    )
+    keys, missing = None, np.ones(len(text), dtype=bool)
+    if cache is not None:
+        keys = cache.keys(text, normalize)
+        found, cached = cache.get(keys)
+        if found.any():
+            pooled_embeds[torch.from_numpy(found)] = torch.as_tensor(
+                cached,
+                dtype=encoder.dtype,
+            )
+        missing = ~found
+
+    # Compute the pooled embeddings of the missing items
+    if missing.any():
+        rows = torch.from_numpy(np.flatnonzero(missing))
+        inputs = BatchEncoding({k: v[rows] for k, v in encoding.items()})
+        pooled_embeds[rows] = _embed_batch(
+            inputs,
+            encoder,
+            pooler,
+            normalize,
+        ).to(encoder.dtype)
+
+    return pooled_embeds, keys, missing
 
+
+@torch.no_grad()
+def stream_embeddings(
+    dataloader: DataLoader,
+    encoder: Encoder,
+    pooler: Pooler,
+    normalize: bool = False,
+    cache: EmbeddingCache | None = None,
+) -> EmbedderResult:
+    """Compute pooled hidden embeddings of a streaming dataset.
+
+    The number of items is not known up front, so the embeddings are
+    gathered per batch. The batches of the data workers are interleaved,
+    so the items are put back in file order at the end.
+
+    Parameters
+    ----------
+    dataloader : DataLoader
+        The dataloader of a `StreamingDataset`.
+    encoder : Encoder
+        The encoder to use for inference.
+    pooler : Pooler
+        The pooler to use for pooling the embeddings.
+    normalize : bool, optional
+        Whether to normalize the embeddings, by default False.
+    cache : EmbeddingCache, optional
+        A store of previously computed embeddings, by default None. Only
+        the items missing from the store are encoded (and then stored).
+
+    Returns
+    -------
+    EmbedderResult
+        Dataclass with the embeddings, text, and optional metadata.
+    """
+    embeddings, positions, text, metadata = [], [], [], []
+    new_keys, new_embeddings = [], []
+
+    batch: StreamingBatch
     for batch in tqdm(dataloader):
-        # Move the batch to the model device
-        inputs = batch.to(encoder.device)
+        # Compute the pooled embeddings of the items missing from the cache
+        pooled_embeds, keys, missing = _embed_cached_batch(
+            batch.encoding,
+            batch.text,
+            encoder,
+            pooler,
+            normalize,
+            cache,
+        )
+        if keys is not None and missing.any():
+            encoded = pooled_embeds[torch.from_numpy(missing)]
+            new_keys.append(keys[missing])
+            new_embeddings.append(encoded.numpy())
 
-        # Get the model outputs with a forward pass
-        embeddings = encoder.encode(inputs)
+        # Collect the embeddings with the items they belong to
+        embeddings.append(pooled_embeds)
+        positions.extend(batch.positions)
+        text.extend(batch.text)
+        metadata.extend(batch.metadata)
 
-        # Compute the pooled embeddings
-        pooled_embeds = pooler.pool(embeddings, inputs.attention_mask)
+    # Store the newly computed embeddings
+    if cache is not None and new_keys:
+        cache.put(np.concatenate(new_keys), np.concatenate(new_embeddings))
+
+    # Gather the embeddings in host memory
+    all_embeddings = torch.cat(
+        [torch.empty((0, encoder.embedding_size)), *embeddings],
+    ).to(encoder.dtype)
 
-        # Normalize the embeddings
-        if normalize:
-            pooled_embeds = F.normalize(pooled_embeds, p=2, dim=-1)
+    # Restore the file order of the items
+    order = sorted(range(len(positions)), key=positions.__getitem__)
 
-        # Get the batch size
-        batch_size = inputs.attention_mask.shape[0]
+    return EmbedderResult(
+        embeddings=all_embeddings.numpy()[order],
+        text=[text[i] for i in order],
+        metadata=None
+        if all(m is None for m in metadata)
+        else [metadata[i] for i in order],
+    )
 
-        # Store the pooled embeddings in the output buffer
-        all_embeddings[idx : idx + batch_size, :] = pooled_embeds.cpu()
 
-        # Increment the output buffer index by the batch size
-        idx += batch_size
+@torch.no_grad()
+def iter_embeddings(
+    dataloader: DataLoader,
+    encoder: Encoder,
+    pooler: Pooler,
+    normalize: bool = False,
+    cache: EmbeddingCache | None = None,
+) -> Iterator[EmbedderResult]:
+    """Compute pooled hidden embeddings batch by batch.
 
-    return all_embeddings.numpy()
+    Unlike `compute_embeddings` and `stream_embeddings`, the embeddings
+    of the whole file are never held in host memory: each batch is
+    yielded with its text and metadata as it comes off the encoder, so
+    that it can be written out incrementally. The batches come in the
+    order of the dataloader, i.e., the file order unless length
+    bucketing or the streaming data workers reorder them.
+
+    Parameters
+    ----------
+    dataloader : DataLoader
+        The dataloader to use for batching the data (in-memory or
+        streaming dataset).
+    encoder : Encoder
+        The encoder to use for inference.
+    pooler : Pooler
+        The pooler to use for pooling the embeddings.
+    normalize : bool, optional
+        Whether to normalize the embeddings, by default False.
+    cache : EmbeddingCache, optional
+        A store of previously computed embeddings, by default None. Only
+        the items missing from the store are encoded (and then stored).
+
+    Yields
+    ------
+    EmbedderResult
+        The embeddings, text, and optional metadata of each batch.
+    """
+    dataset = dataloader.dataset
+    new_keys, new_embeddings = [], []
+
+    # The batch sampler yields the dataset indices of each in-memory batch
+    for batch, indices in zip(tqdm(dataloader), dataloader.batch_sampler):
+        # Get the text and metadata of the batch
+        if isinstance(batch, StreamingBatch):
+            encoding, text, metadata = batch.encoding, batch.text, None
+            if any(m is not None for m in batch.metadata):
+                metadata = batch.metadata
+        else:
+            encoding, metadata = batch, None
+            text = [dataset.data[i] for i in indices]
+            if dataset.metadata is not None:
+                metadata = [dataset.metadata[i] for i in indices]
+
+        # Compute the pooled embeddings of the items missing from the cache
+        pooled_embeds, keys, missing = _embed_cached_batch(
+            encoding,
+            text,
+            encoder,
+            pooler,
+            normalize,
+            cache,
+        )
+
+        # Store the newly computed embeddings in shards of bounded size
+        if keys is not None and missing.any():
+            encoded = pooled_embeds[torch.from_numpy(missing)]
+            new_keys.append(keys[missing])
+            new_embeddings.append(encoded.numpy())
+            if sum(map(len, new_keys)) >= CACHE_SHARD_SIZE:
+                cache.put(
+                    np.concatenate(new_keys),
+                    np.concatenate(new_embeddings),
+                )
+                new_keys, new_embeddings = [], []
+
+        yield EmbedderResult(
+            embeddings=pooled_embeds.numpy(),
+            text=text,
+            metadata=metadata,
+        )
+
+    # Store the remaining newly computed embeddings
+    if cache is not None and new_keys:
+        cache.put(np.concatenate(new_keys), np.concatenate(new_embeddings))
 
 
 class FullSequenceEmbedderConfig(BaseConfig):
@@ -88,6 +336,12 @@ class FullSequenceEmbedderConfig(BaseConfig):
         False,
         description='Whether to return normalized the embeddings.',
     )
+    output_dtype: Optional[OutputDtype] = Field(  # noqa: UP007
+        None,
+        description='The storage precision of the embeddings [float32, '
+        'float16, bfloat16 (stored as uint16)], by default the precision '
+        'of the encoder.',
+    )
 
 
 class FullSequenceEmbedder:
@@ -102,6 +356,7 @@ class FullSequenceEmbedder:
         dataloader: DataLoader,
         encoder: Encoder,
         pooler: Pooler,
+        cache: EmbeddingCache | None = None,
     ) -> EmbedderResult:
         """Embed the sequences.
 
@@ -113,22 +368,80 @@ class FullSequenceEmbedder:
             The encoder to use for inference.
         pooler : Pooler
             The pooler to use for pooling the embeddings.
+        cache : EmbeddingCache, optional
+            A store of previously computed embeddings, by default None.
 
         Returns
         -------
         EmbedderResult
             Dataclass with the embeddings, text, and optional metadata.
         """
-        embeddings = compute_embeddings(
+        # Streaming datasets carry their text and metadata in the batches
+        if isinstance(dataloader.dataset, IterableDataset):
+            result = stream_embeddings(
+                dataloader=dataloader,
+                encoder=encoder,
+                pooler=pooler,
+                normalize=self.config.normalize_embeddings,
+                cache=cache,
+            )
+        else:
+            embeddings = compute_embeddings(
+                dataloader=dataloader,
+                encoder=encoder,
+                pooler=pooler,
+                normalize=self.config.normalize_embeddings,
+                cache=cache,
+            )
+            result = EmbedderResult(
+                embeddings=embeddings,
+                text=dataloader.dataset.data,
+                metadata=dataloader.dataset.metadata,
+            )
+
+        # Store the embeddings in the configured precision
+        result.embeddings = cast_embeddings(
+            result.embeddings,
+            self.config.output_dtype,
+        )
+
+        return result
+
+    def embed_batches(
+        self,
+        dataloader: DataLoader,
+        encoder: Encoder,
+        pooler: Pooler,
+        cache: EmbeddingCache | None = None,
+    ) -> Iterator[EmbedderResult]:
+        """Embed the sequences, yielding the result batch by batch.
+
+        Parameters
+        ----------
+        dataloader : DataLoader
+            The dataloader to use for batching the data.
+        encoder : Encoder
+            The encoder to use for inference.
+        pooler : Pooler
+            The pooler to use for pooling the embeddings.
+        cache : EmbeddingCache, optional
+            A store of previously computed embeddings, by default None.
+
+        Yields
+        ------
+        EmbedderResult
+            The embeddings, text, and optional metadata of each batch.
+        """
+        for result in iter_embeddings(
             dataloader=dataloader,
             encoder=encoder,
             pooler=pooler,
             normalize=self.config.normalize_embeddings,
-        )
-
-        # Return the result
-        return EmbedderResult(
-            embeddings=embeddings,
-            text=dataloader.dataset.data,
-            metadata=dataloader.dataset.metadata,
-        )
+            cache=cache,
+        ):
+            # Store the embeddings in the configured precision
+            result.embeddings = cast_embeddings(
+                result.embeddings,
+                self.config.output_dtype,
+            )
+            yield result
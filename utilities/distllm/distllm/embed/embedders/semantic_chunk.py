@@ -6,18 +6,29 @@ https://github.com/run-llama/llama_index/blob/main/llama-index-core/llama_index/
 
 from __future__ import annotations
 
+from typing import Any
+from typing import Iterator
 from typing import Literal
+from typing import Optional
 
 import numpy as np
 from pydantic import Field
 from torch.utils.data import DataLoader
+from torch.utils.data import IterableDataset
 
+from distllm.embed.cache import EmbeddingCache
+from distllm.embed.datasets.utils import batching_kwargs
 from distllm.embed.datasets.utils import DataCollator
 from distllm.embed.datasets.utils import InMemoryDataset
+from distllm.embed.datasets.utils import LengthBucketBatchSampler
 from distllm.embed.embedders.base import EmbedderResult
 from distllm.embed.embedders.full_sequence import compute_embeddings
+from distllm.embed.embedders.full_sequence import iter_embeddings
+from distllm.embed.embedders.full_sequence import stream_embeddings
 from distllm.embed.encoders.base import Encoder
 from distllm.embed.poolers.base import Pooler
+from distllm.embed.precision import cast_embeddings
+from distllm.embed.precision import OutputDtype
 from distllm.utils import BaseConfig
 
 
@@ -40,19 +51,13 @@ def calculate_distances_between_buffer(
     # to avoid overflow errors when computing the dot product and norm
     embeddings = buffer_embeds.astype(np.float32)
 
-    # Compute the embedding distances using a sliding window
-    distances = np.zeros(len(embeddings) - 1)
-    for i in range(len(embeddings) - 1):
-        embedding_current = embeddings[i]
-        embedding_next = embeddings[i + 1]
+    # Compute the cosine distances between each buffer and the next one
+    # with a row-wise dot product of the normalized embeddings
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / norms
+    similarity = np.einsum('ij,ij->i', embeddings[:-1], embeddings[1:])
 
-        similarity = np.dot(embedding_current, embedding_next) / (
-            np.linalg.norm(embedding_current) * np.linalg.norm(embedding_next)
-        )
-
-        distances[i] = 1 - similarity
-
-    return distances
+    return (1 - similarity).astype(np.float64)
 
 
 def build_chunks(
@@ -85,30 +90,83 @@ def build_chunks(
         breakpoint_percentile_threshold,
     )
 
-    indices_above_threshold = [
-        i for i, x in enumerate(distances) if x > breakpoint_distance_threshold
-    ]
-
     # Chunk sentences into semantic groups based on percentile breakpoints
-    start_index = 0
-    index_groups = []
-    for index in indices_above_threshold:
-        index_groups.append((start_index, index + 1))
-        start_index = index + 1
+    breakpoints = np.flatnonzero(distances > breakpoint_distance_threshold) + 1
+    starts = [0, *breakpoints.tolist()]
+    ends = [*breakpoints.tolist(), len(distances) + 1]
+
+    return list(zip(starts, ends))
+
+
+def pool_buffer_embeddings(
+    buffer_embeds: np.ndarray,
+    spans: list[tuple[int, int]],
+    weights: np.ndarray | None = None,
+) -> np.ndarray:
+    """Pool the buffer embeddings over the span of each chunk.
+
+    The buffer embeddings are normalized before they are averaged, so
+    that each buffer contributes by its direction (or by its weight).
+
+    Parameters
+    ----------
+    buffer_embeds : np.ndarray
+        The buffer embeddings (shape: [num_buffers, embedding_size]).
+    spans : list[tuple[int, int]]
+        The [start, end) buffer indices of each chunk.
+    weights : np.ndarray, optional
+        The weight of each buffer (e.g., its sentence length),
+        by default None, in which case the buffers are averaged.
+
+    Returns
+    -------
+    np.ndarray
+        The chunk embeddings (shape: [num_chunks, embedding_size]).
+    """
+    # Normalize the buffer embeddings in float32 to avoid overflow errors
+    embeddings = buffer_embeds.astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    pooled = np.empty((len(spans), embeddings.shape[1]), dtype=np.float32)
+    for i, (start, end) in enumerate(spans):
+        pooled[i] = np.average(
+            embeddings[start:end],
+            axis=0,
+            weights=None if weights is None else weights[start:end],
+        )
+
+    return pooled.astype(buffer_embeds.dtype)
 
-    # Add the last group
-    index_groups.append((start_index, len(distances) + 1))
 
-    return index_groups
+def _pool_chunk_embeddings(
+    chunk_pooling: Literal['mean', 'length_weighted_mean'] | None,
+    buffer_embeds: np.ndarray,
+    spans: list[tuple[int, int]],
+    buffer_metadata: list[dict[str, Any]],
+) -> np.ndarray | None:
+    """Pool the chunk embeddings from the buffer embeddings, if requested.
+
+    With 'length_weighted_mean' the buffers are weighted by the length of
+    their sentence, returns None if `chunk_pooling` is None.
+    """
+    if chunk_pooling is None:
+        return None
 
+    weights = None
+    if chunk_pooling == 'length_weighted_mean':
+        weights = np.array([len(m['sentence']) for m in buffer_metadata])
+    return pool_buffer_embeddings(buffer_embeds, spans, weights)
 
-def compute_semantic_chunks(
+
+def compute_semantic_chunks(  # noqa: PLR0913
     dataloader: DataLoader,
     encoder: Encoder,
     pooler: Pooler,
     breakpoint_percentile_threshold: int,
     min_chunk_length: int,
-) -> InMemoryDataset:
+    chunk_pooling: Literal['mean', 'length_weighted_mean'] | None = None,
+    cache: EmbeddingCache | None = None,
+) -> tuple[InMemoryDataset, np.ndarray | None]:
     """Compute semantic chunked embeddings.
 
     Parameters
@@ -126,11 +184,20 @@ def compute_semantic_chunks(
     min_chunk_length : int
         The minimum length of a chunk (number of characters) to
         filter out any small chunks.
+    chunk_pooling : str, optional
+        How to derive the chunk embeddings from the buffer embeddings
+        [mean, length_weighted_mean], by default None, in which case the
+        chunks are left to be encoded.
+    cache : EmbeddingCache, optional
+        A store of previously computed buffer embeddings, by default None.
 
     Returns
     -------
     InMemoryDataset
         The dataset with the semantically-chunked text and metadata.
+    np.ndarray | None
+        The chunk embeddings pooled from the buffer embeddings, if
+        `chunk_pooling` is set.
 
     Raises
     ------
@@ -139,26 +206,42 @@ def compute_semantic_chunks(
     ValueError
         If the metadata does not have a path.
     """
-    if dataloader.dataset.metadata is None:
+    # Streaming datasets only know their metadata once they are embedded
+    streaming = isinstance(dataloader.dataset, IterableDataset)
+    if streaming:
+        buffers = stream_embeddings(dataloader, encoder, pooler, cache=cache)
+        all_metadata = buffers.metadata
+    else:
+        all_metadata = dataloader.dataset.metadata
+
+    if all_metadata is None:
         raise ValueError('Metadata is required for semantic chunking.')
 
-    if dataloader.dataset.metadata[0].get('path') is None:
+    if all_metadata[0].get('path') is None:
         raise ValueError('Metadata path is required for semantic chunking.')
 
     # Group the data such that we only compute distances between
     # buffers within the same document.
     document_indices = []
     current_idx = 0
-    current_doc = dataloader.dataset.metadata[0]['path']
-    for i, metadata in enumerate(dataloader.dataset.metadata):
+    current_doc = all_metadata[0]['path']
+    for i, metadata in enumerate(all_metadata):
         if metadata['path'] != current_doc:
             document_indices.append((current_idx, i))
             current_idx = i
             current_doc = metadata['path']
-    document_indices.append((current_idx, len(dataloader.dataset)))
+    document_indices.append((current_idx, len(all_metadata)))
 
     # Compute embeddings for each buffer (num_examples, embedding_size)
-    buffer_embeds = compute_embeddings(dataloader, encoder, pooler)
+    if streaming:
+        buffer_embeds = buffers.embeddings
+    else:
+        buffer_embeds = compute_embeddings(
+            dataloader,
+            encoder,
+            pooler,
+            cache=cache,
+        )
 
     dataset_indices = []
     for doc_start, doc_end in document_indices:
@@ -184,14 +267,12 @@ def compute_semantic_chunks(
     # Group the data by the index groups
     data = []
     for start, end in dataset_indices:
-        group = dataloader.dataset.metadata[start:end]
+        group = all_metadata[start:end]
         chunk = ''.join(g['sentence'] for g in group)
         data.append(chunk)
 
     # Get the metadata for the chunks
-    metadata = [
-        dataloader.dataset.metadata[start] for start, _ in dataset_indices
-    ]
+    metadata = [all_metadata[start] for start, _ in dataset_indices]
 
     # Apply a length filter to remove small chunks
     filter_indices = [
@@ -200,11 +281,19 @@ def compute_semantic_chunks(
     data = [data[i] for i in filter_indices]
     metadata = [metadata[i] for i in filter_indices]
 
+    # Pool the buffer embeddings over the span of each chunk
+    chunk_embeds = _pool_chunk_embeddings(
+        chunk_pooling,
+        buffer_embeds,
+        [dataset_indices[i] for i in filter_indices],
+        all_metadata,
+    )
+
     # Drop the splits from the metadata
     for meta in metadata:
         meta.pop('sentence')
 
-    return InMemoryDataset(data, metadata)
+    return InMemoryDataset(data, metadata), chunk_embeds
 
 
 class SemanticChunkEmbedderConfig(BaseConfig):
@@ -230,6 +319,23 @@ class SemanticChunkEmbedderConfig(BaseConfig):
         False,
         description='Whether to return normalized the embeddings.',
     )
+    chunk_embedding: Literal[
+        'encode',
+        'mean',
+        'length_weighted_mean',
+    ] = Field(
+        'encode',
+        description='How to embed the chunks: encode re-encodes each chunk '
+        'with the model (exact), mean and length_weighted_mean pool the '
+        'normalized buffer embeddings over the span of each chunk (weighted '
+        'by sentence length), which skips the second encoder pass.',
+    )
+    output_dtype: Optional[OutputDtype] = Field(  # noqa: UP007
+        None,
+        description='The storage precision of the embeddings [float32, '
+        'float16, bfloat16 (stored as uint16)], by default the precision '
+        'of the encoder.',
+    )
 
 
 class SemanticChunkEmbedder:
@@ -239,11 +345,71 @@ class SemanticChunkEmbedder:
         """Initialize the embedder with the configuration."""
         self.config = config
 
+    def _chunk_dataloader(
+        self,
+        dataloader: DataLoader,
+        dataset: InMemoryDataset,
+        encoder: Encoder,
+    ) -> DataLoader:
+        """Make a dataloader for the chunks, batched like the buffers."""
+        # Batch the chunks like the buffers, i.e., by length or by token
+        # budget if the buffers were
+        sampler = dataloader.batch_sampler
+        bucketed = isinstance(sampler, LengthBucketBatchSampler)
+
+        return DataLoader(
+            pin_memory=dataloader.pin_memory,
+            num_workers=dataloader.num_workers,
+            dataset=dataset,
+            collate_fn=DataCollator(encoder.tokenizer),
+            **batching_kwargs(
+                dataset.data,
+                encoder.tokenizer,
+                self.config.chunk_batch_size,
+                length_bucketing=bucketed,
+                max_tokens_per_batch=sampler.max_tokens if bucketed else None,
+            ),
+        )
+
+    def _semantic_chunks(
+        self,
+        dataloader: DataLoader,
+        encoder: Encoder,
+        pooler: Pooler,
+        cache: EmbeddingCache | None,
+    ) -> tuple[InMemoryDataset, np.ndarray | None]:
+        """Compute the chunks, and their embeddings if they are pooled."""
+        # Pool the chunk embeddings from the buffers unless they are encoded
+        chunk_pooling = self.config.chunk_embedding
+        dataset, chunked_embeds = compute_semantic_chunks(
+            dataloader=dataloader,
+            encoder=encoder,
+            pooler=pooler,
+            breakpoint_percentile_threshold=self.config.breakpoint_percentile_threshold,
+            min_chunk_length=self.config.min_chunk_length,
+            chunk_pooling=None if chunk_pooling == 'encode' else chunk_pooling,
+            cache=cache,
+        )
+
+        # Normalize the pooled embeddings
+        if chunked_embeds is not None and self.config.normalize_embeddings:
+            norms = np.linalg.norm(
+                chunked_embeds.astype(np.float32),
+                axis=1,
+                keepdims=True,
+            )
+            chunked_embeds = (chunked_embeds / norms).astype(
+                chunked_embeds.dtype,
+            )
+
+        return dataset, chunked_embeds
+
     def embed(
         self,
         dataloader: DataLoader,
         encoder: Encoder,
         pooler: Pooler,
+        cache: EmbeddingCache | None = None,
     ) -> EmbedderResult:
         """Embed the sequences.
 
@@ -255,40 +421,111 @@ class SemanticChunkEmbedder:
             The encoder to use for inference.
         pooler : Pooler
             The pooler to use for pooling the embeddings.
+        cache : EmbeddingCache, optional
+            A store of previously computed embeddings (of the buffers and
+            the encoded chunks), by default None.
 
         Returns
         -------
         EmbedderResult
             Dataclass with the embeddings, text, and optional metadata.
         """
-        dataset = compute_semantic_chunks(
-            dataloader=dataloader,
-            encoder=encoder,
-            pooler=pooler,
-            breakpoint_percentile_threshold=self.config.breakpoint_percentile_threshold,
-            min_chunk_length=self.config.min_chunk_length,
+        # Chunk the sequences, pooling the chunk embeddings if configured
+        dataset, chunked_embeds = self._semantic_chunks(
+            dataloader,
+            encoder,
+            pooler,
+            cache,
         )
 
-        # Make a new dataloader with the chunked data
-        chunked_dataloader = DataLoader(
-            pin_memory=dataloader.pin_memory,
-            batch_size=self.config.chunk_batch_size,
-            num_workers=dataloader.num_workers,
-            dataset=dataset,
-            collate_fn=DataCollator(encoder.tokenizer),
+        if chunked_embeds is None:
+            # Make a new dataloader with the chunked data
+            chunked_dataloader = self._chunk_dataloader(
+                dataloader,
+                dataset,
+                encoder,
+            )
+
+            # Compute embeddings for each chunk
+            chunked_embeds = compute_embeddings(
+                dataloader=chunked_dataloader,
+                encoder=encoder,
+                pooler=pooler,
+                normalize=self.config.normalize_embeddings,
+                cache=cache,
+            )
+
+        # Return the result, in the configured precision
+        return EmbedderResult(
+            embeddings=cast_embeddings(
+                chunked_embeds,
+                self.config.output_dtype,
+            ),
+            text=dataset.data,
+            metadata=dataset.metadata,
+        )
+
+    def embed_batches(
+        self,
+        dataloader: DataLoader,
+        encoder: Encoder,
+        pooler: Pooler,
+        cache: EmbeddingCache | None = None,
+    ) -> Iterator[EmbedderResult]:
+        """Embed the sequences, yielding the result batch by batch.
+
+        The chunks are only known once all the buffers are embedded, so
+        the buffer embeddings are held in memory, but the chunks are
+        yielded batch by batch as they are encoded. The pooled chunk
+        embeddings are yielded at once.
+
+        Parameters
+        ----------
+        dataloader : DataLoader
+            The dataloader to use for batching the data.
+        encoder : Encoder
+            The encoder to use for inference.
+        pooler : Pooler
+            The pooler to use for pooling the embeddings.
+        cache : EmbeddingCache, optional
+            A store of previously computed embeddings (of the buffers and
+            the encoded chunks), by default None.
+
+        Yields
+        ------
+        EmbedderResult
+            The embeddings, text, and optional metadata of each batch.
+        """
+        # Chunk the sequences, pooling the chunk embeddings if configured
+        dataset, chunked_embeds = self._semantic_chunks(
+            dataloader,
+            encoder,
+            pooler,
+            cache,
         )
 
-        # Compute embeddings for each chunk
-        chunked_embeds = compute_embeddings(
-            dataloader=chunked_dataloader,
+        if chunked_embeds is not None:
+            yield EmbedderResult(
+                embeddings=cast_embeddings(
+                    chunked_embeds,
+                    self.config.output_dtype,
+                ),
+                text=dataset.data,
+                metadata=dataset.metadata,
+            )
+            return
+
+        # Encode the chunks batch by batch
+        for result in iter_embeddings(
+            dataloader=self._chunk_dataloader(dataloader, dataset, encoder),
             encoder=encoder,
             pooler=pooler,
             normalize=self.config.normalize_embeddings,
-        )
-
-        # Return the result
-        return EmbedderResult(
-            embeddings=chunked_embeds,
-            text=dataset.data,
-            metadata=dataset.metadata,
-        )
+            cache=cache,
+        ):
+            # Store the embeddings in the configured precision
+            result.embeddings = cast_embeddings(
+                result.embeddings,
+                self.config.output_dtype,
+            )
+            yield result
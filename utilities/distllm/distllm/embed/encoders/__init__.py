@@ -8,6 +8,8 @@ from typing import Union
 from distllm.embed.encoders.auto import AutoEncoder
 from distllm.embed.encoders.auto import AutoEncoderConfig
 from distllm.embed.encoders.base import Encoder
+from distllm.embed.encoders.cpu import CpuEncoder
+from distllm.embed.encoders.cpu import CpuEncoderConfig
 from distllm.embed.encoders.esm2 import Esm2Encoder
 from distllm.embed.encoders.esm2 import Esm2EncoderConfig
 from distllm.embed.encoders.esmc import EsmCambrianEncoder
@@ -19,12 +21,14 @@ EncoderConfigs = Union[
     Esm2EncoderConfig,
     EsmCambrianEncoderConfig,
     AutoEncoderConfig,
+    CpuEncoderConfig,
 ]
 
 STRATEGIES: dict[str, tuple[type[BaseConfig], type[Encoder]]] = {
     'esm2': (Esm2EncoderConfig, Esm2Encoder),
     'esmc': (EsmCambrianEncoderConfig, EsmCambrianEncoder),
     'auto': (AutoEncoderConfig, AutoEncoder),
+    'cpu': (CpuEncoderConfig, CpuEncoder),
 }
 
 
@@ -56,6 +60,7 @@ def get_encoder(
     - esm2
     - esmc
     - auto
+    - cpu
 
     Parameters
     ----------
@@ -0,0 +1,117 @@
+"""Encoder for the auto model on CPU, with dynamic int8 quantization."""
+
+from __future__ import annotations
+
+from typing import Literal
+from typing import Optional
+
+import torch
+from transformers import BatchEncoding
+from transformers import PreTrainedTokenizer
+
+from distllm.utils import BaseConfig
+
+
+class CpuEncoderConfig(BaseConfig):
+    """Config for the transformers AutoModel encoder on CPU."""
+
+    # The name of the encoder
+    name: Literal['cpu'] = 'cpu'  # type: ignore[assignment]
+    # The model id
+    pretrained_model_name_or_path: str
+    # Optional tokenizer
+    tokenizer_name: Optional[str] = None  # noqa: UP007
+    # Quantize the weights of the linear layers to int8 ahead of time (the
+    # activations are quantized on the fly), otherwise run in fp32
+    quantization: bool = True
+
+
+class CpuEncoder:
+    """Encoder for the transformers AutoModel on CPU.
+
+    The `auto` encoder quantizes with bitsandbytes, which needs a GPU, so
+    on CPU-only nodes it runs the model in fp32. This encoder instead uses
+    torch dynamic quantization: the weights of the linear layers, which
+    dominate the compute of transformer encoders, are stored in int8 and
+    the matrix products run with int8 kernels (fbgemm/onednn), while the
+    embeddings and the outputs stay in fp32.
+    """
+
+    def __init__(self, config: CpuEncoderConfig):
+        """Initialize the encoder."""
+        from transformers import AutoModel
+        from transformers import AutoTokenizer
+
+        # Load model and tokenizer
+        model = AutoModel.from_pretrained(
+            config.pretrained_model_name_or_path,
+            trust_remote_code=True,
+            torch_dtype=torch.float32,
+        )
+
+        tokenizer_path = (
+            config.tokenizer_name or config.pretrained_model_name_or_path
+        )
+        tokenizer = AutoTokenizer.from_pretrained(
+            tokenizer_path,
+            trust_remote_code=True,
+        )
+
+        # Set the model max length for proper truncation
+        tokenizer.model_max_length = model.config.max_position_embeddings
+
+        # Set the model to evaluation mode (quantization requires it)
+        model.eval()
+
+        # Quantize the linear layers to int8
+        if config.quantization:
+            model = torch.ao.quantization.quantize_dynamic(
+                model,
+                {torch.nn.Linear},
+                dtype=torch.qint8,
+            )
+
+        # Set persistent attributes
+        self.model = model
+        self._tokenizer = tokenizer
+
+    @property
+    def dtype(self) -> torch.dtype:
+        """Get the data type of the encoder."""
+        return torch.float32
+
+    @property
+    def device(self) -> torch.device:
+        """Get the device of the encoder."""
+        return torch.device('cpu')
+
+    @property
+    def embedding_size(self) -> int:
+        """Get the embedding size of the encoder."""
+        return self.model.config.hidden_size
+
+    @property
+    def tokenizer(self) -> PreTrainedTokenizer:
+        """Get the tokenizer of the encoder."""
+        return self._tokenizer
+
+    def encode(self, batch_encoding: BatchEncoding) -> torch.Tensor:
+        """Encode the sequence.
+
+        Parameters
+        ----------
+        batch_encoding : BatchEncoding
+            The batch encoding of the sequence (containing the input_ids,
+            attention_mask, and token_type_ids).
+
+        Returns
+        -------
+        torch.Tensor
+            The embeddings of the sequence extracted from the last hidden state
+            (shape: [num_sequences, sequence_length, embedding_size])
+        """
+        # Get the model outputs with a forward pass
+        outputs = self.model(**batch_encoding, output_hidden_states=True)
+
+        # Get the last hidden states
+        return outputs.hidden_states[-1]
@@ -16,6 +16,11 @@ def average_pool(
 ) -> torch.Tensor:
     """Average pool the hidden states using the attention mask.
 
+    The pooling weights are a (B, SeqLen) copy of the attention mask, so
+    the mask of the caller is left unchanged, and the weighted sum over
+    the sequence is a batched matrix product, so no mask or product the
+    size of the hidden states is materialized.
+
     Parameters
     ----------
     embeddings : torch.Tensor
@@ -31,19 +36,21 @@ def average_pool(
     # Get the sequence lengths
     seq_lengths = attention_mask.sum(axis=1)
 
-    # Set the attention mask to 0 for start and end tokens
-    attention_mask[:, 0] = 0
-    attention_mask[:, seq_lengths - 1] = 0
-
-    # Create a mask for the pooling operation (B, SeqLen, HiddenDim)
-    pool_mask = attention_mask.unsqueeze(-1).expand(embeddings.shape)
+    # Set the weights to 0 for the pad, start and end tokens (the end
+    # token of each sequence is at its own position in its row)
+    weights = attention_mask.to(embeddings.dtype, copy=True)
+    weights[:, 0] = 0
+    weights[torch.arange(len(weights)), seq_lengths - 1] = 0
 
-    # Sum the embeddings over the sequence length (use the mask to avoid
-    # pad, start, and stop tokens)
-    sum_embeds = torch.sum(embeddings * pool_mask, 1)
+    # Sum the weighted embeddings over the sequence length
+    # (B, 1, SeqLen) @ (B, SeqLen, HiddenDim) -> (B, HiddenDim)
+    sum_embeds = torch.bmm(weights.unsqueeze(1), embeddings).squeeze(1)
 
     # Avoid division by zero for zero length sequences by clamping
-    sum_mask = torch.clamp(pool_mask.sum(1), min=1e-9)
+    sum_mask = torch.clamp(
+        weights.sum(dim=1, keepdim=True, dtype=torch.float32),
+        min=1e-9,
+    )
 
     # Compute mean pooled embeddings for each sequence
     return sum_embeds / sum_mask
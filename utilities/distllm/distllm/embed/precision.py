@@ -0,0 +1,81 @@
+"""Reduced-precision storage of embeddings.
+
+Embeddings can be stored in float16 or bfloat16 to halve the size of the
+corpus on disk and in the page cache. Since numpy has no bfloat16 type,
+bfloat16 embeddings are stored as the uint16 bit patterns of the values
+(the upper half of the float32 bits), so any uint16 embeddings are read
+back as bfloat16. The loaders upcast the embeddings to float32 on the
+fly (e.g., when building or rescoring an index).
+"""
+
+from __future__ import annotations
+
+from typing import Literal
+
+import numpy as np
+
+# The storage precisions of the embeddings
+OutputDtype = Literal['float32', 'float16', 'bfloat16']
+
+# The numpy type used to store each precision
+STORAGE_DTYPES = {
+    'float32': np.dtype(np.float32),
+    'float16': np.dtype(np.float16),
+    'bfloat16': np.dtype(np.uint16),
+}
+
+
+def upcast_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Upcast stored embeddings to float32.
+
+    Parameters
+    ----------
+    embeddings : np.ndarray
+        The embeddings, with bfloat16 values stored as uint16 (or any
+        integer type, e.g., when the values are read back as Python ints).
+
+    Returns
+    -------
+    np.ndarray
+        The float32 embeddings (not a copy if they are already float32).
+    """
+    # Shift the bfloat16 bits to the upper half of the float32 bits
+    if np.issubdtype(embeddings.dtype, np.integer):
+        bits = embeddings.astype(np.uint32) << 16
+        return bits.view(np.float32)
+    return embeddings.astype(np.float32, copy=False)
+
+
+def cast_embeddings(
+    embeddings: np.ndarray,
+    output_dtype: OutputDtype | None,
+) -> np.ndarray:
+    """Cast embeddings to their storage precision.
+
+    Parameters
+    ----------
+    embeddings : np.ndarray
+        The embeddings (e.g., in the precision of the encoder).
+    output_dtype : OutputDtype, optional
+        The storage precision [float32, float16, bfloat16], if None the
+        embeddings are stored in the precision they are given in.
+
+    Returns
+    -------
+    np.ndarray
+        The embeddings in the storage precision, with bfloat16 values
+        stored as uint16.
+    """
+    if output_dtype is None:
+        return embeddings
+    if embeddings.dtype == STORAGE_DTYPES[output_dtype]:
+        return embeddings
+
+    embeddings = upcast_embeddings(embeddings)
+    if output_dtype != 'bfloat16':
+        return embeddings.astype(STORAGE_DTYPES[output_dtype])
+
+    # Round the float32 bits to the upper half (to nearest, ties to even)
+    bits = np.ascontiguousarray(embeddings).view(np.uint32).astype(np.uint64)
+    bits += 0x7FFF + ((bits >> 16) & 1)
+    return (bits >> 16).astype(np.uint16)
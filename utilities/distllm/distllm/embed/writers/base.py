@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 from pathlib import Path
+from typing import Iterable
 from typing import Protocol
 
 from distllm.embed.embedders.base import EmbedderResult
@@ -28,6 +29,22 @@ class Writer(Protocol):
         """
         ...
 
+    def write_batches(
+        self,
+        output_dir: Path,
+        results: Iterable[EmbedderResult],
+    ) -> None:
+        """Write the result to disk incrementally, batch by batch.
+
+        Parameters
+        ----------
+        output_dir : Path
+            The output directory to write the result to.
+        results : Iterable[EmbedderResult]
+            The batches of the result to write to disk.
+        """
+        ...
+
     def merge(self, dataset_dirs: list[Path], output_dir: Path) -> None:
         """Merge the datasets from multiple directories.
 
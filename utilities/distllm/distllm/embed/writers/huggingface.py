@@ -2,36 +2,95 @@
 
 from __future__ import annotations
 
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Iterable
 from typing import Iterator
 from typing import Literal
 from typing import Optional
 
 import numpy as np
+import pyarrow as pa
 from datasets import concatenate_datasets
 from datasets import Dataset
+from datasets import Features
+from datasets.arrow_writer import ArrowWriter
+from datasets.fingerprint import generate_random_fingerprint
 
+from distllm.dedup import deduplicate_dataset
 from distllm.embed.embedders.base import EmbedderResult
+from distllm.embed.precision import cast_embeddings
+from distllm.embed.precision import OutputDtype
 from distllm.utils import BaseConfig
 
 
-def _generate_dataset(
-    embeddings: np.ndarray,
-    text: list[str],
-    metadata: list[dict[str, Any]] | None,
-) -> Iterator[dict[str, str | np.ndarray | Any]]:
-    """Generate a dataset from the embeddings, text, and metadata."""
-    for idx, (text_, embedding) in enumerate(zip(text, embeddings)):
-        # Always include the text and the embeddings
-        item = {'text': text_, 'embeddings': embedding}
+def _result_table(
+    result: EmbedderResult,
+    output_dtype: OutputDtype | None = None,
+) -> pa.Table:
+    """Convert a result to an Arrow table.
 
-        # Add metadata if available
-        if metadata is not None:
-            for key, value in metadata[idx].items():
-                item[key] = value
+    The embeddings are cast to the storage precision (if given) and
+    wrapped as a `FixedSizeList` column over the buffer of the
+    (contiguous) embedding matrix, without copying it, and the metadata
+    is converted column by column.
+    """
+    embeddings = cast_embeddings(result.embeddings, output_dtype)
+    embeddings = np.ascontiguousarray(embeddings)
+    columns = {
+        'text': pa.array(result.text, type=pa.string()),
+        'embeddings': pa.FixedSizeListArray.from_arrays(
+            pa.array(embeddings.reshape(-1)),
+            embeddings.shape[1],
+        ),
+    }
 
-        yield item
+    # Add metadata if available
+    if result.metadata is not None:
+        metadata = pa.Table.from_pylist(result.metadata)
+        for key in metadata.column_names:
+            columns[key] = metadata[key]
+
+    return pa.table(columns)
+
+
+def _record_batches(
+    results: Iterable[EmbedderResult],
+    batch_size: int,
+    output_dtype: OutputDtype | None = None,
+) -> Iterator[pa.Table]:
+    """Gather the results into Arrow tables of about `batch_size` rows.
+
+    The metadata types are inferred per result, so the tables of the
+    results are concatenated with their types promoted (e.g., a field that
+    is null in one result and a string in another becomes a string).
+    """
+    tables: list[pa.Table] = []
+    num_rows = 0
+    for result in results:
+        tables.append(_result_table(result, output_dtype))
+        num_rows += len(result.text)
+        if num_rows >= batch_size:
+            yield pa.concat_tables(tables, promote_options='permissive')
+            tables, num_rows = [], 0
+    if tables:
+        yield pa.concat_tables(tables, promote_options='permissive')
+
+
+def _copy_datasets(
+    dataset_dirs: list[Path],
+    arrow_file: Path,
+    batch_size: int,
+) -> None:
+    """Copy the rows of the datasets to an Arrow file, batch by batch."""
+    with ArrowWriter(path=str(arrow_file)) as writer:
+        for dataset_dir in dataset_dirs:
+            dataset = Dataset.load_from_disk(dataset_dir).with_format('arrow')
+            for table in dataset.iter(batch_size=batch_size):
+                writer.write_table(table)
+        writer.finalize()
 
 
 class HuggingFaceWriterConfig(BaseConfig):
@@ -42,6 +101,20 @@ class HuggingFaceWriterConfig(BaseConfig):
     # The number of processes to use for writing the dataset
     num_proc: Optional[int] = None  # noqa: UP007
 
+    # Whether to remove near-duplicate texts when merging
+    dedup: bool = False
+
+    # The minimum estimated Jaccard similarity of near-duplicate texts
+    dedup_threshold: float = 0.8
+
+    # The number of rows gathered into each Arrow record batch when the
+    # embeddings are written incrementally or merged
+    write_batch_size: int = 4096
+
+    # The storage precision of the embeddings [float32, float16, bfloat16],
+    # bfloat16 is stored as uint16, by default the precision of the result
+    output_dtype: Optional[OutputDtype] = None  # noqa: UP007
+
 
 class HuggingFaceWriter:
     """Hugging face writer for saving embeddings to disk."""
@@ -58,23 +131,103 @@ class HuggingFaceWriter:
         result : EmbedderResult
             The result to write to disk.
         """
-        # TODO: Use Dataset.from_dict instead of Dataset.from_generator
-        # Create a dataset from the generator
-        dataset = Dataset.from_generator(
-            _generate_dataset,
-            gen_kwargs={
-                'embeddings': result.embeddings,
-                'text': result.text,
-                'metadata': result.metadata,
-            },
+        # Create a dataset from the columns of the result, with a random
+        # fingerprint since hashing the table would read all of it
+        dataset = Dataset(
+            _result_table(result, self.config.output_dtype),
+            fingerprint=generate_random_fingerprint(),
         )
 
         # Write the dataset to disk
         dataset.save_to_disk(output_dir)
 
+    def write_batches(
+        self,
+        output_dir: Path,
+        results: Iterable[EmbedderResult],
+    ) -> None:
+        """Write the embeddings to disk incrementally, batch by batch.
+
+        The batches are appended to an Arrow file as record batches of
+        `write_batch_size` rows, so that only one record batch is held
+        in memory, and the file is then saved as a dataset. A batch whose
+        types do not fit the file so far starts a new file, and the files
+        are cast to their common types when they are saved.
+
+        Parameters
+        ----------
+        output_dir : Path
+            The output directory to write the dataset to.
+        results : Iterable[EmbedderResult]
+            The batches of the result to write to disk.
+        """
+        # The Arrow files are written in a subdirectory since a dataset
+        # cannot be saved to the directory of its own files
+        tmp_dir = output_dir / 'tmp'
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        # Append the batches as record batches of bounded size, starting a
+        # new Arrow file when a batch does not fit the schema of the file
+        # (e.g., a metadata field that was null so far has values)
+        arrow_files: list[Path] = []
+        writer, schema = None, None
+        tables = _record_batches(
+            results,
+            self.config.write_batch_size,
+            self.config.output_dtype,
+        )
+        for table in tables:
+            if writer is not None:
+                unified = pa.unify_schemas(
+                    [schema, table.schema],
+                    promote_options='permissive',
+                )
+                if unified.equals(schema):
+                    writer.write_table(table.cast(schema))
+                    continue
+                writer.finalize()
+                writer.close()
+
+            arrow_files.append(tmp_dir / f'data-{len(arrow_files)}.arrow')
+            writer = ArrowWriter(path=str(arrow_files[-1]))
+            schema = table.schema
+            writer.write_table(table)
+
+        # Write an empty Arrow file if there are no batches
+        if writer is None:
+            arrow_files.append(tmp_dir / 'data-0.arrow')
+            writer = ArrowWriter(path=str(arrow_files[-1]))
+        writer.finalize()
+        writer.close()
+
+        # Save the memory-mapped Arrow files as one dataset, with the
+        # columns of the files cast to their common types
+        datasets = [Dataset.from_file(str(path)) for path in arrow_files]
+        if len(datasets) > 1:
+            features = Features.from_arrow_schema(
+                pa.unify_schemas(
+                    [dataset.data.schema for dataset in datasets],
+                    promote_options='permissive',
+                ),
+            )
+            datasets = [
+                dataset
+                if dataset.features == features
+                else dataset.cast(features)
+                for dataset in datasets
+            ]
+        dataset = concatenate_datasets(datasets)
+        dataset.save_to_disk(output_dir)
+        del dataset, datasets
+        shutil.rmtree(tmp_dir)
+
     def merge(self, dataset_dirs: list[Path], output_dir: Path) -> None:
         """Merge the datasets from multiple directories.
 
+        The rows are copied batch by batch from the memory-mapped datasets
+        to the files of the merged dataset, one file per process, so the
+        merge only holds one batch per process in memory.
+
         Parameters
         ----------
         dataset_dirs : list[Path]
@@ -82,11 +235,58 @@ class HuggingFaceWriter:
         output_dir : Path
             The output directory to write the merged dataset to.
         """
-        # Load all the datasets
-        all_datasets = [Dataset.load_from_disk(p) for p in dataset_dirs]
+        # Keep one representative of each cluster of near-duplicate texts,
+        # which needs the concatenation of all the (memory-mapped) datasets
+        if self.config.dedup:
+            dataset = concatenate_datasets(
+                [Dataset.load_from_disk(p) for p in dataset_dirs],
+            )
+            dataset = deduplicate_dataset(
+                dataset,
+                threshold=self.config.dedup_threshold,
+                num_proc=self.config.num_proc,
+            )
+            dataset.save_to_disk(output_dir, num_proc=self.config.num_proc)
+            return
 
-        # Concatenate the datasets
-        dataset = concatenate_datasets(all_datasets)
+        # Split the datasets into contiguous groups, each copied batch by
+        # batch to one file of the merged dataset (in parallel)
+        num_files = max(min(self.config.num_proc or 1, len(dataset_dirs)), 1)
+        bounds = np.linspace(0, len(dataset_dirs), num_files + 1).astype(int)
+        groups = [dataset_dirs[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        filenames = [
+            f'data-{i:05d}-of-{num_files:05d}.arrow' for i in range(num_files)
+        ]
+        arrow_files = [output_dir / filename for filename in filenames]
+        batch_sizes = [self.config.write_batch_size] * num_files
 
-        # Write the dataset to disk
-        dataset.save_to_disk(output_dir, num_proc=self.config.num_proc)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if num_files > 1:
+            with ProcessPoolExecutor(num_files) as pool:
+                copies = pool.map(
+                    _copy_datasets,
+                    groups,
+                    arrow_files,
+                    batch_sizes,
+                )
+                list(copies)
+        else:
+            _copy_datasets(groups[0], arrow_files[0], batch_sizes[0])
+
+        # Write the info and state files of `Dataset.save_to_disk` so that
+        # the merged dataset can be loaded with `Dataset.load_from_disk`
+        dataset = concatenate_datasets(
+            [Dataset.from_file(str(path)) for path in arrow_files],
+        )
+        dataset.info.write_to_directory(str(output_dir))
+        state = {
+            '_data_files': [{'filename': filename} for filename in filenames],
+            '_fingerprint': dataset._fingerprint,
+            '_format_columns': None,
+            '_format_kwargs': {},
+            '_format_type': None,
+            '_output_all_columns': False,
+            '_split': None,
+        }
+        with open(output_dir / 'state.json', 'w') as fp:
+            json.dump(state, fp, indent=2, sort_keys=True)
@@ -3,19 +3,77 @@
 from __future__ import annotations
 
 from pathlib import Path
+from typing import Any
+from typing import Iterable
 from typing import Literal
+from typing import Optional
 
 import numpy as np
 
 from distllm.embed.embedders.base import EmbedderResult
+from distllm.embed.precision import cast_embeddings
+from distllm.embed.precision import OutputDtype
 from distllm.utils import BaseConfig
 
+# The size reserved for the header of an incrementally written .npy file
+# (numpy pads the version 1.0 headers to a multiple of 64 bytes)
+NPY_HEADER_SIZE = 128
+
+
+def _merge_arrays(paths: list[Path], output_path: Path) -> None:
+    """Concatenate .npy files along the first axis, shard by shard.
+
+    The output file is preallocated with the final shape, then each
+    shard is memory-mapped and copied to its rows of the output, which
+    are mapped, flushed and unmapped one shard at a time so that the
+    merge only holds about one shard in memory.
+    """
+    # Read the shapes and types of the shards without loading them
+    arrays = [np.load(path, mmap_mode='r') for path in paths]
+    num_rows = sum(len(array) for array in arrays)
+    dtype = np.result_type(*arrays)
+    row_shape = arrays[0].shape[1:]
+    del arrays
+
+    # Preallocate the output file
+    merged = np.lib.format.open_memmap(
+        output_path,
+        mode='w+',
+        dtype=dtype,
+        shape=(num_rows, *row_shape),
+    )
+    header_size = merged.offset
+    del merged
+
+    # Copy each shard to its rows of the output
+    row_size = dtype.itemsize * int(np.prod(row_shape))
+    offset = header_size
+    for path in paths:
+        array = np.load(path, mmap_mode='r')
+        if len(array):
+            rows = np.memmap(
+                output_path,
+                dtype=dtype,
+                mode='r+',
+                offset=offset,
+                shape=array.shape,
+            )
+            rows[:] = array
+            rows.flush()
+            del rows
+        offset += len(array) * row_size
+        del array
+
 
 class NumpyWriterConfig(BaseConfig):
     """Configuration for the numpy writer."""
 
     name: Literal['numpy'] = 'numpy'  # type: ignore[assignment]
 
+    # The storage precision of the embeddings [float32, float16, bfloat16],
+    # bfloat16 is stored as uint16, by default the precision of the result
+    output_dtype: Optional[OutputDtype] = None  # noqa: UP007
+
 
 class NumpyWriter:
     """Numpy writer for saving embeddings to disk."""
@@ -32,7 +90,11 @@ class NumpyWriter:
         result : EmbedderResult
             The result to write to disk.
         """
-        np.save(output_dir / 'embeddings.npy', result.embeddings)
+        embeddings = cast_embeddings(
+            result.embeddings,
+            self.config.output_dtype,
+        )
+        np.save(output_dir / 'embeddings.npy', embeddings)
         np.save(output_dir / 'text.npy', result.text)
         if result.metadata is not None:
             np.save(
@@ -41,9 +103,77 @@ class NumpyWriter:
                 allow_pickle=True,
             )
 
+    def write_batches(
+        self,
+        output_dir: Path,
+        results: Iterable[EmbedderResult],
+    ) -> None:
+        """Write the embeddings to disk incrementally, batch by batch.
+
+        The embeddings are appended to the .npy file as they come and
+        the header, which holds the final shape, is written last. The
+        text and metadata are gathered and saved at the end.
+
+        Parameters
+        ----------
+        output_dir : Path
+            The output directory to write the result to.
+        results : Iterable[EmbedderResult]
+            The batches of the result to write to disk.
+        """
+        text: list[str] = []
+        metadata: list[dict[str, Any]] = []
+        has_metadata = False
+        num_rows, embedding_size, dtype = 0, 0, np.dtype(np.float32)
+
+        with open(output_dir / 'embeddings.npy', 'wb') as fp:
+            # Append the embeddings after the space reserved for the header
+            fp.seek(NPY_HEADER_SIZE)
+            for result in results:
+                embeddings = cast_embeddings(
+                    result.embeddings,
+                    self.config.output_dtype,
+                )
+                embeddings = np.ascontiguousarray(embeddings)
+                embedding_size, dtype = embeddings.shape[1], embeddings.dtype
+                fp.write(embeddings.tobytes())
+                num_rows += len(embeddings)
+                text.extend(result.text)
+                if result.metadata is not None:
+                    has_metadata = True
+                    metadata.extend(result.metadata)
+
+            # Write the header with the final shape of the embeddings
+            fp.seek(0)
+            np.lib.format.write_array_header_1_0(
+                fp,
+                {
+                    'descr': np.lib.format.dtype_to_descr(dtype),
+                    'fortran_order': False,
+                    'shape': (num_rows, embedding_size),
+                },
+            )
+            if fp.tell() != NPY_HEADER_SIZE:
+                raise ValueError(
+                    f'The .npy header takes {fp.tell()} bytes instead of '
+                    f'the {NPY_HEADER_SIZE} reserved bytes.',
+                )
+
+        np.save(output_dir / 'text.npy', text)
+        if has_metadata:
+            np.save(
+                output_dir / 'metadata.npy',
+                metadata,
+                allow_pickle=True,
+            )
+
     def merge(self, dataset_dirs: list[Path], output_dir: Path) -> None:
         """Merge the datasets from multiple directories.
 
+        The embeddings and text are copied shard by shard to preallocated
+        memory-mapped files, so the merge does not need to fit them in
+        memory.
+
         Parameters
         ----------
         dataset_dirs : list[Path]
@@ -51,18 +181,14 @@ class NumpyWriter:
         output_dir : Path
             The output directory to write the merged dataset to.
         """
-        # TODO: For now, we just concatenate the arrays. We should add a
-        # to handle larger datasets, we could use NpyAppendArray.
-
-        # Merge the embeddings
-        embeddings = [np.load(p / 'embeddings.npy') for p in dataset_dirs]
-        np.save(output_dir / 'embeddings.npy', np.concatenate(embeddings))
+        output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Merge the text
-        text = [np.load(p / 'text.npy') for p in dataset_dirs]
-        np.save(output_dir / 'text.npy', np.concatenate(text))
+        # Merge the embeddings and the text
+        for name in ('embeddings.npy', 'text.npy'):
+            _merge_arrays([p / name for p in dataset_dirs], output_dir / name)
 
-        # Merge the metadata
+        # Merge the metadata, which are pickled objects that cannot be
+        # memory-mapped (but are small compared to the embeddings)
         paths = [p / 'metadata.npy' for p in dataset_dirs]
         if all(p.exists() for p in paths):
             metadata = [np.load(p, allow_pickle=True) for p in paths]
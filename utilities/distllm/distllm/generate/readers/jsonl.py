@@ -2,11 +2,11 @@
 
 from __future__ import annotations
 
-import json
 from pathlib import Path
 from typing import Literal
 
 from distllm.utils import BaseConfig
+from distllm.utils import iter_jsonl
 
 
 class JsonlReaderConfig(BaseConfig):
@@ -39,15 +39,13 @@ class JsonlReader:
         tuple[list[str], list[str]]
             The text and paths from the dataset.
         """
-        # Read the jsonl file
-        lines = input_path.read_text().strip().split('\n')
-        # Parse the jsonl content into a list of dictionaries
-        content = [json.loads(line) for line in lines]
-
-        # Extract the text data
-        text = [item[self.config.text_field] for item in content]
-
-        # Extract the path data
-        paths = [item[self.config.path_field] for item in content]
+        # Parse the jsonl file lazily, keeping only the needed fields
+        text, paths = [], []
+        for item in iter_jsonl(input_path):
+            # Extract the text data
+            text.append(item[self.config.text_field])
+
+            # Extract the path data
+            paths.append(item[self.config.path_field])
 
         return text, paths
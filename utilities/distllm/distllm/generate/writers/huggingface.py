@@ -10,6 +10,7 @@ from datasets import concatenate_datasets
 from datasets import Dataset
 from tqdm import tqdm
 
+from distllm.dedup import deduplicate_dataset
 from distllm.utils import BaseConfig
 
 
@@ -21,6 +22,12 @@ class HuggingFaceWriterConfig(BaseConfig):
     # The number of processes to use for writing the dataset
     num_proc: Optional[int] = None  # noqa: UP007
 
+    # Whether to remove near-duplicate texts when merging
+    dedup: bool = False
+
+    # The minimum estimated Jaccard similarity of near-duplicate texts
+    dedup_threshold: float = 0.8
+
 
 class HuggingFaceWriter:
     """Hugging face writer for saving embeddings to disk."""
@@ -85,5 +92,13 @@ class HuggingFaceWriter:
         # Concatenate the datasets
         dataset = concatenate_datasets(all_datasets)
 
+        # Keep one representative of each cluster of near-duplicate texts
+        if self.config.dedup:
+            dataset = deduplicate_dataset(
+                dataset,
+                threshold=self.config.dedup_threshold,
+                num_proc=self.config.num_proc,
+            )
+
         # Write the dataset to disk
         dataset.save_to_disk(output_dir, num_proc=self.config.num_proc)
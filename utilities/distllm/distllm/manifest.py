@@ -0,0 +1,266 @@
+"""Run manifest to make distributed runs resumable."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+
+def file_checksum(path: Path, chunk_size: int = 1 << 20) -> str:
+    """Compute the sha256 checksum of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """Records which output shard each input file produced.
+
+    The manifest is a directory with one JSON record per input file,
+    written atomically by the worker that processes the file, so that
+    concurrent workers never contend on a shared file. A record is
+    `running` while the worker writes its output shard and `committed`
+    once the shard is complete, along with the sizes (and optionally the
+    checksums) of its files.
+    Reruns skip the inputs whose shard is committed (unless the input
+    changed), and merges only consume committed shards.
+    """
+
+    def __init__(self, manifest_dir: Path) -> None:
+        """Open the manifest.
+
+        Parameters
+        ----------
+        manifest_dir : Path
+            The directory of the manifest records.
+        """
+        self.manifest_dir = manifest_dir
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+
+    def _record_path(self, input_path: Path) -> Path:
+        """Get the path of the record of an input file."""
+        key = hashlib.sha256(str(input_path.resolve()).encode()).hexdigest()
+        return self.manifest_dir / f'{key[:32]}.json'
+
+    def _write(self, input_path: Path, record: dict[str, Any]) -> None:
+        """Atomically write the record of an input file."""
+        path = self._record_path(input_path)
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(record, indent=2))
+        os.replace(tmp_path, path)
+
+    def get(self, input_path: Path) -> dict[str, Any] | None:
+        """Get the record of an input file, if any.
+
+        Parameters
+        ----------
+        input_path : Path
+            The input file.
+
+        Returns
+        -------
+        dict[str, Any] | None
+            The record, or None if the input has not been processed.
+        """
+        path = self._record_path(input_path)
+        if not path.exists():
+            return None
+        return json.loads(path.read_text())
+
+    def records(self) -> list[dict[str, Any]]:
+        """Get the records of all the input files."""
+        return [
+            json.loads(path.read_text())
+            for path in sorted(self.manifest_dir.glob('*.json'))
+        ]
+
+    @staticmethod
+    def _input_stats(input_path: Path) -> dict[str, Any]:
+        """Get the statistics that identify a version of an input file."""
+        stat = input_path.stat()
+        return {
+            'input_path': str(input_path.resolve()),
+            'input_size': stat.st_size,
+            'input_mtime_ns': stat.st_mtime_ns,
+        }
+
+    def is_committed(self, input_path: Path) -> bool:
+        """Check whether the current version of an input is committed.
+
+        Parameters
+        ----------
+        input_path : Path
+            The input file.
+
+        Returns
+        -------
+        bool
+            True if the input has a committed shard that still exists and
+            the input has not changed since.
+        """
+        record = self.get(input_path)
+        if record is None or record['status'] != 'committed':
+            return False
+
+        # Check that the input did not change since it was processed
+        stats = self._input_stats(input_path)
+        if any(record[key] != value for key, value in stats.items()):
+            return False
+
+        return Path(record['output_path']).exists()
+
+    def start(self, input_path: Path, output_path: Path) -> None:
+        """Record that an input file is being processed.
+
+        Parameters
+        ----------
+        input_path : Path
+            The input file.
+        output_path : Path
+            The output shard being written.
+        """
+        self._write(
+            input_path,
+            {
+                **self._input_stats(input_path),
+                'output_path': str(output_path.resolve()),
+                'status': 'running',
+                'started_at': time.time(),
+            },
+        )
+
+    def commit(
+        self,
+        input_path: Path,
+        output_path: Path,
+        checksum: bool = False,
+    ) -> None:
+        """Record that the output shard of an input file is complete.
+
+        Parameters
+        ----------
+        input_path : Path
+            The input file.
+        output_path : Path
+            The output shard (a file or a directory of files).
+        checksum : bool, optional
+            Whether to record the checksums of the files of the shard, by
+            default False. This reads the whole shard back, so only the
+            sizes of the files are recorded by default.
+        """
+        record = self.get(input_path) or {}
+        if output_path.is_file():
+            files = [output_path]
+        else:
+            files = sorted(p for p in output_path.rglob('*') if p.is_file())
+        names = [str(path.relative_to(output_path.parent)) for path in files]
+        checksums = None
+        if checksum:
+            checksums = {
+                name: file_checksum(path) for name, path in zip(names, files)
+            }
+        self._write(
+            input_path,
+            {
+                **record,
+                **self._input_stats(input_path),
+                'output_path': str(output_path.resolve()),
+                'status': 'committed',
+                'sizes': {
+                    name: path.stat().st_size
+                    for name, path in zip(names, files)
+                },
+                'checksums': checksums,
+                'committed_at': time.time(),
+            },
+        )
+
+    def committed_outputs(self, verify: bool = False) -> set[Path]:
+        """Get the committed output shards.
+
+        Parameters
+        ----------
+        verify : bool, optional
+            Whether to verify the files of the shards, by default False,
+            shards that fail the verification are left out.
+
+        Returns
+        -------
+        set[Path]
+            The resolved paths of the committed output shards.
+        """
+        outputs = set()
+        for record in self.records():
+            if record['status'] != 'committed':
+                continue
+
+            output_path = Path(record['output_path'])
+            if verify and not self.verify(record):
+                print(f'Verification failed, skipping {output_path}')
+                continue
+
+            outputs.add(output_path)
+
+        return outputs
+
+    @staticmethod
+    def verify(record: dict[str, Any]) -> bool:
+        """Verify the sizes and checksums (if any) of an output shard."""
+        root = Path(record['output_path']).parent
+        for name, size in record['sizes'].items():
+            path = root / name
+            if not path.is_file() or path.stat().st_size != size:
+                return False
+        for name, checksum in (record['checksums'] or {}).items():
+            if file_checksum(root / name) != checksum:
+                return False
+        return True
+
+
+def filter_committed(
+    dataset_dirs: list[Path],
+    dataset_dir: Path,
+    manifest_dir: Path | None = None,
+    verify: bool = False,
+) -> list[Path]:
+    """Keep the dataset directories committed in the run manifest.
+
+    Skips the datasets left partially written by failed or running
+    workers. All the directories are kept if there is no manifest.
+
+    Parameters
+    ----------
+    dataset_dirs : list[Path]
+        The dataset directories to filter.
+    dataset_dir : Path
+        The directory containing the dataset directories.
+    manifest_dir : Path, optional
+        The run manifest, by default the `manifest` directory next to
+        `dataset_dir` (as written by a distributed run), if any.
+    verify : bool, optional
+        Whether to verify the files of the committed datasets against the
+        manifest, by default False.
+
+    Returns
+    -------
+    list[Path]
+        The committed dataset directories, in the input order.
+    """
+    if manifest_dir is None and (dataset_dir.parent / 'manifest').is_dir():
+        manifest_dir = dataset_dir.parent / 'manifest'
+    if manifest_dir is None:
+        return dataset_dirs
+
+    committed = RunManifest(manifest_dir).committed_outputs(verify=verify)
+    committed_dirs = [d for d in dataset_dirs if d.resolve() in committed]
+    print(
+        f'Found {len(committed_dirs)} committed datasets, skipping '
+        f'{len(dataset_dirs) - len(committed_dirs)} uncommitted ones',
+    )
+    return committed_dirs
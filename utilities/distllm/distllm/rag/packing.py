@@ -0,0 +1,78 @@
+"""Token-budgeted context packing for retrieved documents."""
+
+from __future__ import annotations
+
+import numpy as np
+
+
+def mmr_pack(  # noqa: PLR0913
+    scores: list[float] | np.ndarray,
+    embeddings: np.ndarray,
+    token_counts: list[int],
+    token_budget: int,
+    *,
+    mmr_lambda: float = 0.5,
+    max_docs: int | None = None,
+) -> list[int]:
+    """Select documents by maximal marginal relevance within a token budget.
+
+    Documents are picked greedily by their MMR score, i.e.,
+    `mmr_lambda * score - (1 - mmr_lambda) * max_similarity`, where
+    `max_similarity` is the cosine similarity to the closest document
+    already selected. Documents that no longer fit in the remaining token
+    budget are skipped, so a shorter document may still be selected.
+
+    Parameters
+    ----------
+    scores : list[float] | np.ndarray
+        The retrieval scores of the documents (higher is more relevant).
+    embeddings : np.ndarray
+        The embeddings of the documents (shape: [num_docs, embedding_size]).
+    token_counts : list[int]
+        The number of tokens of each document.
+    token_budget : int
+        The maximum total number of tokens of the selected documents.
+    mmr_lambda : float, optional
+        The trade-off between relevance (1.0) and diversity (0.0),
+        by default 0.5.
+    max_docs : int, optional
+        The maximum number of documents to select, by default None.
+
+    Returns
+    -------
+    list[int]
+        The positions of the selected documents, in selection order.
+    """
+    num_docs = len(token_counts)
+    if not num_docs:
+        return []
+
+    # Cosine similarities between the documents
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.maximum(norms, 1e-12)
+    similarity = embeddings @ embeddings.T
+
+    relevance = np.asarray(scores, dtype=np.float32)
+    token_counts = np.asarray(token_counts)  # type: ignore[assignment]
+    max_similarity = np.zeros(num_docs, dtype=np.float32)
+    available = np.ones(num_docs, dtype=bool)
+    max_docs = max_docs or num_docs
+
+    selected: list[int] = []
+    remaining_tokens = token_budget
+    while len(selected) < max_docs:
+        # Only consider documents that still fit in the budget
+        available &= token_counts <= remaining_tokens
+        if not available.any():
+            break
+
+        # Pick the most relevant document that is least redundant
+        mmr = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        best = int(np.argmax(np.where(available, mmr, -np.inf)))
+        selected.append(best)
+        available[best] = False
+        remaining_tokens -= int(token_counts[best])
+        max_similarity = np.maximum(max_similarity, similarity[best])
+
+    return selected
@@ -0,0 +1,191 @@
+"""In-process query encoder with request micro-batching."""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+from pydantic import Field
+
+from distllm.embed import Encoder
+from distllm.embed import EncoderConfigs
+from distllm.embed import get_encoder
+from distllm.embed import get_pooler
+from distllm.embed import Pooler
+from distllm.embed import PoolerConfigs
+from distllm.embed.datasets.utils import DataCollator
+from distllm.utils import BaseConfig
+
+# The warm query encoders of this process, keyed by their configuration
+_QUERY_ENCODERS: dict[str, QueryEncoder] = {}
+_QUERY_ENCODERS_LOCK = threading.Lock()
+
+
+class QueryEncoder:
+    """Embed queries in process, batching concurrent requests together.
+
+    The encoder and pooler are held warm for the lifetime of the process.
+    Each call to `encode` queues its queries and waits for a worker
+    thread, which encodes the queued queries of all the pending requests
+    together in batches of up to `batch_size`. Requests that arrive while
+    a batch is being encoded are batched into the next forward pass, so
+    batching adds no latency to a lone request unless `max_wait_ms` holds
+    the batches open to gather more requests.
+    """
+
+    def __init__(
+        self,
+        encoder: Encoder,
+        pooler: Pooler,
+        batch_size: int = 32,
+        max_wait_ms: float = 0.0,
+    ) -> None:
+        """Initialize the query encoder.
+
+        Parameters
+        ----------
+        encoder : Encoder
+            The encoder instance to use for embedding queries.
+        pooler : Pooler
+            The pooler instance to use for pooling embeddings.
+        batch_size : int, optional
+            The maximum number of queries per forward pass, by default 32.
+        max_wait_ms : float, optional
+            How long to wait for more requests before encoding a batch
+            that is not full, by default 0.0.
+        """
+        self.encoder = encoder
+        self.pooler = pooler
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.collator = DataCollator(encoder.tokenizer)
+
+        # Start the worker thread that encodes the queued requests
+        self._requests: queue.Queue = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._run,
+            name='query-encoder',
+            daemon=True,
+        )
+        self._worker.start()
+
+    @torch.no_grad()
+    def _embed(self, queries: list[str]) -> np.ndarray:
+        """Embed the queries in batches of up to batch_size."""
+        embeddings = []
+        for start in range(0, len(queries), self.batch_size):
+            batch = self.collator(queries[start : start + self.batch_size])
+            inputs = batch.to(self.encoder.device)
+            hidden_states = self.encoder.encode(inputs)
+            pooled_embeds = self.pooler.pool(
+                hidden_states,
+                inputs.attention_mask,
+            )
+            embeddings.append(pooled_embeds.float().cpu().numpy())
+        return np.concatenate(embeddings)
+
+    def _next_requests(self) -> list[tuple[list[str], Future[np.ndarray]]]:
+        """Wait for a request and gather the requests queued behind it."""
+        requests = [self._requests.get()]
+        num_queries = len(requests[0][0])
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while num_queries < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    request = self._requests.get(timeout=timeout)
+                else:
+                    request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            requests.append(request)
+            num_queries += len(request[0])
+        return requests
+
+    def _run(self) -> None:
+        """Encode the queued requests, batch by batch."""
+        while True:
+            requests = self._next_requests()
+            queries = [query for batch, _ in requests for query in batch]
+            try:
+                embeddings = self._embed(queries)
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+
+            # Hand each request the embeddings of its queries
+            offset = 0
+            for batch, future in requests:
+                future.set_result(embeddings[offset : offset + len(batch)])
+                offset += len(batch)
+
+    def encode(self, query: str | list[str]) -> np.ndarray:
+        """Embed the queries.
+
+        Parameters
+        ----------
+        query : str | list[str]
+            The single query or list of queries.
+
+        Returns
+        -------
+        np.ndarray
+            The fp32 embeddings of the queries
+            (shape: [num_queries, embedding_size])
+        """
+        # Convert the query to a list if it is a single string
+        if isinstance(query, str):
+            query = [query]
+
+        if not query:
+            return np.empty((0, self.encoder.embedding_size), np.float32)
+
+        # Queue the queries and wait for their embeddings
+        future: Future[np.ndarray] = Future()
+        self._requests.put((list(query), future))
+        return future.result()
+
+
+class QueryEncoderConfig(BaseConfig):
+    """Configuration for the in-process query encoder."""
+
+    encoder_config: EncoderConfigs = Field(
+        ...,
+        description='Settings for the encoder',
+    )
+    pooler_config: PoolerConfigs = Field(
+        ...,
+        description='Settings for the pooler',
+    )
+    batch_size: int = Field(
+        32,
+        description='The maximum number of queries per forward pass.',
+    )
+    max_wait_ms: float = Field(
+        0.0,
+        description='How long to wait for more requests before encoding a '
+        'batch that is not full (in milliseconds), by default requests are '
+        'only batched with the requests queued while the encoder is busy.',
+    )
+
+    def get_query_encoder(self) -> QueryEncoder:
+        """Get the warm query encoder of this configuration.
+
+        The encoder is loaded on the first call and shared by all the
+        later calls with the same configuration in this process.
+        """
+        key = self.model_dump_json()
+        with _QUERY_ENCODERS_LOCK:
+            if key not in _QUERY_ENCODERS:
+                _QUERY_ENCODERS[key] = QueryEncoder(
+                    encoder=get_encoder(self.encoder_config.model_dump()),
+                    pooler=get_pooler(self.pooler_config.model_dump()),
+                    batch_size=self.batch_size,
+                    max_wait_ms=self.max_wait_ms,
+                )
+            return _QUERY_ENCODERS[key]
@@ -3,18 +3,22 @@
 from __future__ import annotations
 
 import functools
+import os
 import time
 import warnings
 
-from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 from typing import ClassVar
+from typing import Iterator
 from typing import Literal
 from typing import List
 
 import faiss
 import numpy as np
+import pyarrow as pa
 import requests
 import torch
 import json
@@ -23,7 +27,6 @@ from datasets import Dataset
 from datasets.search import BatchedSearchResults
 from pydantic import Field
 from sentence_transformers.quantization import quantize_embeddings
-from sentence_transformers.quantization import semantic_search_faiss
 from tqdm import tqdm
 
 from distllm.embed import Encoder
@@ -32,10 +35,96 @@ from distllm.embed import get_encoder
 from distllm.embed import get_pooler
 from distllm.embed import Pooler
 from distllm.embed import PoolerConfigs
+from distllm.embed.precision import upcast_embeddings
+from distllm.rag.query_encoder import QueryEncoder
+from distllm.rag.query_encoder import QueryEncoderConfig
 from distllm.utils import BaseConfig
 from distllm.utils import batch_data
 
 
+def iter_embedding_batches(
+    dataset_paths: list[Path],
+    batch_size: int = 65536,
+    skip: int = 0,
+) -> Iterator[np.ndarray]:
+    """Stream the fp32 embeddings of the datasets in Arrow record batches.
+
+    The Arrow files are memory-mapped, so only one batch of embeddings is
+    resident at a time. Embeddings stored in reduced precision (float16,
+    or bfloat16 stored as uint16) are upcast to fp32 batch by batch.
+
+    Parameters
+    ----------
+    dataset_paths : list[Path]
+        The HF dataset directories containing the embeddings.
+    batch_size : int, optional
+        The maximum number of rows per batch, by default 65536.
+    skip : int, optional
+        The number of leading rows (across all datasets) to skip,
+        by default 0.
+
+    Yields
+    ------
+    np.ndarray
+        The fp32 embeddings (shape: [num_rows, embedding_size]).
+    """
+    for dataset_path in dataset_paths:
+        dataset = Dataset.load_from_disk(str(dataset_path))
+        table = dataset.data.select(['embeddings'])
+        for batch in table.to_batches(max_chunksize=batch_size):
+            # Skip whole batches without converting them
+            if skip >= batch.num_rows:
+                skip -= batch.num_rows
+                continue
+
+            # Flatten the list column into a 2D array
+            column = batch.column(0).slice(skip)
+            skip = 0
+            values = column.flatten().to_numpy(zero_copy_only=False)
+            yield upcast_embeddings(values).reshape(len(column), -1)
+
+
+def sample_embeddings(
+    dataset_paths: list[Path],
+    num_samples: int,
+    batch_size: int = 65536,
+    seed: int = 0,
+) -> np.ndarray:
+    """Uniformly sample fp32 embeddings from the datasets.
+
+    Parameters
+    ----------
+    dataset_paths : list[Path]
+        The HF dataset directories containing the embeddings.
+    num_samples : int
+        The number of embeddings to sample.
+    batch_size : int, optional
+        The number of rows to read at a time, by default 65536.
+    seed : int, optional
+        The random seed, by default 0.
+
+    Returns
+    -------
+    np.ndarray
+        The sampled embeddings (shape: [num_samples, embedding_size]).
+    """
+    # Choose the sampled rows up front
+    num_rows = sum(len(Dataset.load_from_disk(str(p))) for p in dataset_paths)
+    rng = np.random.default_rng(seed)
+    rows = np.sort(
+        rng.choice(num_rows, size=min(num_samples, num_rows), replace=False),
+    )
+
+    # Collect the sampled rows from each batch
+    samples, offset = [], 0
+    for batch in iter_embedding_batches(dataset_paths, batch_size):
+        start, end = np.searchsorted(rows, [offset, offset + len(batch)])
+        samples.append(batch[rows[start:end] - offset])
+        offset += len(batch)
+
+    return np.concatenate(samples)
+
+
 def quantize_dataset(dataset_path: Path, precision: str) -> np.ndarray:
     """Quantize the embeddings in the dataset to the specified precision.
 
@@ -48,17 +137,366 @@ def quantize_dataset(dataset_path: Path, precision: str) -> np.ndarray:
         "float32", "uint8", "int8", "ubinary", and "binary".
         But FAISS only supports "float32", "uint8", and "ubinary".
     """
-    # Load the dataset
-    dataset = Dataset.load_from_disk(str(dataset_path))
-    dataset.set_format('numpy', columns=['embeddings'])
+    # Quantize the pre-computed fp32 embeddings batch by batch
+    quantized_embeddings = [
+        quantize_embeddings(batch, precision=precision)
+        for batch in iter_embedding_batches([dataset_path])
+    ]
 
-    # Load the pre-computed fp32 embeddings
-    embeddings = dataset['embeddings']
+    return np.concatenate(quantized_embeddings)
 
-    # Quantize the embeddings
-    quantized_embeddings = quantize_embeddings(embeddings, precision=precision)
 
-    return quantized_embeddings
+class RescoreSidecar:
+    """Memory-mapped fp16/fp32 copy of the corpus embeddings for rescoring.
+
+    Binary indexes only store the packed sign bits of each embedding, so
+    rescoring the `top_k * rescore_multiplier` candidates needs the full
+    precision corpus embeddings. Rather than keeping the HF `embeddings`
+    column resident, the embeddings are written once to a compact `.npy`
+    file at index build time and memory-mapped at search time, so that
+    rescoring only reads the candidate rows from disk.
+
+    Documents appended to an ID-mapped index get their own sidecar file,
+    the files are addressed as one contiguous array of corpus rows.
+    """
+
+    def __init__(self, paths: list[Path]) -> None:
+        """Initialize the sidecar.
+
+        Parameters
+        ----------
+        paths : list[Path]
+            The paths to the `.npy` sidecar files, in corpus row order.
+        """
+        self.paths: list[Path] = []
+        self.embeddings: list[np.ndarray] = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        for path in paths:
+            self.append(path)
+
+    def append(self, path: Path) -> None:
+        """Memory-map another sidecar file after the existing rows.
+
+        Parameters
+        ----------
+        path : Path
+            The path to the `.npy` sidecar file.
+        """
+        embeddings = np.load(str(path), mmap_mode='r')
+        self.paths.append(path)
+        self.embeddings.append(embeddings)
+        self.offsets = np.append(
+            self.offsets,
+            self.offsets[-1] + len(embeddings),
+        )
+
+    def gather(self, indices: np.ndarray) -> np.ndarray:
+        """Read the fp32 embeddings of the given (sorted) corpus rows.
+
+        Parameters
+        ----------
+        indices : np.ndarray
+            The sorted corpus row indices to read.
+
+        Returns
+        -------
+        np.ndarray
+            The fp32 embeddings (shape: [num_indices, embedding_size]).
+        """
+        # Map the corpus rows to (file, local row), only the requested
+        # rows are read from each memory-mapped file
+        files = np.searchsorted(self.offsets, indices, side='right') - 1
+        rows = [
+            self.embeddings[f][indices[files == f] - self.offsets[f]]
+            for f in np.unique(files)
+        ]
+        if not rows:
+            return np.empty((0, self.embeddings[0].shape[1]), np.float32)
+        return np.concatenate(rows).astype(np.float32)
+
+    @staticmethod
+    def write(
+        path: Path,
+        dataset_paths: list[Path],
+        dtype: str = 'float16',
+        batch_size: int = 65536,
+    ) -> None:
+        """Write the sidecar file from the HF dataset embeddings.
+
+        Parameters
+        ----------
+        path : Path
+            The path to write the `.npy` sidecar file to.
+        dataset_paths : list[Path]
+            The HF dataset directories containing the embeddings,
+            in the same order as they were added to the FAISS index.
+        dtype : str, optional
+            The storage precision of the sidecar [float16, float32],
+            by default 'float16'.
+        batch_size : int, optional
+            The number of rows to copy at a time, by default 65536.
+        """
+        if dtype not in ('float16', 'float32'):
+            raise ValueError(
+                f'Invalid rescore dtype {dtype}. '
+                'Options: ["float16" and "float32"]',
+            )
+
+        # Open the datasets lazily (the arrow files are memory-mapped)
+        datasets = [Dataset.load_from_disk(str(p)) for p in dataset_paths]
+        for dataset in datasets:
+            dataset.set_format('numpy', columns=['embeddings'])
+
+        # Preallocate the output file on disk
+        num_rows = sum(len(dataset) for dataset in datasets)
+        embedding_size = len(datasets[0][0]['embeddings'])
+        output = np.lib.format.open_memmap(
+            str(path),
+            mode='w+',
+            dtype=dtype,
+            shape=(num_rows, embedding_size),
+        )
+
+        # Copy the embeddings batch by batch to bound the memory usage
+        offset = 0
+        for dataset in datasets:
+            for start in range(0, len(dataset), batch_size):
+                batch = dataset[start : start + batch_size]['embeddings']
+                batch = upcast_embeddings(batch)
+                output[offset : offset + len(batch)] = batch
+                offset += len(batch)
+
+        output.flush()
+        del output
+
+    def rescore(
+        self,
+        query_embedding: np.ndarray,
+        candidate_indices: np.ndarray,
+        top_k: int,
+    ) -> BatchedSearchResults:
+        """Rescore the candidates with the full precision embeddings.
+
+        Parameters
+        ----------
+        query_embedding : np.ndarray
+            The fp32 query embeddings (shape: [num_queries, embedding_size]).
+        candidate_indices : np.ndarray
+            The candidate corpus indices returned by the binary index
+            (shape: [num_queries, num_candidates]), padded with -1.
+        top_k : int
+            The number of top results to keep for each query.
+
+        Returns
+        -------
+        BatchedSearchResults
+            The rescored results sorted by descending inner product.
+        """
+        total_scores, total_indices = [], []
+        for query, indices in zip(query_embedding, candidate_indices):
+            # FAISS pads short result sets with -1. Sorting the candidate
+            # ids makes the memory-mapped reads as sequential as possible.
+            indices = np.sort(indices[indices >= 0])  # noqa: PLW2901
+
+            # Only the candidate rows are read from disk
+            candidates = self.gather(indices)
+            scores = candidates @ query.astype(np.float32)
+
+            # Keep the top k candidates by rescored similarity
+            order = np.argsort(-scores)[:top_k]
+            total_scores.append(scores[order].tolist())
+            total_indices.append(indices[order].tolist())
+
+        return BatchedSearchResults(
+            total_scores=total_scores,
+            total_indices=total_indices,
+        )
+
+
+class VirtualDataset:
+    """Read-only view of HF dataset shards as one corpus, without a merge.
+
+    The rows of the shards are addressed as one contiguous range of
+    corpus rows (the rows of the first shard come first, followed by the
+    rows of the second shard, and so on), each global row is mapped to
+    its (shard, local row) with the row offsets of the shards. The shards
+    are only loaded (memory-mapped) the first time one of their rows is
+    read, so the embedding shards (e.g., `embeddings/<uuid>`) can be
+    indexed and served directly.
+
+    The shards and their number of rows are recorded in a JSON manifest,
+    which fixes the order of the shards (and thus the corpus rows) between
+    building the index and serving it.
+    """
+
+    def __init__(
+        self,
+        shard_dirs: list[Path],
+        num_rows: list[int] | None = None,
+    ) -> None:
+        """Initialize the virtual dataset.
+
+        Parameters
+        ----------
+        shard_dirs : list[Path]
+            The HF dataset directories of the shards, in corpus row order.
+        num_rows : list[int], optional
+            The number of rows of each shard, by default None, in which
+            case the shards are loaded to count their rows.
+        """
+        self.shard_dirs: list[Path] = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self._shards: dict[int, Dataset] = {}
+        for i, shard_dir in enumerate(shard_dirs):
+            self.append(shard_dir, None if num_rows is None else num_rows[i])
+
+    @classmethod
+    def from_manifest(cls, path: Path) -> VirtualDataset:
+        """Load the virtual dataset from its manifest.
+
+        Parameters
+        ----------
+        path : Path
+            The path to the JSON manifest.
+
+        Returns
+        -------
+        VirtualDataset
+            The virtual dataset.
+        """
+        shards = json.loads(path.read_text())['shards']
+        return cls(
+            [Path(shard['path']) for shard in shards],
+            [shard['num_rows'] for shard in shards],
+        )
+
+    def save(self, path: Path) -> None:
+        """Atomically write the manifest of the virtual dataset.
+
+        Parameters
+        ----------
+        path : Path
+            The path to the JSON manifest.
+        """
+        shards = [
+            {'path': str(shard_dir), 'num_rows': int(num_rows)}
+            for shard_dir, num_rows in zip(
+                self.shard_dirs,
+                np.diff(self.offsets),
+            )
+        ]
+        tmp_path = Path(f'{path}.tmp')
+        tmp_path.write_text(json.dumps({'shards': shards}, indent=2))
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        """Get the number of corpus rows."""
+        return int(self.offsets[-1])
+
+    @property
+    def column_names(self) -> list[str]:
+        """Get the column names (of the first shard)."""
+        return self._shard(0).column_names
+
+    def _shard(self, shard_idx: int) -> Dataset:
+        """Get a shard, memory-mapping it on first use."""
+        if shard_idx not in self._shards:
+            self._shards[shard_idx] = Dataset.load_from_disk(
+                str(self.shard_dirs[shard_idx]),
+            )
+        return self._shards[shard_idx]
+
+    def append(self, shard_dir: Path, num_rows: int | None = None) -> None:
+        """Add a shard after the existing rows.
+
+        Parameters
+        ----------
+        shard_dir : Path
+            The HF dataset directory of the shard.
+        num_rows : int, optional
+            The number of rows of the shard, by default None, in which
+            case the shard is loaded to count its rows.
+        """
+        self.shard_dirs.append(shard_dir)
+        if num_rows is None:
+            num_rows = len(self._shard(len(self.shard_dirs) - 1))
+        self.offsets = np.append(self.offsets, self.offsets[-1] + num_rows)
+
+    def _locate(self, indices: list[int]) -> tuple[np.ndarray, np.ndarray]:
+        """Map the corpus rows to their shard and local row."""
+        rows = np.asarray(indices, dtype=np.int64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError(f'Corpus rows out of range [0, {len(self)})')
+        shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        return shard_ids, rows - self.offsets[shard_ids]
+
+    def __getitem__(self, index: int) -> dict[str, Any]:
+        """Get a corpus row."""
+        shard_ids, rows = self._locate([index])
+        return self._shard(int(shard_ids[0]))[int(rows[0])]
+
+    def get(self, indices: list[int], key: str) -> list[Any]:
+        """Get the values of a key for the given corpus rows.
+
+        Only the key column of the requested rows is read, one shard at
+        a time.
+
+        Parameters
+        ----------
+        indices : list[int]
+            The list of corpus rows to get.
+        key : str
+            The key to get from the dataset.
+
+        Returns
+        -------
+        list[Any]
+            The values of the key for the given rows.
+        """
+        shard_ids, rows = self._locate(indices)
+        values: list[Any] = [None] * len(indices)
+        for shard_idx in np.unique(shard_ids):
+            positions = np.flatnonzero(shard_ids == shard_idx)
+            column = self._shard(int(shard_idx)).data.column(key)
+            taken = column.take(pa.array(rows[positions])).to_pylist()
+            for position, value in zip(positions, taken):
+                values[position] = value
+        return values
+
+    def check_key_exists(self, key: str) -> bool:
+        """Check if the key exists in the dataset.
+
+        Parameters
+        ----------
+        key : str
+            The key to check.
+
+        Returns
+        -------
+        bool
+            True if the key exists, False otherwise.
+        """
+        return key in self.column_names
+
+    def column(self, key: str) -> pa.ChunkedArray:
+        """Get a column of every shard, without copying it.
+
+        Parameters
+        ----------
+        key : str
+            The column to get.
+
+        Returns
+        -------
+        pa.ChunkedArray
+            The memory-mapped chunks of the column, in corpus row order.
+        """
+        chunks = [
+            chunk
+            for shard_idx in range(len(self.shard_dirs))
+            for chunk in self._shard(shard_idx).data.column(key).chunks
+        ]
+        return pa.chunked_array(chunks)
 
 
 class FaissIndexV2Config(BaseConfig):
@@ -69,7 +507,8 @@ class FaissIndexV2Config(BaseConfig):
     dataset_dir: Path = Field(
         ...,
         description='The path to the HF dataset directory containing the '
-        'document text and fp32 embeddings.',
+        'document text and fp32 embeddings, or to the JSON manifest of a '
+        'virtual dataset over the (unmerged) dataset shards.',
     )
     faiss_index_path: Path = Field(
         ...,
@@ -88,7 +527,7 @@ class FaissIndexV2Config(BaseConfig):
     )
     search_algorithm: str = Field(
         default='exact',
-        description='The desired search algorithm [exact, hnsw].',
+        description='The desired search algorithm [exact, hnsw, ivf].',
     )
     rescore_multiplier: int = Field(
         default=2,
@@ -96,7 +535,54 @@ class FaissIndexV2Config(BaseConfig):
     )
     num_quantization_workers: int = Field(
         default=1,
-        description='The number of quantization process workers.',
+        description='The number of batches quantized ahead of the index '
+        'during creation.',
+    )
+    build_batch_size: int = Field(
+        default=65536,
+        description='The number of embeddings added to the index at a time '
+        'during creation.',
+    )
+    checkpoint_interval: int = Field(
+        default=10_000_000,
+        description='The number of embeddings added between index build '
+        'checkpoints, 0 disables checkpointing.',
+    )
+    nlist: int = Field(
+        default=4096,
+        description='The number of IVF clusters.',
+    )
+    nprobe: int = Field(
+        default=32,
+        description='The number of IVF clusters visited per query.',
+    )
+    ivf_train_size: int = Field(
+        default=262_144,
+        description='The number of sampled embeddings used to train the '
+        'IVF clusters.',
+    )
+    rescore_embeddings_path: Path | None = Field(
+        default=None,
+        description='The path to the memory-mapped embedding sidecar used '
+        'to rescore ubinary search candidates, by default None, in which '
+        'case it is stored next to the FAISS index with a .rescore.npy '
+        'extension.',
+    )
+    rescore_dtype: str = Field(
+        default='float16',
+        description='The precision of the rescoring sidecar '
+        '[float16, float32].',
+    )
+    id_map: bool = Field(
+        default=False,
+        description='Whether to wrap the FAISS index in an IndexIDMap2 so '
+        'that documents can be appended and compacted without a rebuild '
+        '(IVF indexes store the document ids natively and are not wrapped).',
+    )
+    filter_fields: list[str] | None = Field(
+        default=None,
+        description='The metadata columns of the dataset (e.g., path) that '
+        'searches can be filtered on.',
     )
 
 class FaissIndexV2:
@@ -105,8 +591,10 @@ class FaissIndexV2:
     Supported FAISS indexes:
         - IndexFlatIP
         - IndexHNSWFlat
+        - IndexIVFFlat
         - IndexBinaryFlat
         - IndexBinaryHNSW
+        - IndexBinaryIVF
 
     Supported embedding precision:
         - float32
@@ -115,9 +603,39 @@ class FaissIndexV2:
     Supported search algorithms:
         - exact
         - hnsw
+        - ivf
 
     If the FAISS index does not exist, it will be created and saved to disk.
-    Supports parallel quantization of HF dataset chunks using a process pool.
+    The index is built by streaming Arrow record batches from the HF dataset
+    (chunks) into the index, so the full corpus is never materialized in
+    memory. IVF indexes are trained on a uniform sample of the corpus. The
+    partial index is checkpointed periodically so that a crashed build
+    resumes where it left off.
+
+    The stored embeddings may be float32, float16 or bfloat16 (stored as
+    uint16, see `output_dtype` of the embedders and writers), they are
+    upcast to float32 batch by batch as the index is built.
+
+    ID-mapped indexes (`id_map=True`) and IVF indexes support appending new
+    dataset shards and compacting deleted documents without rebuilding the
+    index. Appended shards and deleted (tombstoned) documents are recorded
+    in a JSON file next to the index with a .updates.json extension.
+    Tombstoned documents are excluded from the search results until the
+    index is compacted.
+
+    The dataset can also be a `VirtualDataset` (given by its JSON manifest)
+    over the unmerged dataset shards, e.g., the `embeddings/<uuid>` outputs
+    of an embedding run. The index is then built from the shards and the
+    text store reads the rows from the memory-mapped shards directly, so
+    the shards never need to be merged.
+
+    Searches can be restricted to documents matching metadata filters on the
+    `filter_fields` columns. Each filter field is dictionary encoded once at
+    load time, and a filtered search passes a bitmap of the matching rows
+    to FAISS as an ID selector, so exactly `top_k` results are returned
+    without over-fetching (except for binary HNSW/IVF indexes, which do not
+    accept search parameters and are post-filtered). Note that HNSW graphs
+    may return fewer than `top_k` results for very selective filters.
 
     For more information, see:
     https://github.com/UKPLab/sentence-transformers/blob/master/examples/applications/embedding-quantization/semantic_search_faiss.py
@@ -132,6 +650,15 @@ class FaissIndexV2:
         search_algorithm: str = 'exact',
         rescore_multiplier: int = 2,
         num_quantization_workers: int = 1,
+        build_batch_size: int = 65536,
+        checkpoint_interval: int = 10_000_000,
+        nlist: int = 4096,
+        nprobe: int = 32,
+        ivf_train_size: int = 262_144,
+        rescore_embeddings_path: Path | None = None,
+        rescore_dtype: str = 'float16',
+        id_map: bool = False,
+        filter_fields: list[str] | None = None,
     ) -> None:
         """Initialize the FAISS index.
 
@@ -139,7 +666,9 @@ class FaissIndexV2:
         ----------
         dataset_dir : Path
             The path to the HF dataset directory containing
-            the document text and fp32 embeddings.
+            the document text and fp32 embeddings, or to the JSON
+            manifest (.json) of a `VirtualDataset` over the dataset
+            shards, in which case the index is built from the shards.
         faiss_index_path : Path
             The path to the FAISS index, if it does not exist,
             it will be created and saved to this path.
@@ -147,9 +676,8 @@ class FaissIndexV2:
             The paths to the dataset chunks, each containing
             an HF dataset with the document text and fp32 embeddings,
             to be quantized and added to the FAISS index during creation.
-            Each dataset chunk is quantized in parallel using a process
-            pool, and the quantized embeddings are concatenated and added
-            to the index, by default None.
+            The dataset chunks are streamed into the index in order,
+            by default None.
         precision : str, optional
             The desired precision for the embeddings, by default 'float32'.
             Supported options are 'float32' and 'ubinary'. If 'ubinary' is
@@ -157,13 +685,45 @@ class FaissIndexV2:
             format, which is more memory efficient than 'float32'.
         search_algorithm : str, optional
             Whether to use exact search or approximate FAISS search,
-            by default 'exact'. Supported options are 'exact' and 'hnsw'.
+            by default 'exact'. Supported options are 'exact', 'hnsw'
+            and 'ivf'.
         rescore_multiplier : int, optional
             Oversampling factor for rescoring. The code will now search
             `top_k * rescore_multiplier` samples and then rescore to only
             keep `top_k`, by default 2.
         num_quantization_workers : int, optional
-            The number of quantization process workers, by default 1.
+            The number of batches quantized ahead of the index by a thread
+            pool during creation, by default 1.
+        build_batch_size : int, optional
+            The number of embeddings added to the index at a time during
+            creation, by default 65536.
+        checkpoint_interval : int, optional
+            The number of embeddings added between index build checkpoints,
+            by default 10,000,000. A value of 0 disables checkpointing.
+        nlist : int, optional
+            The number of IVF clusters, by default 4096.
+        nprobe : int, optional
+            The number of IVF clusters visited per query, by default 32.
+        ivf_train_size : int, optional
+            The number of sampled embeddings used to train the IVF
+            clusters, by default 262,144.
+        rescore_embeddings_path : Path, optional
+            The path to the memory-mapped fp16/fp32 embedding sidecar used
+            to rescore 'ubinary' search candidates. If it does not exist,
+            it will be written alongside the index, by default None, in
+            which case `faiss_index_path` with a .rescore.npy extension
+            is used.
+        rescore_dtype : str, optional
+            The precision of the rescoring sidecar, by default 'float16'.
+            Supported options are 'float16' and 'float32'.
+        id_map : bool, optional
+            Whether to wrap a newly created FAISS index in an IndexIDMap2
+            so that documents can be appended and compacted without a
+            rebuild, by default False. IVF indexes store the document ids
+            natively, so they are not wrapped and always support it.
+        filter_fields : list[str], optional
+            The metadata columns of the dataset (e.g., path) that searches
+            can be filtered on, by default None.
         """
         self.dataset_dir = dataset_dir
         self.faiss_index_path = faiss_index_path
@@ -172,6 +732,18 @@ class FaissIndexV2:
         self.search_algorithm = search_algorithm
         self.rescore_multiplier = rescore_multiplier
         self.num_workers = num_quantization_workers
+        self.build_batch_size = build_batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ivf_train_size = ivf_train_size
+        self.rescore_dtype = rescore_dtype
+        self.rescore_embeddings_path = rescore_embeddings_path or Path(
+            f'{faiss_index_path}.rescore.npy',
+        )
+        self.id_map = id_map
+        self.filter_fields = filter_fields or []
+        self.updates_path = Path(f'{faiss_index_path}.updates.json')
 
         # Validate the precision and search algorithm
         if self.precision not in ('float32', 'ubinary'):
@@ -179,87 +751,500 @@ class FaissIndexV2:
                 f'Invalid precision {precision}. '
                 'Options: ["float32" and "ubinary"]',
             )
-        if self.search_algorithm not in ('exact', 'hnsw'):
+        if self.search_algorithm not in ('exact', 'hnsw', 'ivf'):
             raise ValueError(
                 f'Invalid search_algorithm {search_algorithm}. '
-                'Options: ["exact" and "hnsw"]',
+                'Options: ["exact", "hnsw" and "ivf"]',
             )
         # Initialize the FAISS index
         if self.faiss_index_path.exists():
             # Load the  from disk
-            self.dataset = Dataset.load_from_disk(str(dataset_dir))
+            self.dataset = self._load_dataset(dataset_dir)
             print(f'Loading FAISS index from {self.faiss_index_path}')
             self.faiss_index = self._load_index_from_disk()
         else:
             # Load the  from disk
-            self.dataset = Dataset.load_from_disk(str(dataset_dir))
+            self.dataset = self._load_dataset(dataset_dir)
             print(f'Creating FAISS index at {self.faiss_index_path}')
             self.faiss_index = self._create_index()
 
-    def _load_index_from_disk(self) -> faiss.Index:
-        """Load the FAISS index from disk."""
-        if self.precision in ('float32', 'uint8'):
-            return faiss.read_index(str(self.faiss_index_path))
+        # Set the number of IVF clusters visited per query
+        if self.search_algorithm == 'ivf':
+            self._ivf_index().nprobe = self.nprobe
+
+        # Binary indexes are rescored from a memory-mapped fp16/fp32 copy
+        # of the corpus embeddings instead of the HF dataset column
+        self.rescore_sidecar = None
+        if self.precision == 'ubinary':
+            self.rescore_sidecar = self._load_rescore_sidecar()
+
+        # Apply the shards appended and documents deleted since the
+        # index was created
+        self.appended_dirs: list[Path] = []
+        self.tombstones = np.empty(0, dtype=np.int64)
+        if self.updates_path.exists():
+            self._load_updates()
+
+        # Encode the metadata columns used to filter searches
+        self._build_filter_index()
+
+    @staticmethod
+    def _load_dataset(dataset_dir: Path) -> Dataset | VirtualDataset:
+        """Load the HF dataset, or the virtual dataset of a manifest."""
+        if dataset_dir.suffix == '.json':
+            return VirtualDataset.from_manifest(dataset_dir)
+        return Dataset.load_from_disk(str(dataset_dir))
+
+    def _dataset_paths(self) -> list[Path]:
+        """Get the HF dataset directories of the corpus embeddings."""
+        if self.dataset_chunk_paths:
+            return self.dataset_chunk_paths
+        if isinstance(self.dataset, VirtualDataset):
+            return self.dataset.shard_dirs
+        return [self.dataset_dir]
+
+    def _load_rescore_sidecar(self) -> RescoreSidecar:
+        """Load the rescoring sidecar, writing it first if needed."""
+        if not self.rescore_embeddings_path.exists():
+            print(
+                f'Writing {self.rescore_dtype} rescoring embeddings to '
+                f'{self.rescore_embeddings_path}',
+            )
+            RescoreSidecar.write(
+                self.rescore_embeddings_path,
+                self._dataset_paths(),
+                dtype=self.rescore_dtype,
+            )
+
+        return RescoreSidecar([self.rescore_embeddings_path])
+
+    def _load_updates(self) -> None:
+        """Load the appended shards and tombstones from disk."""
+        updates = json.loads(self.updates_path.read_text())
+        self.appended_dirs = [Path(p) for p in updates['appended_dirs']]
+        self.tombstones = np.array(updates['tombstones'], dtype=np.int64)
+
+        # Concatenating the memory-mapped Arrow tables does not copy data
+        if isinstance(self.dataset, VirtualDataset):
+            for dataset_dir in self.appended_dirs:
+                self.dataset.append(dataset_dir)
         else:
-            return faiss.read_index_binary(str(self.faiss_index_path))
+            appended = [
+                Dataset.load_from_disk(str(p)) for p in self.appended_dirs
+            ]
+            self.dataset = concatenate_datasets([self.dataset, *appended])
+
+        # Each appended shard has its own rescoring sidecar file
+        if self.rescore_sidecar is not None:
+            for shard_idx in range(len(self.appended_dirs)):
+                self.rescore_sidecar.append(
+                    self._appended_sidecar_path(shard_idx),
+                )
+
+    def _save_updates(self) -> None:
+        """Atomically write the appended shards and tombstones to disk."""
+        updates = {
+            'appended_dirs': [str(p) for p in self.appended_dirs],
+            'tombstones': self.tombstones.tolist(),
+        }
+        tmp_path = Path(f'{self.updates_path}.tmp')
+        tmp_path.write_text(json.dumps(updates, indent=2))
+        os.replace(tmp_path, self.updates_path)
+
+    def _appended_sidecar_path(self, shard_idx: int) -> Path:
+        """Get the rescoring sidecar path of an appended shard."""
+        return self.rescore_embeddings_path.with_suffix(
+            f'.{shard_idx:04}.npy',
+        )
 
-    def _create_index(self) -> faiss.Index:
-        # Define the worker function for quantization
-        func = functools.partial(quantize_dataset, precision=self.precision)
+    def _build_filter_index(self) -> None:
+        """Encode the metadata columns used to filter searches.
+
+        Each filter field is dictionary encoded: store a lookup from each
+        distinct value to its code and the code of every row (-1 for
+        missing values).
+        """
+        self.filter_index: dict[str, tuple[dict[Any, int], np.ndarray]] = {}
+        for field in self.filter_fields:
+            if field not in self.dataset.column_names:
+                raise ValueError(
+                    f'Filter field {field} not found in the dataset columns: '
+                    f'{self.dataset.column_names}',
+                )
+            if isinstance(self.dataset, VirtualDataset):
+                column = self.dataset.column(field).combine_chunks()
+            else:
+                column = self.dataset.data.column(field).combine_chunks()
+            encoded = column.dictionary_encode()
+            codes = encoded.indices.fill_null(-1)
+            values = encoded.dictionary.to_pylist()
+            self.filter_index[field] = (
+                {value: code for code, value in enumerate(values)},
+                codes.to_numpy(zero_copy_only=False),
+            )
 
-        # Check if the dataset is chunked
-        if self.dataset_chunk_paths is None:
-            embeddings = quantize_dataset(self.dataset_dir, self.precision)
+    def _filter_mask(self, filters: dict[str, Any]) -> np.ndarray:
+        """Get the mask of the documents matching the metadata filters.
+
+        Parameters
+        ----------
+        filters : dict[str, Any]
+            Maps each filter field to an allowed value or a list of allowed
+            values. A document matches if it has one of the allowed values
+            for every field.
 
+        Returns
+        -------
+        np.ndarray
+            The boolean mask of the matching documents.
+
+        Raises
+        ------
+        ValueError
+            If a field is not one of the filter fields.
+        """
+        mask = np.ones(len(self.dataset), dtype=bool)
+        for field, values in filters.items():
+            if field not in self.filter_index:
+                raise ValueError(
+                    f'Cannot filter on {field}, available filter fields: '
+                    f'{self.filter_fields}',
+                )
+            lookup, codes = self.filter_index[field]
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]  # noqa: PLW2901
+            value_codes = [lookup[v] for v in values if v in lookup]
+            mask &= np.isin(codes, value_codes)
+
+        return mask
+
+    def _write_index(
+        self,
+        index: faiss.Index,
+        path: Path | None = None,
+    ) -> None:
+        """Atomically write the FAISS index to disk."""
+        path = path or self.faiss_index_path
+        tmp_path = f'{path}.tmp'
+        if self.precision in ('float32', 'uint8'):
+            faiss.write_index(index, tmp_path)
         else:
-            # Quantize the embeddings in each dataset chunk in parallel
-            quantized_embeddings = []
-            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
-                for x in tqdm(
-                    executor.map(func, self.dataset_chunk_paths),
-                    desc='Quantizing embeddings',
-                ):
-                    quantized_embeddings.append(x)
-
-            # Concatenate the quantized embeddings
-            embeddings = np.concatenate(quantized_embeddings)
+            faiss.write_index_binary(index, tmp_path)
+        os.replace(tmp_path, path)
 
-        print(
-            f'Creating {self.precision} FAISS index using '
-            f'{self.search_algorithm} search with embeddings '
-            f'shape: {embeddings.shape}',
+    def _ivf_index(self) -> Any:
+        """Get the (possibly ID-mapped) IVF index."""
+        if self.precision in ('float32', 'uint8'):
+            return faiss.extract_index_ivf(self.faiss_index)
+        index = self.faiss_index
+        if isinstance(index, faiss.IndexBinaryIDMap2):
+            index = faiss.downcast_IndexBinary(index.index)
+        return index
+
+    def _check_id_map(self, operation: str) -> None:
+        """Check that the loaded FAISS index is ID-mapped (or IVF)."""
+        if not isinstance(
+            self.faiss_index,
+            (
+                faiss.IndexIDMap2,
+                faiss.IndexBinaryIDMap2,
+                faiss.IndexIVF,
+                faiss.IndexBinaryIVF,
+            ),
+        ):
+            raise ValueError(
+                f'Cannot {operation} documents: the FAISS index at '
+                f'{self.faiss_index_path} is not ID-mapped. Rebuild '
+                'it with id_map=True.',
+            )
+
+    def append(self, dataset_dirs: list[Path]) -> list[int]:
+        """Append new dataset shards to the index without a rebuild.
+
+        Parameters
+        ----------
+        dataset_dirs : list[Path]
+            The HF dataset directories containing the document text and
+            fp32 embeddings of the new documents.
+
+        Returns
+        -------
+        list[int]
+            The corpus indices assigned to the new documents.
+
+        Raises
+        ------
+        ValueError
+            If the FAISS index is not ID-mapped.
+        """
+        self._check_id_map('append')
+
+        new_indices: list[int] = []
+        for dataset_dir in dataset_dirs:
+            shard = Dataset.load_from_disk(str(dataset_dir))
+            embeddings = quantize_dataset(dataset_dir, self.precision)
+
+            # New documents are numbered after every existing row, including
+            # tombstoned ones, so existing corpus indices never change
+            ids = np.arange(
+                len(self.dataset),
+                len(self.dataset) + len(shard),
+                dtype=np.int64,
+            )
+            self.faiss_index.add_with_ids(embeddings, ids)
+
+            # Write the rescoring sidecar for the new shard
+            if self.rescore_sidecar is not None:
+                sidecar_path = self._appended_sidecar_path(
+                    len(self.appended_dirs),
+                )
+                RescoreSidecar.write(
+                    sidecar_path,
+                    [dataset_dir],
+                    dtype=self.rescore_dtype,
+                )
+                self.rescore_sidecar.append(sidecar_path)
+
+            if isinstance(self.dataset, VirtualDataset):
+                self.dataset.append(dataset_dir, len(shard))
+            else:
+                self.dataset = concatenate_datasets([self.dataset, shard])
+            self.appended_dirs.append(dataset_dir)
+            new_indices.extend(ids.tolist())
+
+        print(f'Appended {len(new_indices)} documents to the FAISS index')
+
+        # Encode the metadata of the new documents
+        self._build_filter_index()
+
+        # Persist the index before recording the appended shards
+        self._write_index(self.faiss_index)
+        self._save_updates()
+
+        return new_indices
+
+    def delete(self, indices: list[int]) -> None:
+        """Tombstone documents so that they are excluded from search.
+
+        Parameters
+        ----------
+        indices : list[int]
+            The corpus indices of the documents to delete.
+        """
+        self.tombstones = np.union1d(
+            self.tombstones,
+            np.asarray(indices, dtype=np.int64),
+        )
+        self._save_updates()
+
+    def compact(self) -> int:
+        """Remove the tombstoned documents from the FAISS index.
+
+        The document rows remain in the dataset shards so that the corpus
+        indices of the remaining documents do not change.
+
+        Returns
+        -------
+        int
+            The number of vectors removed from the index.
+
+        Raises
+        ------
+        ValueError
+            If the FAISS index is not ID-mapped, uses HNSW search, which
+            does not support removing vectors, or is an IVF index wrapped
+            in an IndexIDMap2, which cannot remove vectors from it.
+        """
+        self._check_id_map('compact')
+        if self.search_algorithm == 'hnsw':
+            raise ValueError(
+                'HNSW indexes do not support removing vectors, '
+                'rebuild the index instead.',
+            )
+        if self.search_algorithm == 'ivf' and isinstance(
+            self.faiss_index,
+            (faiss.IndexIDMap2, faiss.IndexBinaryIDMap2),
+        ):
+            raise ValueError(
+                'IVF indexes wrapped in an IndexIDMap2 do not support '
+                'removing vectors, rebuild the index instead.',
+            )
+
+        # Remove the tombstoned vectors from the index
+        num_removed = self.faiss_index.remove_ids(
+            faiss.IDSelectorBatch(self.tombstones),
         )
+        self.tombstones = np.empty(0, dtype=np.int64)
+
+        print(f'Removed {num_removed} vectors from the FAISS index')
+
+        # Persist the index before clearing the tombstones
+        self._write_index(self.faiss_index)
+        self._save_updates()
+
+        return num_removed
 
+    def _load_index_from_disk(
+        self,
+        path: Path | None = None,
+    ) -> faiss.Index:
+        """Load the FAISS index from disk."""
+        path = path or self.faiss_index_path
+        if self.precision in ('float32', 'uint8'):
+            return faiss.read_index(str(path))
+        else:
+            return faiss.read_index_binary(str(path))
+
+    def _new_index(self, dim: int) -> faiss.Index:
+        """Create the FAISS index of the precision and search algorithm.
+
+        Parameters
+        ----------
+        dim : int
+            The dimension of the quantized embeddings (in bytes for
+            'ubinary' embeddings).
+
+        Returns
+        -------
+        faiss.Index
+            The empty (untrained) FAISS index.
+        """
         # Build the FAISS index (logic borrowed from
         # sentence_transformers.quantization.semantic_search_faiss)
         if self.precision in ('float32', 'uint8'):
             if self.search_algorithm == 'exact':
                 # Use the inner product similarity for float32
-                index = faiss.IndexFlatIP(embeddings.shape[1])
-            else:
+                return faiss.IndexFlatIP(dim)
+            if self.search_algorithm == 'hnsw':
                 # Use the HNSW algorithm for approximate search
-                index = faiss.IndexHNSWFlat(embeddings.shape[1], 16)
+                return faiss.IndexHNSWFlat(dim, 16)
+            # Use the inverted file algorithm for approximate search
+            return faiss.IndexIVFFlat(
+                faiss.IndexFlatIP(dim),
+                dim,
+                self.nlist,
+                faiss.METRIC_INNER_PRODUCT,
+            )
 
-        elif self.precision == 'ubinary':
+        if self.precision == 'ubinary':
             if self.search_algorithm == 'exact':
                 # Use exact search with the binary index
-                index = faiss.IndexBinaryFlat(embeddings.shape[1] * 8)
-            else:
+                return faiss.IndexBinaryFlat(dim * 8)
+            if self.search_algorithm == 'hnsw':
                 # Use the HNSW algorithm for approximate search
-                index = faiss.IndexBinaryHNSW(embeddings.shape[1] * 8, 16)
-        else:
-            raise ValueError(f'Invalid precision {self.precision}')
+                return faiss.IndexBinaryHNSW(dim * 8, 16)
+            # Use the inverted file algorithm for approximate search
+            return faiss.IndexBinaryIVF(
+                faiss.IndexBinaryFlat(dim * 8),
+                dim * 8,
+                self.nlist,
+            )
 
-        # Add the embeddings to the index
-        index.add(embeddings)
+        raise ValueError(f'Invalid precision {self.precision}')
+
+    def _create_empty_index(self, dataset_paths: list[Path]) -> faiss.Index:
+        """Create the empty (trained) FAISS index."""
+        # Quantize a sample of the corpus to find the index dimension
+        # (and train the IVF clusters)
+        num_samples = 1
+        if self.search_algorithm == 'ivf':
+            num_samples = self.ivf_train_size
+        sample = quantize_embeddings(
+            sample_embeddings(dataset_paths, num_samples),
+            precision=self.precision,
+        )
 
-        print('Writing the index to disk...')
+        # Build the FAISS index
+        index = self._new_index(sample.shape[1])
+
+        # Train the IVF clusters on the sample
+        if self.search_algorithm == 'ivf':
+            print(f'Training {self.nlist} IVF clusters on {len(sample)} rows')
+            index.train(sample)
+
+        # Wrap the index so documents can be appended and removed by id.
+        # IVF indexes store the ids of their vectors natively (IndexIDMap2
+        # assumes that removing vectors renumbers the remaining ones, which
+        # IVF indexes do not, so it would corrupt the id mapping)
+        if self.id_map and self.search_algorithm != 'ivf':
+            if self.precision in ('float32', 'uint8'):
+                index = faiss.IndexIDMap2(index)
+            else:
+                index = faiss.IndexBinaryIDMap2(index)
 
-        # Save the index to disk
-        if self.precision in ('float32', 'uint8'):
-            faiss.write_index(index, str(self.faiss_index_path))
+        return index
+
+    def _quantize_batches(
+        self,
+        batches: Iterator[np.ndarray],
+    ) -> Iterator[np.ndarray]:
+        """Quantize the batches ahead of the index in a bounded pool."""
+        func = functools.partial(quantize_embeddings, precision=self.precision)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            # Keep at most num_workers batches in flight to bound the memory
+            futures: deque = deque()
+            for batch in batches:
+                futures.append(executor.submit(func, batch))
+                if len(futures) >= self.num_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def _create_index(self) -> faiss.Index:
+        """Stream the dataset embeddings into a new FAISS index."""
+        dataset_paths = self._dataset_paths()
+        partial_path = Path(f'{self.faiss_index_path}.partial')
+
+        # Resume a crashed build from the last checkpoint, the partial
+        # index is written atomically so its size is the resume point
+        if partial_path.exists():
+            index = self._load_index_from_disk(partial_path)
+            num_added = index.ntotal
+            print(f'Resuming FAISS index build after {num_added} embeddings')
         else:
-            faiss.write_index_binary(index, str(self.faiss_index_path))
+            num_added = 0
+            index = self._create_empty_index(dataset_paths)
+
+        print(
+            f'Creating {self.precision} FAISS index using '
+            f'{self.search_algorithm} search',
+        )
+
+        # Stream the quantized embeddings into the index
+        batches = iter_embedding_batches(
+            dataset_paths,
+            self.build_batch_size,
+            skip=num_added,
+        )
+        last_checkpoint = num_added
+        for embeddings in tqdm(
+            self._quantize_batches(batches),
+            desc='Adding embeddings',
+        ):
+            if self.id_map:
+                ids = np.arange(
+                    num_added,
+                    num_added + len(embeddings),
+                    dtype=np.int64,
+                )
+                index.add_with_ids(embeddings, ids)
+            else:
+                index.add(embeddings)
+            num_added += len(embeddings)
+
+            # Checkpoint the partial index
+            if (
+                self.checkpoint_interval
+                and num_added - last_checkpoint >= self.checkpoint_interval
+            ):
+                self._write_index(index, partial_path)
+                last_checkpoint = num_added
+
+        print(f'Writing the index with {num_added} embeddings to disk...')
+
+        # Save the index to disk and clean up the checkpoint
+        self._write_index(index)
+        partial_path.unlink(missing_ok=True)
 
         return index
 
@@ -286,6 +1271,7 @@ class FaissIndexV2:
         query_embedding: np.ndarray,
         top_k: int = 1,
         score_threshold: float = 0.0,
+        filters: dict[str, Any] | None = None,
     ) -> BatchedSearchResults:
         """Search for the top k similar texts in the dataset.
 
@@ -298,6 +1284,9 @@ class FaissIndexV2:
         score_threshold : float
             The score threshold to use for filtering out results,
             by default we keep everything 0.0.
+        filters : dict[str, Any], optional
+            Maps filter fields to an allowed value or a list of allowed
+            values, only matching documents are searched, by default None.
 
         Returns
         -------
@@ -312,26 +1301,24 @@ class FaissIndexV2:
         # faiss.normalize_L2(query_embeddings)
 
         t_start = time.perf_counter()
+
+        # Binary indexes are rescored from the memory-mapped sidecar
+        if self.rescore_sidecar is not None:
+            results = self._search_binary(query_embedding, top_k, filters)
+            print(f'Search time: {time.perf_counter() - t_start:.6f} seconds')
+            return self._filter_search_by_score(results, score_threshold)
+
         # Search the index for the top k similar results
-        # The list of search results is in the format:
-        # [[{"corpus_id": int, "score": float}, ...], ...]
-        results, *_ = semantic_search_faiss(
-            query_embedding,
-            corpus_index=self.faiss_index,
-            corpus_precision=self.precision,
-            top_k=10,
-            rescore=self.precision != 'float32',
-            rescore_multiplier=self.rescore_multiplier,
-            exact=self.search_algorithm == 'exact',
-        )
+        scores, indices = self._search_index(query_embedding, top_k, filters)
 
         print(f'Search time: {time.perf_counter() - t_start:.6f} seconds')
-        print(f'Retrieved {len(results)} results')
+        print(f'Retrieved {len(indices)} results')
 
-        # Convert the search results to a BatchedSearchResults object
+        # Convert the search results to a BatchedSearchResults object,
+        # FAISS pads short result sets with index -1
         results = BatchedSearchResults(
-            total_scores=[[r['score'] for r in res] for res in results],
-            total_indices=[[r['corpus_id'] for r in res] for res in results],
+            total_scores=[s[i >= 0].tolist() for s, i in zip(scores, indices)],
+            total_indices=[i[i >= 0].tolist() for i in indices],
         )
 
         # Filter out results with the score threshold
@@ -339,6 +1326,150 @@ class FaissIndexV2:
 
         return results
 
+    def _search_binary(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int,
+        filters: dict[str, Any] | None = None,
+    ) -> BatchedSearchResults:
+        """Search the binary index and rescore with the sidecar.
+
+        Parameters
+        ----------
+        query_embedding : np.ndarray
+            The fp32 query embeddings.
+        top_k : int
+            The number of top results to return.
+        filters : dict[str, Any], optional
+            The metadata filters, by default None.
+
+        Returns
+        -------
+        BatchedSearchResults
+            The rescored search results.
+        """
+        assert self.rescore_sidecar is not None
+
+        # Search the binary index with the quantized queries for
+        # `top_k * rescore_multiplier` candidates
+        query_binary = quantize_embeddings(
+            query_embedding,
+            precision='ubinary',
+        )
+        _, candidates = self._search_index(
+            query_binary,
+            top_k * self.rescore_multiplier,
+            filters,
+        )
+
+        # Rescore the candidates with the fp32 queries
+        return self.rescore_sidecar.rescore(query_embedding, candidates, top_k)
+
+    def _search_index(
+        self,
+        queries: np.ndarray,
+        k: int,
+        filters: dict[str, Any] | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Search the FAISS index, skipping tombstoned and filtered documents.
+
+        Parameters
+        ----------
+        queries : np.ndarray
+            The (quantized) query embeddings.
+        k : int
+            The number of results to return for each query.
+        filters : dict[str, Any], optional
+            The metadata filters, by default None.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The scores and corpus indices (shape: [num_queries, k]),
+            padded with index -1 if fewer than k documents match.
+        """
+        # Build the mask of the documents matching the filters
+        mask = None
+        if filters:
+            mask = self._filter_mask(filters)
+            mask[self.tombstones] = False
+        elif not len(self.tombstones):
+            return self.faiss_index.search(queries, k)
+
+        # Binary HNSW and IVF indexes do not accept search parameters,
+        # so we over-fetch and drop the excluded documents afterwards
+        if self.precision == 'ubinary' and self.search_algorithm != 'exact':
+            if mask is None:
+                mask = np.ones(len(self.dataset), dtype=bool)
+                mask[self.tombstones] = False
+            return self._search_post_filtered(queries, k, mask)
+
+        # Exclude the tombstoned (and filtered) documents inside the search
+        if mask is None:
+            selector = faiss.IDSelectorNot(
+                faiss.IDSelectorBatch(self.tombstones),
+            )
+        else:
+            # The bitmap must outlive the search, FAISS does not copy it
+            bitmap = np.packbits(mask, bitorder='little')
+            selector = faiss.IDSelectorBitmap(
+                len(mask),
+                faiss.swig_ptr(bitmap),
+            )
+        if self.search_algorithm == 'ivf':
+            # IVF indexes require IVF search parameters
+            params = faiss.SearchParametersIVF(
+                sel=selector,
+                nprobe=self.nprobe,
+            )
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        return self.faiss_index.search(queries, k, params=params)
+
+    def _search_post_filtered(
+        self,
+        queries: np.ndarray,
+        k: int,
+        mask: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Over-fetch from the FAISS index and keep the allowed documents.
+
+        Parameters
+        ----------
+        queries : np.ndarray
+            The (quantized) query embeddings.
+        k : int
+            The number of results to return for each query.
+        mask : np.ndarray
+            The boolean mask of the allowed documents.
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            The scores and corpus indices (shape: [num_queries, k]),
+            padded with index -1 if fewer than k documents match.
+        """
+        # Grow the number of fetched results until every query has k
+        # allowed documents (or the whole index has been fetched)
+        num_excluded = len(mask) - np.count_nonzero(mask)
+        fetch = min(k + min(num_excluded, k), self.faiss_index.ntotal)
+        while True:
+            scores, indices = self.faiss_index.search(queries, fetch)
+            allowed = (indices >= 0) & mask[indices]
+            if (
+                fetch >= self.faiss_index.ntotal
+                or allowed.sum(axis=1).min() >= k
+            ):
+                break
+            fetch = min(4 * fetch, self.faiss_index.ntotal)
+
+        # Move the allowed results to the front of each row
+        indices[~allowed] = -1
+        order = np.argsort(~allowed, axis=1, kind='stable')[:, :k]
+        scores = np.take_along_axis(scores, order, axis=1)
+        indices = np.take_along_axis(indices, order, axis=1)
+        return scores, indices
+
     def _filter_search_by_score(
         self,
         results: BatchedSearchResults,
@@ -400,7 +1531,10 @@ class FaissIndexV2:
         Dataset
             The dataset for the given indices.
         """
-        return [self.dataset[i][key] for i in indices]
+        # Only read the key column of the rows
+        if isinstance(self.dataset, VirtualDataset):
+            return self.dataset.get(indices, key)
+        return self.dataset.select_columns([key])[list(indices)][key]
 
     def check_key_exists(self, key: str) -> bool:
         """Check if the key exists in the dataset.
@@ -417,6 +1551,268 @@ class FaissIndexV2:
         """
         return key in self.dataset.column_names
 
+
+class ShardedFaissIndexConfig(BaseConfig):
+    """Configuration for the sharded FAISS index."""
+
+    name: Literal['faiss_index_sharded'] = 'faiss_index_sharded'  # type: ignore[assignment]
+
+    dataset_chunk_paths: list[Path] = Field(
+        ...,
+        description='The paths to the dataset chunks, each containing an '
+        'HF dataset with the document text and fp32 embeddings. Each '
+        'chunk is indexed as a separate shard.',
+    )
+    faiss_index_dir: Path = Field(
+        ...,
+        description='The directory to store the FAISS index of each shard.',
+    )
+    precision: str = Field(
+        default='float32',
+        description='The desired precision for the embeddings '
+        '[float32, ubinary].',
+    )
+    search_algorithm: str = Field(
+        default='exact',
+        description='The desired search algorithm [exact, hnsw].',
+    )
+    rescore_multiplier: int = Field(
+        default=2,
+        description='Oversampling factor for rescoring.',
+    )
+    rescore_dtype: str = Field(
+        default='float16',
+        description='The precision of the rescoring sidecar '
+        '[float16, float32].',
+    )
+    num_search_workers: int = Field(
+        default=4,
+        description='The number of threads used to search the shards.',
+    )
+    filter_fields: list[str] | None = Field(
+        default=None,
+        description='The metadata columns of the dataset (e.g., path) that '
+        'searches can be filtered on.',
+    )
+
+
+class ShardedFaissIndex:
+    """FAISS index with one FaissIndexV2 shard per dataset chunk.
+
+    Each dataset chunk keeps its own FAISS index (and rescoring sidecar for
+    'ubinary' precision) so the corpus never needs to be concatenated into
+    a single contiguous array. Queries are searched against every shard in
+    a thread pool (FAISS releases the GIL during search), and the per-shard
+    top-k results are merged by score.
+
+    Corpus indices are global: the rows of the first chunk come first,
+    followed by the rows of the second chunk, and so on.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        dataset_chunk_paths: list[Path],
+        faiss_index_dir: Path,
+        precision: str = 'float32',
+        search_algorithm: str = 'exact',
+        rescore_multiplier: int = 2,
+        rescore_dtype: str = 'float16',
+        num_search_workers: int = 4,
+        filter_fields: list[str] | None = None,
+    ) -> None:
+        """Initialize the sharded FAISS index.
+
+        Parameters
+        ----------
+        dataset_chunk_paths : list[Path]
+            The paths to the dataset chunks, each containing an HF dataset
+            with the document text and fp32 embeddings. Each chunk is
+            indexed as a separate shard.
+        faiss_index_dir : Path
+            The directory to store the FAISS index of each shard. Missing
+            shard indexes will be created and saved to this directory.
+        precision : str, optional
+            The desired precision for the embeddings, by default 'float32'.
+            Supported options are 'float32' and 'ubinary'.
+        search_algorithm : str, optional
+            Whether to use exact search or approximate FAISS search,
+            by default 'exact'. Supported options are 'exact' and 'hnsw'.
+        rescore_multiplier : int, optional
+            Oversampling factor for rescoring, by default 2.
+        rescore_dtype : str, optional
+            The precision of the rescoring sidecars, by default 'float16'.
+        num_search_workers : int, optional
+            The number of threads used to search the shards, by default 4.
+        filter_fields : list[str], optional
+            The metadata columns of the dataset (e.g., path) that searches
+            can be filtered on, by default None.
+        """
+        self.dataset_chunk_paths = dataset_chunk_paths
+        self.faiss_index_dir = faiss_index_dir
+        self.num_search_workers = num_search_workers
+
+        # The thread pool used to search the shards of every query
+        self.search_pool = ThreadPoolExecutor(max_workers=num_search_workers)
+
+        # Create the index directory if it does not exist
+        self.faiss_index_dir.mkdir(parents=True, exist_ok=True)
+
+        # Load (or create) the index of each shard
+        self.shards = [
+            FaissIndexV2(
+                dataset_dir=chunk_path,
+                faiss_index_path=self.faiss_index_dir / f'shard-{i:04}.index',
+                precision=precision,
+                search_algorithm=search_algorithm,
+                rescore_multiplier=rescore_multiplier,
+                rescore_dtype=rescore_dtype,
+                filter_fields=filter_fields,
+            )
+            for i, chunk_path in enumerate(self.dataset_chunk_paths)
+        ]
+
+        # The global index of the first row of each shard
+        self.offsets = np.cumsum(
+            [0] + [len(shard.dataset) for shard in self.shards],
+        )
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        """Transform the embeddings according to the FAISS strategy.
+
+        Parameters
+        ----------
+        embeddings : np.ndarray
+            The embeddings to transform.
+
+        Returns
+        -------
+        np.ndarray
+            The transformed embeddings.
+        """
+        # Normalize the embeddings for inner product search
+        faiss.normalize_L2(embeddings)
+
+        return embeddings
+
+    def search(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int = 1,
+        score_threshold: float = 0.0,
+        filters: dict[str, Any] | None = None,
+    ) -> BatchedSearchResults:
+        """Search every shard and merge the top k results by score.
+
+        Parameters
+        ----------
+        query_embedding : np.ndarray
+            The query embedding, shape (num_queries, embedding_size).
+        top_k : int
+            The number of top results to return, by default 1.
+        score_threshold : float
+            The score threshold to use for filtering out results,
+            by default 0.0.
+        filters : dict[str, Any], optional
+            Maps filter fields to an allowed value or a list of allowed
+            values, only matching documents are searched, by default None.
+
+        Returns
+        -------
+        BatchedSearchResults
+            A namedtuple with list[list[float]] (.total_scores) of scores for
+            each  of the top_k returned items and a list[list[int]]]
+            (.total_indices) of global indices for each of the top_k
+            returned items for each query.
+        """
+        t_start = time.perf_counter()
+
+        # Search the shards in parallel
+        shard_results = list(
+            self.search_pool.map(
+                lambda shard: shard.search(
+                    query_embedding,
+                    top_k=top_k,
+                    score_threshold=score_threshold,
+                    filters=filters,
+                ),
+                self.shards,
+            ),
+        )
+
+        # Merge the per-shard results of each query
+        total_scores, total_indices = [], []
+        for query_idx in range(len(query_embedding)):
+            scores, indices = [], []
+            for offset, results in zip(self.offsets, shard_results):
+                scores.extend(results.total_scores[query_idx])
+                # Map the shard-local indices to global indices
+                indices.extend(
+                    int(offset) + i for i in results.total_indices[query_idx]
+                )
+
+            # Keep the top k results across all the shards
+            order = np.argsort(scores, kind='stable')[::-1][:top_k]
+            total_scores.append([float(scores[i]) for i in order])
+            total_indices.append([indices[i] for i in order])
+
+        print(
+            f'Sharded search time ({len(self.shards)} shards): '
+            f'{time.perf_counter() - t_start:.6f} seconds',
+        )
+
+        return BatchedSearchResults(
+            total_scores=total_scores,
+            total_indices=total_indices,
+        )
+
+    def get(self, indices: list[int], key: str) -> list[Any]:
+        """Get the values of a key from the dataset for the given indices.
+
+        Parameters
+        ----------
+        indices : list[int]
+            The list of global indices to get.
+        key : str
+            The key to get from the dataset.
+
+        Returns
+        -------
+        list[Any]
+            The values of the key for the given indices.
+        """
+        # Find the shard containing each global index
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+
+        # Read the key column of the rows of each shard, in the input order
+        values: list[Any] = [None] * len(indices)
+        for shard_id in np.unique(shard_ids):
+            positions = np.flatnonzero(shard_ids == shard_id)
+            local_indices = indices[positions] - self.offsets[shard_id]
+            shard_values = self.shards[shard_id].get(
+                local_indices.tolist(),
+                key,
+            )
+            for position, value in zip(positions, shard_values):
+                values[position] = value
+        return values
+
+    def check_key_exists(self, key: str) -> bool:
+        """Check if the key exists in the dataset.
+
+        Parameters
+        ----------
+        key : str
+            The key to check.
+
+        Returns
+        -------
+        bool
+            True if the key exists, False otherwise.
+        """
+        return key in self.shards[0].dataset.column_names
+
+
 class FaissIndexBrcConfig(BaseConfig):
     """Configuration for the BRC FAISS index."""
 
@@ -734,7 +2130,9 @@ class FaissIndexV1:
 class RetrieverConfig(BaseConfig):
     """Configuration for the retriever."""
 
-    faiss_config: FaissIndexV1Config | FaissIndexV2Config = Field(
+    faiss_config: (
+        FaissIndexV1Config | FaissIndexV2Config | ShardedFaissIndexConfig
+    ) = Field(
         ...,
         description='Settings for the faiss index',
     )
@@ -766,6 +2164,8 @@ class RetrieverConfig(BaseConfig):
             faiss_index = FaissIndexV1(**faiss_kwargs)
         elif self.faiss_config.name == 'faiss_brc':
             faiss_index = FaissIndexBrc(**faiss_kwargs)
+        elif self.faiss_config.name == 'faiss_index_sharded':
+            faiss_index = ShardedFaissIndex(**faiss_kwargs)
         else:
             faiss_index = FaissIndexV2(**faiss_kwargs)  # type: ignore[assignment]
 
@@ -781,24 +2181,39 @@ class RetrieverConfig(BaseConfig):
 class RemoteRetrieverConfig(BaseConfig):
     """Configuration for the retriever."""
 
-    faiss_config: FaissIndexV2Config | FaissIndexBrcConfig = Field(
+    faiss_config: (
+        FaissIndexV2Config | ShardedFaissIndexConfig | FaissIndexBrcConfig
+    ) = Field(
         ...,
         description='Settings for the faiss index',
     )
+    query_encoder_config: QueryEncoderConfig | None = Field(
+        None,
+        description='Settings for a warm in-process query encoder, by '
+        'default None, in which case the queries are embedded by the '
+        'remote embedding service.',
+    )
 
     def get_retriever(self) -> Retriever:
         """Get the retriever."""
+        # Get the warm query encoder, if the queries are embedded locally
+        query_encoder = None
+        if self.query_encoder_config is not None:
+            query_encoder = self.query_encoder_config.get_query_encoder()
 
         faiss_kwargs = self.faiss_config.model_dump(exclude={'name'})
         if self.faiss_config.name == 'faiss_index_v1':
             faiss_index = FaissIndexV1(**faiss_kwargs)
         elif self.faiss_config.name == 'faiss_brc':
             faiss_index = FaissIndexBrc(**faiss_kwargs)
+        elif self.faiss_config.name == 'faiss_index_sharded':
+            faiss_index = ShardedFaissIndex(**faiss_kwargs)
         else:
             faiss_index = FaissIndexV2(**faiss_kwargs)  # type: ignore[assignment]
 
         retriever = RemoteRetriever(
-            faiss_index=faiss_index
+            faiss_index=faiss_index,
+            query_encoder=query_encoder,
         )
 
         return retriever
@@ -806,15 +2221,31 @@ class RemoteRetrieverConfig(BaseConfig):
 class RemoteRetriever:
     """Remote retriever for semantic similarity search."""
 
-    def __init__(self, faiss_index: FaissIndexV2) -> None:
+    def __init__(
+        self,
+        faiss_index: FaissIndexV2,
+        query_encoder: QueryEncoder | None = None,
+    ) -> None:
+        """Initialize the RemoteRetriever.
+
+        Parameters
+        ----------
+        faiss_index : FaissIndexV2
+            The FAISS index instance to use for searching.
+        query_encoder : QueryEncoder, optional
+            A warm in-process query encoder, by default None, in which
+            case the queries are embedded by the remote embedding service.
+        """
         self.faiss_index = faiss_index
+        self.query_encoder = query_encoder
 
-    def search(
+    def search(  # noqa: PLR0913
         self,
         query: str | list[str] | None = None,
         query_embedding: np.ndarray | None = None,
         top_k: int = 1,
         score_threshold: float = 0.0,
+        filters: dict[str, Any] | None = None,
     ) -> tuple[BatchedSearchResults, np.ndarray]:
             # Check whether arguments are valid
         if query is None and query_embedding is None:
@@ -825,11 +2256,14 @@ class RemoteRetriever:
         if query_embedding is None:
             assert query is not None
             query_embedding = self.get_pooled_embeddings(query)
-        # Search the dataset for the top k similar results
+        # Search the dataset for the top k similar results, only
+        # FaissIndexV2 and ShardedFaissIndex support metadata filters
+        search_kwargs = {'filters': filters} if filters else {}
         results = self.faiss_index.search(
             query_embedding=query_embedding,
             top_k=top_k,
             score_threshold=score_threshold,
+            **search_kwargs,
         )
         return results, query_embedding
 
@@ -848,10 +2282,22 @@ class RemoteRetriever:
             (shape: [num_queries, embedding_size])
         """
         # Convert the query to a list if it is a single string
-
         if isinstance(query, str):
             query = [query]
 
+        # Embed the queries in process, or with the remote service
+        if self.query_encoder is not None:
+            pool_embeds = self.query_encoder.encode(query)
+        else:
+            pool_embeds = self._remote_embeddings(query)
+
+        # Transform the embeddings according to the faiss strategy
+        pool_embeds = self.faiss_index.transform(pool_embeds)
+
+        return pool_embeds
+
+    def _remote_embeddings(self, query: list[str]) -> np.ndarray:
+        """Embed the queries with the remote embedding service."""
         # Load config from file relative to this module's location
         config_path = Path(__file__).parent.parent / 'config.json'
         print('config_path', config_path)
@@ -881,12 +2327,7 @@ class RemoteRetriever:
             embeddings.append(data.get("embedding", []))
         
         # Convert to numpy array
-        pool_embeds = np.array(embeddings, dtype=np.float32)
-
-        # Transform the embeddings according to the faiss strategy
-        pool_embeds = self.faiss_index.transform(pool_embeds)
-
-        return pool_embeds
+        return np.array(embeddings, dtype=np.float32)
 
     def get(self, indices: list[int], key: str) -> list[Any]:
         """Get the values of a key from the dataset for the given indices.
@@ -918,7 +2359,7 @@ class RemoteRetriever:
         np.ndarray
             Array of embeddings (shape: [num_indices, embed_size])
         """
-        return np.array(self.get(indices, 'embeddings'))
+        return upcast_embeddings(np.array(self.get(indices, 'embeddings')))
 
     def get_texts(self, indices: list[int]) -> list[str]:
         """Get the texts for the given indices.
@@ -978,12 +2419,16 @@ class Retriever:
         self.faiss_index = faiss_index
         self.batch_size = batch_size
 
-    def search(
+        # Embed the queries with the warm encoder, batching the requests
+        self.query_encoder = QueryEncoder(encoder, pooler, batch_size)
+
+    def search(  # noqa: PLR0913
         self,
         query: str | list[str] | None = None,
         query_embedding: np.ndarray | None = None,
         top_k: int = 1,
         score_threshold: float = 0.0,
+        filters: dict[str, Any] | None = None,
     ) -> tuple[BatchedSearchResults, np.ndarray]:
         """Search for text similar to the queries.
 
@@ -998,6 +2443,9 @@ class Retriever:
         score_threshold : float
             The score threshold to use for filtering out results,
             by default we keep everything 0.0.
+        filters : dict[str, Any], optional
+            Maps filter fields to an allowed value or a list of allowed
+            values, only matching documents are searched, by default None.
 
         Returns
         -------
@@ -1029,10 +2477,13 @@ class Retriever:
 
         # Search the dataset for the top k similar results
         # TODO: Consider how to handle faiss index, this one works on local gpu
+        # Only FaissIndexV2 and ShardedFaissIndex support metadata filters
+        search_kwargs = {'filters': filters} if filters else {}
         results = self.faiss_index.search(
             query_embedding=query_embedding,
             top_k=top_k,
             score_threshold=score_threshold,
+            **search_kwargs,
         )
 
         return results, query_embedding
@@ -1051,11 +2502,8 @@ class Retriever:
             The embeddings of the queries
             (shape: [num_queries, embedding_size])
         """
-        # Convert the query to a list if it is a single string
-        if isinstance(query, str):
-            query = [query]
-
-        # TODO: implement remote embedding
+        # Embed the queries with the warm encoder
+        pool_embeds = self.query_encoder.encode(query)
 
         # TODO: Consider moving this into faiss index internals
         # Transform the embeddings according to the faiss strategy
@@ -1093,7 +2541,7 @@ class Retriever:
         np.ndarray
             Array of embeddings (shape: [num_indices, embed_size])
         """
-        return np.array(self.get(indices, 'embeddings'))
+        return upcast_embeddings(np.array(self.get(indices, 'embeddings')))
 
     def get_texts(self, indices: list[int]) -> list[str]:
         """Get the texts for the given indices.
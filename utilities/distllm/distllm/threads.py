@@ -0,0 +1,104 @@
+"""Per-process thread budget for FAISS, torch and HF tokenizers."""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import sys
+
+# Environment variables read by the native thread pools at import time
+_THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'RAYON_NUM_THREADS',
+)
+
+
+def available_cpus() -> int:
+    """Get the number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is not available on macOS
+        return os.cpu_count() or 1
+
+
+def configure_thread_budget(
+    num_workers: int | None = None,
+    num_threads: int | None = None,
+) -> dict[str, int | str]:
+    """Limit the thread pools of this process to its share of the CPUs.
+
+    FAISS (OpenMP), torch (intra/inter-op pools) and HF tokenizers (Rayon)
+    each default to one thread per core, so several worker processes on one
+    node oversubscribe the CPUs. This splits the CPUs available to the
+    process between the workers on the node. If the CPU affinity of the
+    process is already restricted (e.g., by parsl or taskset) the whole
+    affinity set is used, since it is not shared with the other workers.
+
+    Call it before importing faiss, torch or tokenizers: the environment
+    variables are only read when the libraries are loaded. Libraries that
+    are already imported are configured through their APIs instead.
+    Environment variables that are already set are respected.
+
+    Parameters
+    ----------
+    num_workers : int, optional
+        The number of worker processes sharing the node, by default None,
+        in which case it is read from WEB_CONCURRENCY (gunicorn) or
+        PARSL_WORKER_COUNT (parsl), or 1 otherwise.
+    num_threads : int, optional
+        The number of threads per process, by default None, in which case
+        it is derived from the CPUs and the number of workers.
+
+    Returns
+    -------
+    dict[str, int | str]
+        The resulting thread settings, which are also printed.
+    """
+    # Find the number of workers sharing the node
+    if num_workers is None:
+        num_workers = int(
+            os.environ.get('WEB_CONCURRENCY')
+            or os.environ.get('PARSL_WORKER_COUNT')
+            or 1,
+        )
+
+    # Split the CPUs between the workers unless the affinity is pinned
+    cpus = available_cpus()
+    if num_threads is None:
+        pinned = cpus < (os.cpu_count() or cpus)
+        num_threads = cpus if pinned else cpus // max(num_workers, 1)
+    num_threads = max(num_threads, 1)
+
+    # Configure the native thread pools before they are created
+    for var in _THREAD_ENV_VARS:
+        os.environ.setdefault(var, str(num_threads))
+    os.environ.setdefault(
+        'TOKENIZERS_PARALLELISM',
+        'true' if num_threads > 1 else 'false',
+    )
+
+    # Configure the libraries that are already imported
+    omp_threads = int(os.environ['OMP_NUM_THREADS'])
+    if 'faiss' in sys.modules:
+        sys.modules['faiss'].omp_set_num_threads(omp_threads)
+    if 'torch' in sys.modules:
+        torch = sys.modules['torch']
+        torch.set_num_threads(omp_threads)
+        # The inter-op pool can only be sized before it is first used
+        with contextlib.suppress(RuntimeError):
+            torch.set_num_interop_threads(1)
+
+    budget: dict[str, int | str] = {
+        'cpus': cpus,
+        'workers': num_workers,
+        'threads': num_threads,
+        'omp_num_threads': os.environ['OMP_NUM_THREADS'],
+        'rayon_num_threads': os.environ['RAYON_NUM_THREADS'],
+        'tokenizers_parallelism': os.environ['TOKENIZERS_PARALLELISM'],
+    }
+    print(f'Thread budget (pid {os.getpid()}): {budget}')
+
+    return budget
@@ -2,16 +2,27 @@
 
 from __future__ import annotations
 
+import gzip
+import io
+import itertools
 import json
 import subprocess
 from pathlib import Path
+from typing import Any
+from typing import Iterator
 from typing import Literal
+from typing import TextIO
 from typing import TypeVar
 from typing import Union
 
 import yaml  # type: ignore[import-untyped]
 from pydantic import BaseModel
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore[assignment]
+
 PathLike = Union[str, Path]
 
 T = TypeVar('T')
@@ -142,3 +153,63 @@ def curl_download(data_file: Path, download_url: str) -> None:
     if not data_file.exists():
         command = f'curl -o {data_file} {download_url}'
         subprocess.run(command.split(), check=False)
+
+
+def open_text(path: PathLike) -> TextIO:
+    """Open a text file for reading, decompressing .gz and .zst files.
+
+    Parameters
+    ----------
+    path : PathLike
+        The path to the (optionally compressed) text file.
+
+    Returns
+    -------
+    TextIO
+        The text stream, decompressed on the fly.
+    """
+    path = Path(path)
+    if path.suffix == '.gz':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.suffix == '.zst':
+        import zstandard
+
+        # Frames are concatenated by parallel compressors (e.g., pzstd)
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, 'rb'),  # noqa: SIM115
+            read_across_frames=True,
+            closefd=True,
+        )
+        return io.TextIOWrapper(reader, encoding='utf-8')
+    return open(path, encoding='utf-8')  # noqa: SIM115
+
+
+def iter_jsonl(
+    path: PathLike,
+    num_shards: int = 1,
+    shard_index: int = 0,
+) -> Iterator[dict[str, Any]]:
+    """Lazily parse the records of a (optionally compressed) jsonl file.
+
+    Blank lines are skipped. When sharded, only every `num_shards`-th
+    record starting at `shard_index` is parsed, so that several readers
+    can split the parsing of one file.
+
+    Parameters
+    ----------
+    path : PathLike
+        The path to the jsonl file (.jsonl, .jsonl.gz or .jsonl.zst).
+    num_shards : int, optional
+        The number of readers sharing the file, by default 1.
+    shard_index : int, optional
+        The index of this reader, by default 0.
+
+    Yields
+    ------
+    dict[str, Any]
+        The parsed records, in file order.
+    """
+    with open_text(path) as fp:
+        lines = (line for line in fp if line.strip())
+        for line in itertools.islice(lines, shard_index, None, num_shards):
+            yield json_loads(line)
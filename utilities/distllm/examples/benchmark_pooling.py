@@ -0,0 +1,148 @@
+"""Benchmark the peak memory and time of the mean pooler on CPU.
+
+Compares the `mean` pooler against the previous implementation, which
+expanded the attention mask to the shape of the hidden states (and
+multiplied them, materializing two more tensors of that size) and zeroed
+the start and end tokens in the attention mask of the caller (the
+reference below zeroes the end token of each row, as the pooler does, so
+that the outputs can be compared). Each method runs in a fresh process
+that builds its own random hidden states, so the growth of its peak
+resident memory is the working memory of the pooling alone, e.g.:
+
+    python examples/benchmark_pooling.py --batch_size 8 \
+        --sequence_length 4096 --hidden_size 4096 --dtype bfloat16
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+import torch
+
+from distllm.embed.poolers.mean import average_pool
+
+
+def legacy_average_pool(
+    embeddings: torch.Tensor,
+    attention_mask: torch.Tensor,
+) -> torch.Tensor:
+    """Average pool with an expanded mask, mutating the attention mask."""
+    seq_lengths = attention_mask.sum(axis=1)
+    attention_mask[:, 0] = 0
+    attention_mask[torch.arange(len(attention_mask)), seq_lengths - 1] = 0
+    pool_mask = attention_mask.unsqueeze(-1).expand(embeddings.shape)
+    sum_embeds = torch.sum(embeddings * pool_mask, 1)
+    sum_mask = torch.clamp(pool_mask.sum(1), min=1e-9)
+    return sum_embeds / sum_mask
+
+
+METHODS: dict[str, Callable[[torch.Tensor, torch.Tensor], torch.Tensor]] = {
+    'legacy (expanded mask)': legacy_average_pool,
+    'mean (batched matmul)': average_pool,
+}
+
+
+def max_rss_mb() -> float:
+    """Get the peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(
+    method: str,
+    shape: tuple[int, int, int],
+    dtype: str,
+    num_trials: int,
+) -> tuple[float, float, torch.Tensor, bool]:
+    """Pool random hidden states and measure the pooling.
+
+    Returns the growth of the peak resident memory (MB), the best wall
+    time (s), the pooled embeddings and whether the mask was modified.
+    """
+    # Build the inputs, with a random amount of right padding
+    generator = torch.Generator().manual_seed(0)
+    batch_size, sequence_length, _ = shape
+    embeddings = torch.randn(
+        shape,
+        generator=generator,
+        dtype=getattr(torch, dtype),
+    )
+    lengths = torch.randint(
+        2,
+        sequence_length + 1,
+        (batch_size,),
+        generator=generator,
+    )
+    attention_mask = torch.arange(sequence_length)[None] < lengths[:, None]
+    attention_mask = attention_mask.long()
+    original_mask = attention_mask.clone()
+
+    # Measure the pooling, with a fresh copy of the mask for each trial
+    baseline = max_rss_mb()
+    times = []
+    for _ in range(num_trials):
+        mask = original_mask.clone()
+        start = time.perf_counter()
+        pooled = METHODS[method](embeddings, mask)
+        times.append(time.perf_counter() - start)
+    peak = max_rss_mb() - baseline
+
+    # Check whether the pooling modified the mask
+    METHODS[method](embeddings, attention_mask)
+    mutated = not torch.equal(attention_mask, original_mask)
+
+    return peak, min(times), pooled, mutated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the peak memory and time of mean pooling.',
+    )
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--sequence_length', type=int, default=4096)
+    parser.add_argument('--hidden_size', type=int, default=4096)
+    parser.add_argument(
+        '--dtype',
+        default='float32',
+        choices=['float32', 'float16', 'bfloat16'],
+        help='The precision of the hidden states.',
+    )
+    parser.add_argument(
+        '--num_trials',
+        type=int,
+        default=3,
+        help='The number of timed runs of each method.',
+    )
+    args = parser.parse_args()
+
+    shape = (args.batch_size, args.sequence_length, args.hidden_size)
+    size_mb = torch.empty(0, dtype=getattr(torch, args.dtype)).element_size()
+    size_mb *= args.batch_size * args.sequence_length * args.hidden_size
+    size_mb /= 1024**2
+    print(f'hidden states {shape} {args.dtype}: {size_mb:.0f} MB\n')
+
+    # Run each method in a fresh process to isolate its peak memory
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for method in METHODS:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            future = pool.submit(
+                run,
+                method,
+                shape,
+                args.dtype,
+                args.num_trials,
+            )
+            peak, elapsed, pooled, mutated = future.result()
+        results[method] = pooled
+        print(
+            f'{method:<24} peak +{peak:>8.0f} MB {elapsed:>8.3f} s '
+            f'(mask {"modified" if mutated else "unchanged"})',
+        )
+
+    legacy, pooled = results.values()
+    torch.testing.assert_close(legacy, pooled, atol=1e-3, rtol=1e-3)
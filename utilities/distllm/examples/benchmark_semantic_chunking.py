@@ -0,0 +1,206 @@
+"""Benchmark the CPU-side stages of semantic chunking on a jsonl file.
+
+Times the sentence splitting, buffer construction, buffer distances and
+breakpoint detection of the `jsonl_chunk` dataset and `semantic_chunk`
+embedder against the previous (serial, loop-based) implementations,
+whose outputs are compared in `tests/distllm_test.py`. Run it on a
+realistic nougat file, e.g.:
+
+    python examples/benchmark_semantic_chunking.py \
+        --jsonl_path /path/to/nougat/parsed_pdfs.jsonl --num_workers 8
+
+The buffer embeddings are random, since only the cost of the CPU-side
+computations (not the encoder) is measured.
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+from typing import Callable
+
+import numpy as np
+
+from distllm.embed.datasets.jsonl_chunk import JsonlChunkDataset
+from distllm.embed.datasets.jsonl_chunk import JsonlChunkDatasetConfig
+from distllm.embed.datasets.jsonl_chunk import sentences_to_buffers
+from distllm.embed.embedders.semantic_chunk import build_chunks
+from distllm.embed.embedders.semantic_chunk import (
+    calculate_distances_between_buffer,
+)
+from distllm.utils import iter_jsonl
+
+
+def legacy_sentences_to_buffers(
+    split: list[str],
+    buffer_size: int,
+) -> list[str]:
+    """Group split into buffers by re-joining each window."""
+    buffers = []
+    for i in range(len(split)):
+        combined = ''.join(
+            split[j]
+            for j in range(
+                max(0, i - buffer_size),
+                min(i + 1 + buffer_size, len(split)),
+            )
+        )
+        buffers.append(combined)
+    return buffers
+
+
+def legacy_distances(buffer_embeds: np.ndarray) -> np.ndarray:
+    """Calculate the buffer distances one pair at a time."""
+    embeddings = buffer_embeds.astype(np.float32)
+    distances = np.zeros(len(embeddings) - 1)
+    for i in range(len(embeddings) - 1):
+        embedding_current = embeddings[i]
+        embedding_next = embeddings[i + 1]
+
+        similarity = np.dot(embedding_current, embedding_next) / (
+            np.linalg.norm(embedding_current) * np.linalg.norm(embedding_next)
+        )
+
+        distances[i] = 1 - similarity
+
+    return distances
+
+
+def legacy_build_chunks(
+    distances: np.ndarray,
+    breakpoint_percentile_threshold: int,
+) -> list[tuple[int, int]]:
+    """Build the chunks with a Python loop over the distances."""
+    if len(distances) == 0:
+        return [(0, 0)]
+
+    threshold = np.percentile(distances, breakpoint_percentile_threshold)
+    indices_above_threshold = [
+        i for i, x in enumerate(distances) if x > threshold
+    ]
+
+    start_index = 0
+    index_groups = []
+    for index in indices_above_threshold:
+        index_groups.append((start_index, index + 1))
+        start_index = index + 1
+    index_groups.append((start_index, len(distances) + 1))
+
+    return index_groups
+
+
+def timed(name: str, func: Callable[[], Any]) -> tuple[Any, float]:
+    """Run a function and print its wall time."""
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<40} {elapsed:>10.3f} s')
+    return result, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the CPU-side stages of semantic chunking.',
+    )
+    parser.add_argument(
+        '--jsonl_path',
+        type=Path,
+        required=True,
+        help='A jsonl file with text and path fields (e.g., nougat output).',
+    )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=4,
+        help='The number of processes used to split the documents.',
+    )
+    parser.add_argument(
+        '--buffer_size',
+        type=int,
+        default=1,
+        help='The number of sentences on each side of a buffer.',
+    )
+    parser.add_argument(
+        '--embedding_size',
+        type=int,
+        default=768,
+        help='The size of the (random) buffer embeddings.',
+    )
+    parser.add_argument(
+        '--breakpoint_percentile_threshold',
+        type=int,
+        default=90,
+        help='The percentile of the distances that forms a breakpoint.',
+    )
+    args = parser.parse_args()
+
+    records = list(iter_jsonl(args.jsonl_path))
+    dataset = JsonlChunkDataset(
+        JsonlChunkDatasetConfig(buffer_size=args.buffer_size),
+    )
+    print(f'Loaded {len(records)} documents from {args.jsonl_path}')
+
+    # Sentence splitting, serial vs. across processes
+    serial, t_serial = timed(
+        'split (serial)',
+        lambda: [dataset.splitter(r['text']) for r in records],
+    )
+
+    def parallel_split() -> list[list[str]]:
+        """Split the documents across processes."""
+        texts = [r['text'] for r in records]
+        with ProcessPoolExecutor(args.num_workers) as pool:
+            return list(pool.map(dataset.splitter, texts, chunksize=8))
+
+    parallel, t_parallel = timed(
+        f'split ({args.num_workers} processes)',
+        parallel_split,
+    )
+    assert serial == parallel
+    num_sentences = sum(len(split) for split in serial)
+    print(f'{num_sentences} sentences, speedup {t_serial / t_parallel:.1f}x\n')
+
+    # Buffer construction, re-joined windows vs. prefix-sum slices
+    _, t_legacy = timed(
+        'buffers (join per window)',
+        lambda: [
+            legacy_sentences_to_buffers(s, args.buffer_size) for s in serial
+        ],
+    )
+    _, t_new = timed(
+        'buffers (prefix-sum slices)',
+        lambda: [sentences_to_buffers(s, args.buffer_size) for s in serial],
+    )
+    print(f'speedup {t_legacy / t_new:.1f}x\n')
+
+    # Buffer distances, pairwise loop vs. row-wise dot product
+    rng = np.random.default_rng(0)
+    embeddings = [
+        rng.standard_normal((len(s), args.embedding_size), dtype=np.float32)
+        for s in serial
+        if s
+    ]
+    _, t_legacy = timed(
+        'distances (pairwise loop)',
+        lambda: [legacy_distances(e) for e in embeddings],
+    )
+    distances, t_new = timed(
+        'distances (vectorized)',
+        lambda: [calculate_distances_between_buffer(e) for e in embeddings],
+    )
+    print(f'speedup {t_legacy / t_new:.1f}x\n')
+
+    # Breakpoint detection, Python loop vs. vectorized
+    threshold = args.breakpoint_percentile_threshold
+    _, t_legacy = timed(
+        'build_chunks (loop)',
+        lambda: [legacy_build_chunks(d, threshold) for d in distances],
+    )
+    _, t_new = timed(
+        'build_chunks (vectorized)',
+        lambda: [build_chunks(d, threshold) for d in distances],
+    )
+    print(f'speedup {t_legacy / t_new:.1f}x')
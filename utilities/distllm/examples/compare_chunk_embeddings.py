@@ -0,0 +1,200 @@
+"""Compare encoded and pooled semantic chunk embeddings on a corpus.
+
+The `semantic_chunk` embedder can either re-encode each chunk with the
+model (`chunk_embedding: encode`, exact) or pool the buffer embeddings
+over the span of each chunk (`mean` or `length_weighted_mean`), which
+skips the second encoder pass. This script embeds a jsonl file with each
+mode and reports, per mode:
+
+- the embedding time,
+- the cosine similarity of the pooled and encoded chunk embeddings,
+- the known-item retrieval quality (recall@1, recall@k and MRR) of
+  queries made of the longest sentence of randomly sampled chunks,
+- the overlap of the top-k results with those of the encoded chunks.
+
+For example:
+
+    python examples/compare_chunk_embeddings.py \
+        --jsonl_path /path/to/nougat/parsed_pdfs.jsonl \
+        --pretrained_model_name_or_path pritamdeka/S-PubMedBert-MS-MARCO
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from distllm.embed import get_dataset
+from distllm.embed import get_encoder
+from distllm.embed import get_pooler
+from distllm.embed.datasets.jsonl_chunk import split_by_sentence_tokenizer
+from distllm.embed.datasets.utils import DataCollator
+from distllm.embed.datasets.utils import InMemoryDataset
+from distllm.embed.embedders.full_sequence import compute_embeddings
+from distllm.embed.embedders.semantic_chunk import SemanticChunkEmbedder
+from distllm.embed.embedders.semantic_chunk import SemanticChunkEmbedderConfig
+
+MODES = ('encode', 'mean', 'length_weighted_mean')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare encoded and pooled semantic chunk embeddings.',
+    )
+    parser.add_argument(
+        '--jsonl_path',
+        type=Path,
+        required=True,
+        help='A jsonl file with text and path fields (e.g., nougat output).',
+    )
+    parser.add_argument(
+        '--encoder_name',
+        type=str,
+        default='auto',
+        help='The name of the encoder architecture [auto, esm2].',
+    )
+    parser.add_argument(
+        '--pretrained_model_name_or_path',
+        type=str,
+        required=True,
+        help='The model weights to use for the embeddings.',
+    )
+    parser.add_argument(
+        '--pooler_name',
+        type=str,
+        default='mean',
+        help='The name of the pooler [mean, last_token].',
+    )
+    parser.add_argument(
+        '--buffer_size',
+        type=int,
+        default=1,
+        help='The buffer size to use for semantic chunking.',
+    )
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=8,
+        help='The batch size for the buffers, chunks and queries.',
+    )
+    parser.add_argument(
+        '--num_queries',
+        type=int,
+        default=200,
+        help='The number of chunks sampled to build known-item queries.',
+    )
+    parser.add_argument(
+        '--top_k',
+        type=int,
+        default=10,
+        help='The number of retrieved chunks per query.',
+    )
+    parser.add_argument(
+        '--query_prefix',
+        type=str,
+        default='',
+        help='A prefix for the queries (e.g., an instruction for '
+        'instruction-tuned embedding models).',
+    )
+    parser.add_argument(
+        '--half_precision',
+        action='store_true',
+        help='Use half precision for the model.',
+    )
+    args = parser.parse_args()
+
+    encoder = get_encoder(
+        {
+            'name': args.encoder_name,
+            'pretrained_model_name_or_path': (
+                args.pretrained_model_name_or_path
+            ),
+            'half_precision': args.half_precision,
+            'eval_mode': True,
+        },
+    )
+    pooler = get_pooler({'name': args.pooler_name})
+    dataset = get_dataset(
+        {
+            'name': 'jsonl_chunk',
+            'buffer_size': args.buffer_size,
+            'batch_size': args.batch_size,
+        },
+    )
+
+    # Embed the corpus with each mode (the chunking is deterministic)
+    results, timings = {}, {}
+    for mode in MODES:
+        embedder = SemanticChunkEmbedder(
+            SemanticChunkEmbedderConfig(
+                chunk_batch_size=args.batch_size,
+                normalize_embeddings=True,
+                chunk_embedding=mode,
+            ),
+        )
+        start = time.perf_counter()
+        dataloader = dataset.get_dataloader(args.jsonl_path, encoder)
+        results[mode] = embedder.embed(dataloader, encoder, pooler)
+        timings[mode] = time.perf_counter() - start
+
+    chunks = results['encode'].text
+    assert all(results[mode].text == chunks for mode in MODES)
+    print(f'Embedded {len(chunks)} chunks from {args.jsonl_path}\n')
+
+    # Use the longest sentence of randomly sampled chunks as queries
+    rng = np.random.default_rng(0)
+    targets = rng.choice(
+        len(chunks),
+        size=min(args.num_queries, len(chunks)),
+        replace=False,
+    )
+    splitter = split_by_sentence_tokenizer()
+    queries = [
+        args.query_prefix + max(splitter(chunks[i]), key=len).strip()
+        for i in targets
+    ]
+    query_embeds = compute_embeddings(
+        DataLoader(
+            batch_size=args.batch_size,
+            dataset=InMemoryDataset(queries),
+            collate_fn=DataCollator(encoder.tokenizer),
+        ),
+        encoder,
+        pooler,
+        normalize=True,
+    ).astype(np.float32)
+
+    # Retrieve the chunks of each query with each mode
+    top_k, ranks = {}, {}
+    for mode in MODES:
+        embeddings = results[mode].embeddings.astype(np.float32)
+        scores = query_embeds @ embeddings.T
+        order = np.argsort(-scores, axis=1)
+        top_k[mode] = order[:, : args.top_k]
+        ranks[mode] = np.argmax(order == targets[:, None], axis=1) + 1
+
+    header = (
+        f'{"mode":<22}{"time (s)":>10}{"cos(enc)":>10}{"R@1":>8}'
+        f'{f"R@{args.top_k}":>8}{"MRR":>8}{f"overlap@{args.top_k}":>12}'
+    )
+    print(header)
+    print('-' * len(header))
+    encoded = results['encode'].embeddings.astype(np.float32)
+    for mode in MODES:
+        embeddings = results[mode].embeddings.astype(np.float32)
+        cosine = np.mean(np.sum(embeddings * encoded, axis=1))
+        overlap = np.mean(
+            [
+                len(np.intersect1d(a, b)) / args.top_k
+                for a, b in zip(top_k[mode], top_k['encode'])
+            ],
+        )
+        print(
+            f'{mode:<22}{timings[mode]:>10.2f}{cosine:>10.3f}'
+            f'{np.mean(ranks[mode] == 1):>8.3f}'
+            f'{np.mean(ranks[mode] <= args.top_k):>8.3f}'
+            f'{np.mean(1 / ranks[mode]):>8.3f}{overlap:>12.3f}',
+        )
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import time
 from pathlib import Path
+from typing import Any
 
 
 def test_distllm() -> None:
@@ -46,3 +47,1261 @@ def test_time_logger(capsys, tmp_path) -> None:  # type: ignore[no-untyped-def]
     assert len(df) == num_rows
     print(df.keys())
     assert list(df.keys()) == ['tags', 'elapsed_s', 'start_unix', 'end_unix']
+
+
+def test_mmr_pack() -> None:
+    """Test token-budgeted MMR context packing."""
+    import numpy as np
+
+    from distllm.rag.packing import mmr_pack
+
+    # Documents 0 and 1 are near duplicates, 2 and 3 are distinct
+    embeddings = np.array([[1, 0], [1, 0.01], [0, 1], [0.7, 0.7]])
+    scores = [0.9, 0.89, 0.5, 0.6]
+
+    # Diversity skips the near duplicate of the top document
+    assert mmr_pack(scores, embeddings, [10] * 4, token_budget=25) == [0, 2]
+
+    # Pure relevance keeps the score order
+    selected = mmr_pack(scores, embeddings, [10] * 4, 100, mmr_lambda=1.0)
+    assert selected == [0, 1, 3, 2]
+
+    # Documents larger than the remaining budget are skipped
+    assert mmr_pack(scores, embeddings, [30, 5, 5, 50], 12) == [1, 2]
+
+
+# The minimum cosine similarity of the int8 and fp32 embeddings
+CPU_PARITY_MIN_COSINE = 0.99
+
+
+def test_cpu_encoder_parity(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test the int8 CPU encoder against the fp32 encoder."""
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+    from transformers import BertConfig
+    from transformers import BertModel
+    from transformers import BertTokenizerFast
+
+    from distllm.embed import get_encoder
+    from distllm.embed import get_pooler
+    from distllm.embed.datasets.utils import DataCollator
+    from distllm.embed.datasets.utils import InMemoryDataset
+    from distllm.embed.embedders.full_sequence import compute_embeddings
+
+    # Save a small randomly initialized model and its tokenizer
+    words = ['protein', 'gene', 'cell', 'virus', 'host', 'binds', 'the', 'a']
+    vocab_file = tmp_path / 'vocab.txt'
+    special = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    vocab_file.write_text('\n'.join(special + words))
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(special) + len(words),
+        hidden_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=256,
+        max_position_embeddings=64,
+    )
+    BertModel(config).save_pretrained(tmp_path)
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(tmp_path)
+
+    # Embed the same texts with the fp32 and int8 encoders
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(3, 20, size=32)
+    texts = [' '.join(rng.choice(words, size=n)) for n in lengths]
+    embeddings = {}
+    for name, quantization in (('auto', False), ('cpu', True)):
+        encoder = get_encoder(
+            {
+                'name': name,
+                'pretrained_model_name_or_path': str(tmp_path),
+                'quantization': quantization,
+            },
+        )
+        dataloader = DataLoader(
+            batch_size=8,
+            dataset=InMemoryDataset(texts),
+            collate_fn=DataCollator(encoder.tokenizer),
+        )
+        embeddings[name] = compute_embeddings(
+            dataloader,
+            encoder,
+            get_pooler({'name': 'mean'}),
+            normalize=True,
+        )
+
+    # The int8 embeddings are close to the fp32 embeddings
+    assert embeddings['cpu'].shape == embeddings['auto'].shape
+    assert embeddings['cpu'].dtype == np.float32
+    cosine = np.sum(embeddings['cpu'] * embeddings['auto'], axis=1)
+    assert cosine.min() > CPU_PARITY_MIN_COSINE
+
+
+def test_average_pool() -> None:
+    """Test the mean pooling without the start and end tokens."""
+    import torch
+
+    from distllm.embed.poolers.mean import average_pool
+
+    # Sequences of 6 and 3 tokens, padded to 7 tokens
+    embeddings = torch.randn(2, 7, 8)
+    attention_mask = torch.tensor([[1] * 6 + [0], [1] * 3 + [0] * 4])
+    original_mask = attention_mask.clone()
+
+    # The start, end and pad tokens of each sequence are excluded
+    pooled = average_pool(embeddings, attention_mask)
+    expected = torch.stack(
+        [embeddings[0, 1:5].mean(dim=0), embeddings[1, 1]],
+    )
+    torch.testing.assert_close(pooled, expected)
+
+    # The attention mask of the caller is not modified
+    assert torch.equal(attention_mask, original_mask)
+
+
+def test_pool_buffer_embeddings() -> None:
+    """Test pooling the buffer embeddings over the chunk spans."""
+    import numpy as np
+
+    from distllm.embed.embedders.semantic_chunk import _pool_chunk_embeddings
+
+    # Buffers of different norms, chunked at a breakpoint after the second
+    rng = np.random.default_rng(0)
+    scales = np.array([[1.0], [3.0], [0.5], [2.0], [10.0]], dtype=np.float32)
+    buffer_embeds = rng.standard_normal((5, 4)).astype(np.float32) * scales
+    spans = [(0, 2), (2, 5)]
+    sentences = ['a', 'bbb', 'cc', 'dddddd', 'e']
+    buffer_metadata = [{'sentence': s} for s in sentences]
+
+    # Average the unit buffers of each span by hand
+    def expected(weights: list[int]) -> list[list[float]]:
+        units = [
+            [x / sum(y**2 for y in e) ** 0.5 for x in e]
+            for e in buffer_embeds.tolist()
+        ]
+        pooled = []
+        for start, end in spans:
+            span = list(zip(weights[start:end], units[start:end]))
+            total = sum(w for w, _ in span)
+            pooled.append(
+                [sum(w * u[j] for w, u in span) / total for j in range(4)],
+            )
+        return pooled
+
+    for chunk_pooling, weights in (
+        ('mean', [1] * len(sentences)),
+        ('length_weighted_mean', [len(s) for s in sentences]),
+    ):
+        pooled = _pool_chunk_embeddings(
+            chunk_pooling,  # type: ignore[arg-type]
+            buffer_embeds,
+            spans,
+            buffer_metadata,
+        )
+        assert pooled is not None
+        assert pooled.dtype == buffer_embeds.dtype
+        np.testing.assert_allclose(pooled, expected(weights), rtol=1e-5)
+
+    # Without chunk pooling the chunks are left to be encoded
+    assert (
+        _pool_chunk_embeddings(None, buffer_embeds, spans, buffer_metadata)
+        is None
+    )
+
+
+def _legacy_sentences_to_buffers(
+    split: list[str],
+    buffer_size: int,
+) -> list[str]:
+    """Group split into buffers by re-joining each window."""
+    buffers = []
+    for i in range(len(split)):
+        combined = ''.join(
+            split[j]
+            for j in range(
+                max(0, i - buffer_size),
+                min(i + 1 + buffer_size, len(split)),
+            )
+        )
+        buffers.append(combined)
+    return buffers
+
+
+def _legacy_distances(buffer_embeds: Any) -> Any:
+    """Calculate the buffer distances one pair at a time."""
+    import numpy as np
+
+    embeddings = buffer_embeds.astype(np.float32)
+    distances = np.zeros(len(embeddings) - 1)
+    for i in range(len(embeddings) - 1):
+        embedding_current = embeddings[i]
+        embedding_next = embeddings[i + 1]
+
+        similarity = np.dot(embedding_current, embedding_next) / (
+            np.linalg.norm(embedding_current) * np.linalg.norm(embedding_next)
+        )
+
+        distances[i] = 1 - similarity
+
+    return distances
+
+
+def _legacy_build_chunks(
+    distances: Any,
+    breakpoint_percentile_threshold: int,
+) -> list[tuple[int, int]]:
+    """Build the chunks with a Python loop over the distances."""
+    import numpy as np
+
+    if len(distances) == 0:
+        return [(0, 0)]
+
+    threshold = np.percentile(distances, breakpoint_percentile_threshold)
+    indices_above_threshold = [
+        i for i, x in enumerate(distances) if x > threshold
+    ]
+
+    start_index = 0
+    index_groups = []
+    for index in indices_above_threshold:
+        index_groups.append((start_index, index + 1))
+        start_index = index + 1
+    index_groups.append((start_index, len(distances) + 1))
+
+    return index_groups
+
+
+def test_semantic_chunking_stages() -> None:
+    """Test the chunking stages against their loop-based implementations."""
+    import numpy as np
+
+    from distllm.embed.datasets.jsonl_chunk import sentences_to_buffers
+    from distllm.embed.embedders.semantic_chunk import build_chunks
+    from distllm.embed.embedders.semantic_chunk import (
+        calculate_distances_between_buffer,
+    )
+
+    # No, a single, and fewer sentences than the buffer size
+    sentences = ['One. ', 'Two, too. ', 'Three! ', '', 'Five? ', 'Six.']
+    for num_sentences in (0, 1, 2, len(sentences)):
+        split = sentences[:num_sentences]
+        for buffer_size in (0, 1, 3):
+            expected = _legacy_sentences_to_buffers(split, buffer_size)
+            assert sentences_to_buffers(split, buffer_size) == expected
+
+    # A single buffer has no distances, the norms of the buffers differ
+    rng = np.random.default_rng(0)
+    for num_buffers in (1, 2, 10):
+        buffer_embeds = rng.standard_normal((num_buffers, 8))
+        buffer_embeds *= rng.uniform(0.1, 10, (num_buffers, 1))
+        for dtype in (np.float32, np.float16):
+            embeds = buffer_embeds.astype(dtype)
+            np.testing.assert_allclose(
+                calculate_distances_between_buffer(embeds),
+                _legacy_distances(embeds),
+                atol=1e-5,
+            )
+
+    # No, a single, random and a breakpoint at the last distance
+    last = [0.1, 0.2, 0.1, 0.2, 0.9]
+    for distances in ([], [0.5], rng.uniform(size=20).tolist(), last):
+        for threshold in (0, 50, 90, 100):
+            chunks = _legacy_build_chunks(np.array(distances), threshold)
+            assert build_chunks(np.array(distances), threshold) == chunks
+    assert build_chunks(np.array(last), 90) == [(0, 5), (5, 6)]
+
+
+def test_fasta_streaming(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test the streaming fasta reader, byte-range shards and index."""
+    from distllm.embed.datasets.fasta import FastaIndex
+    from distllm.embed.datasets.fasta import iter_fasta_shard
+    from distllm.embed.datasets.fasta import read_fasta
+
+    # Write records with wrapped, empty and unterminated sequences
+    fasta_file = tmp_path / 'test.fasta'
+    fasta_file.write_text(
+        '>seq0 first\nMKTAY\nIAKQR\nQ\n>seq1\n\n>seq2 third\nGATTACA\n>seq3',
+    )
+    sequences = read_fasta(fasta_file)
+    assert [seq.tag for seq in sequences] == [
+        'seq0 first',
+        'seq1',
+        'seq2 third',
+        'seq3',
+    ]
+    assert [seq.sequence for seq in sequences] == [
+        'MKTAYIAKQRQ',
+        '',
+        'GATTACA',
+        '',
+    ]
+
+    # Any split of the file into byte ranges splits the records exactly
+    for num_shards in (1, 2, 3, 8, 100):
+        shards = [
+            list(iter_fasta_shard(fasta_file, num_shards, shard_index))
+            for shard_index in range(num_shards)
+        ]
+        records = [record for shard in shards for record in shard]
+        assert [seq for _, seq in records] == sequences
+        assert sorted(records, key=lambda record: record[0]) == records
+
+    # The index is in the samtools faidx format and gives random access
+    index = FastaIndex(fasta_file)
+    lines = index.index_file.read_text().splitlines()
+    assert lines[0] == 'seq0\t11\t12\t5\t6'
+    assert len(index) == len(sequences)
+    assert [index[i] for i in (2, 0, -1, 1)] == [
+        sequences[i] for i in (2, 0, -1, 1)
+    ]
+
+
+def _write_embedding_dataset(
+    dataset_dir: Path,
+    embeddings: Any,
+    **columns: list[Any],
+) -> None:
+    """Save an HF dataset with the text and embeddings of each row."""
+    from datasets import Dataset
+
+    text = [f'doc {i}' for i in range(len(embeddings))]
+    data = {'text': text, 'embeddings': embeddings.tolist(), **columns}
+    Dataset.from_dict(data).save_to_disk(str(dataset_dir))
+
+
+def _unit_embeddings(num_rows: int, seed: int = 0) -> Any:
+    """Get random L2-normalized float32 embeddings."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((num_rows, 32)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def test_faiss_ivf_compact(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test searching an IVF index after compacting deleted documents."""
+    from distllm.rag.search import FaissIndexV2
+
+    embeddings = _unit_embeddings(300)
+    _write_embedding_dataset(tmp_path / 'dataset', embeddings)
+
+    for precision in ('float32', 'ubinary'):
+        kwargs = {
+            'dataset_dir': tmp_path / 'dataset',
+            'faiss_index_path': tmp_path / f'{precision}.index',
+            'precision': precision,
+            'search_algorithm': 'ivf',
+            'nlist': 4,
+            'nprobe': 4,
+            'rescore_multiplier': 8,
+            'id_map': True,
+        }
+        index = FaissIndexV2(**kwargs)
+        deleted = [5, 100]
+        index.delete(deleted)
+        assert index.compact() == len(deleted)
+
+        # Each remaining document is its own nearest neighbor, in process
+        # and after reloading the compacted index
+        queries = [250, 7, 299, 0]
+        for searcher in (index, FaissIndexV2(**kwargs)):
+            results = searcher.search(embeddings[queries], top_k=1)
+            assert results.total_indices == [[i] for i in queries]
+
+            # The deleted documents are gone from the index
+            results = searcher.search(embeddings[deleted], top_k=3)
+            for indices in results.total_indices:
+                assert not set(deleted) & set(indices)
+
+
+def test_faiss_index_updates(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test appending, deleting and compacting ID-mapped FAISS indexes."""
+    import pytest
+
+    from distllm.rag.search import FaissIndexV2
+
+    # A corpus of 200 documents and a shard of 50 new documents
+    embeddings = _unit_embeddings(250)
+    _write_embedding_dataset(tmp_path / 'dataset', embeddings[:200])
+    _write_embedding_dataset(tmp_path / 'shard', embeddings[200:])
+
+    # Indexes that are not ID-mapped cannot be updated
+    index = FaissIndexV2(tmp_path / 'dataset', tmp_path / 'flat.index')
+    with pytest.raises(ValueError, match='not ID-mapped'):
+        index.append([tmp_path / 'shard'])
+
+    for precision in ('float32', 'ubinary'):
+        kwargs = {
+            'dataset_dir': tmp_path / 'dataset',
+            'faiss_index_path': tmp_path / f'{precision}.index',
+            'precision': precision,
+            'rescore_multiplier': 8,
+            'id_map': True,
+        }
+        index = FaissIndexV2(**kwargs)
+
+        # The new documents are numbered after the existing ones
+        new_indices = index.append([tmp_path / 'shard'])
+        assert new_indices == list(range(200, 250))
+        assert index.get([0, 249], 'text') == ['doc 0', 'doc 49']
+
+        # Tombstoned documents are excluded from the search results
+        deleted = [3, 210]
+        index.delete(deleted)
+        queries = [3, 210, 0, 249]
+        results = index.search(embeddings[queries], top_k=2)
+        for query, indices in zip(queries, results.total_indices):
+            assert not set(deleted) & set(indices)
+            assert query in deleted or indices[0] == query
+
+        # The appended shard and tombstones are reloaded from disk
+        index = FaissIndexV2(**kwargs)
+        assert index.tombstones.tolist() == deleted
+        assert index.get([249], 'text') == ['doc 49']
+        assert index.search(embeddings[queries], top_k=2) == results
+
+        # Compaction removes the tombstoned vectors, the corpus indices
+        # of the remaining documents do not change
+        assert index.compact() == len(deleted)
+        index = FaissIndexV2(**kwargs)
+        assert not len(index.tombstones)
+        assert index.faiss_index.ntotal == 250 - len(deleted)
+        assert index.search(embeddings[queries], top_k=2) == results
+
+
+WORDS = ['protein', 'gene', 'cell', 'virus', 'host', 'binds', 'the', 'a']
+
+
+def _word_tokenizer(tmp_path: Path) -> Any:
+    """Get a word-level BERT tokenizer over the test words."""
+    from transformers import BertTokenizerFast
+
+    vocab_file = tmp_path / 'vocab.txt'
+    special = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+    vocab_file.write_text('\n'.join(special + WORDS))
+    return BertTokenizerFast(vocab_file=str(vocab_file))
+
+
+def _random_texts(num_texts: int, seed: int = 0) -> list[str]:
+    """Get texts of random words and lengths."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 30, size=num_texts)
+    return [' '.join(rng.choice(WORDS, size=n)) for n in lengths]
+
+
+class _StubEncoder:
+    """Encoder that embeds each token with a fixed random vector."""
+
+    embedding_size = 16
+
+    def __init__(self, tokenizer: Any) -> None:
+        import torch
+
+        self.tokenizer = tokenizer
+        self.dtype = torch.float32
+        self.device = torch.device('cpu')
+        generator = torch.Generator().manual_seed(0)
+        self.table = torch.randn(
+            (tokenizer.vocab_size, self.embedding_size),
+            generator=generator,
+        )
+        # The (batch size, sequence length) of each encoded batch
+        self.shapes: list[tuple[int, int]] = []
+
+    def encode(self, batch_encoding: Any) -> Any:
+        self.shapes.append(tuple(batch_encoding.input_ids.shape))
+        return self.table[batch_encoding.input_ids]
+
+
+def _reference_embeddings(encoder: _StubEncoder, texts: list[str]) -> Any:
+    """Embed each text on its own, i.e., without any padding."""
+    import numpy as np
+
+    from distllm.embed import get_pooler
+    from distllm.embed.datasets.utils import DataCollator
+
+    collator = DataCollator(encoder.tokenizer)
+    pooler = get_pooler({'name': 'mean'})
+    embeddings = []
+    for text in texts:
+        inputs = collator([text])
+        hidden_states = encoder.encode(inputs)
+        pooled = pooler.pool(hidden_states, inputs.attention_mask)
+        embeddings.append(pooled.numpy())
+    encoder.shapes.clear()
+    return np.concatenate(embeddings)
+
+
+def test_token_budget_batching(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test packing batches to a token budget in the dataset order."""
+    import numpy as np
+
+    from distllm.embed import get_pooler
+    from distllm.embed.datasets.single_line import SequencePerLineDataset
+    from distllm.embed.datasets.single_line import SequencePerLineDatasetConfig
+    from distllm.embed.datasets.utils import LengthBucketBatchSampler
+    from distllm.embed.embedders.full_sequence import compute_embeddings
+
+    # Each batch fits in the budget, unless it holds a single sequence
+    lengths = np.array([5, 40, 12, 7, 100, 3, 12, 25, 1, 60])
+    max_tokens = 64
+    sampler = LengthBucketBatchSampler(lengths, 4, max_tokens)
+    assert sorted(i for batch in sampler for i in batch) == list(range(10))
+    for batch in sampler:
+        padded_size = len(batch) * lengths[batch].max()
+        assert padded_size <= max_tokens or len(batch) == 1
+
+    # Write a file of texts of random lengths
+    texts = _random_texts(50)
+    data_file = tmp_path / 'texts.txt'
+    data_file.write_text('\n'.join(['header', *texts]))
+    encoder = _StubEncoder(_word_tokenizer(tmp_path))
+    expected = _reference_embeddings(encoder, texts)
+
+    # The packed batches are scattered back in the dataset order
+    config = SequencePerLineDatasetConfig(
+        num_data_workers=0,
+        max_tokens_per_batch=max_tokens,
+    )
+    dataloader = SequencePerLineDataset(config).get_dataloader(
+        data_file,
+        encoder,
+    )
+    pooler = get_pooler({'name': 'mean'})
+    embeddings = compute_embeddings(dataloader, encoder, pooler)
+    np.testing.assert_allclose(embeddings, expected, atol=1e-6)
+    for batch_size, sequence_length in encoder.shapes:
+        padded_size = batch_size * sequence_length
+        assert padded_size <= max_tokens or batch_size == 1
+
+
+def test_faiss_filtered_search(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test that filtered searches only return the matching documents."""
+    import numpy as np
+    import pytest
+
+    from distllm.rag.search import FaissIndexV2
+
+    # Documents from three files, some with a missing path
+    embeddings = _unit_embeddings(300)
+    paths = [['a.txt', 'b.txt', 'c.txt', None][i % 4] for i in range(300)]
+    _write_embedding_dataset(tmp_path / 'dataset', embeddings, path=paths)
+    path_of = np.array(paths, dtype=object)
+
+    # Exact, HNSW (bitmap selector) and binary HNSW (post-filtered)
+    for precision, search_algorithm in (
+        ('float32', 'exact'),
+        ('float32', 'hnsw'),
+        ('ubinary', 'exact'),
+        ('ubinary', 'hnsw'),
+    ):
+        index = FaissIndexV2(
+            tmp_path / 'dataset',
+            tmp_path / f'{precision}.{search_algorithm}.index',
+            precision=precision,
+            search_algorithm=search_algorithm,
+            filter_fields=['path'],
+        )
+        queries, top_k = embeddings[:8], 5
+        for filters in ({'path': 'b.txt'}, {'path': ['a.txt', 'c.txt']}):
+            allowed = filters['path']
+            allowed = [allowed] if isinstance(allowed, str) else allowed
+            results = index.search(queries, top_k, filters=filters)
+            for indices in results.total_indices:
+                assert len(indices) == top_k
+                assert set(path_of[indices]) <= set(allowed)
+
+        # Unknown values match nothing, unknown fields are rejected
+        results = index.search(queries, top_k, filters={'path': 'd.txt'})
+        assert results.total_indices == [[]] * len(queries)
+        with pytest.raises(ValueError, match='Cannot filter on text'):
+            index.search(queries, top_k, filters={'text': 'doc 0'})
+
+
+def test_deduplicate_dataset() -> None:
+    """Test MinHash near-duplicate clustering and back references."""
+    import numpy as np
+    from datasets import Dataset
+
+    from distllm.dedup import deduplicate_dataset
+    from distllm.dedup import find_near_duplicates
+    from distllm.dedup import minhash_signature
+
+    # Row 2 is a formatting variant of row 0 and row 4 differs by a letter,
+    # row 5 repeats row 1
+    texts = [
+        'The spike protein binds the ACE2 receptor of the host cell.',
+        'Polymerase inhibitors block the replication of the viral genome.',
+        'the spike protein binds the  ACE2 receptor of the host cell.',
+        'Antibodies against the nucleocapsid are markers of past infection.',
+        'The spike protein binds the ACE2 receptor of the host cells.',
+        'Polymerase inhibitors block the replication of the viral genome.',
+    ]
+    paths = [f'{i}.txt' for i in range(len(texts))]
+
+    # Check the clustering keeps the first occurrence of each cluster
+    signatures = np.stack([minhash_signature(text) for text in texts])
+    representatives = find_near_duplicates(signatures)
+    assert representatives.tolist() == [0, 1, 0, 3, 0, 1]
+
+    # Check the representatives and their back references
+    dataset = Dataset.from_dict({'text': texts, 'path': paths})
+    deduplicated = deduplicate_dataset(dataset)
+    assert deduplicated['text'] == [texts[0], texts[1], texts[3]]
+    assert deduplicated['path'] == ['0.txt', '1.txt', '3.txt']
+    assert deduplicated['duplicates'] == [[2, 4], [5], []]
+    duplicate_paths = [['2.txt', '4.txt'], ['5.txt'], []]
+    assert deduplicated['duplicate_paths'] == duplicate_paths
+
+
+def test_embedding_cache(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test cached and encoded embeddings are merged in dataset order."""
+    import numpy as np
+
+    from distllm.embed import get_pooler
+    from distllm.embed.cache import EmbeddingCache
+    from distllm.embed.datasets.single_line import SequencePerLineDataset
+    from distllm.embed.datasets.single_line import SequencePerLineDatasetConfig
+    from distllm.embed.embedders.full_sequence import compute_embeddings
+
+    encoder = _StubEncoder(_word_tokenizer(tmp_path))
+    pooler = get_pooler({'name': 'mean'})
+    dataset = SequencePerLineDataset(
+        SequencePerLineDatasetConfig(num_data_workers=0, batch_size=4),
+    )
+    cache_dir = tmp_path / 'cache'
+    model_config = {'encoder': {'name': 'stub'}, 'pooler': {'name': 'mean'}}
+
+    def embed(texts: list[str], cache: EmbeddingCache) -> Any:
+        data_file = tmp_path / 'texts.txt'
+        data_file.write_text('\n'.join(['header', *texts]))
+        dataloader = dataset.get_dataloader(data_file, encoder)
+        return compute_embeddings(dataloader, encoder, pooler, cache=cache)
+
+    # The first run encodes (and stores) every text
+    texts, num_cached = _random_texts(20), 12
+    cache = EmbeddingCache(cache_dir, model_config)
+    embed(texts[:num_cached], cache)
+    assert sum(n for n, _ in encoder.shapes) == num_cached
+    encoder.shapes.clear()
+
+    # The next run only encodes the new texts, interleaved with hits
+    order = np.random.default_rng(0).permutation(len(texts))
+    shuffled = [texts[i] for i in order]
+    expected = _reference_embeddings(encoder, shuffled)
+    cache = EmbeddingCache(cache_dir, model_config)
+    embeddings = embed(shuffled, cache)
+    np.testing.assert_allclose(embeddings, expected, atol=1e-6)
+    assert sum(n for n, _ in encoder.shapes) == len(texts) - num_cached
+    encoder.shapes.clear()
+
+    # Compacting merges the shards, and a rerun is all hits
+    num_shards = 2
+    assert len(list(cache.cache_dir.glob('*.keys.npy'))) == num_shards
+    cache.compact()
+    assert len(list(cache.cache_dir.glob('*.keys.npy'))) == 1
+    assert len(list(cache.cache_dir.glob('*.embeddings.npy'))) == 1
+    for compacted in (cache, EmbeddingCache(cache_dir, model_config)):
+        assert len(compacted) == len(texts)
+        embeddings = embed(shuffled, compacted)
+        np.testing.assert_allclose(embeddings, expected, atol=1e-6)
+        assert not encoder.shapes
+
+
+def test_run_manifest(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test skipping committed inputs and merging committed outputs."""
+    import os
+
+    from distllm.manifest import filter_committed
+    from distllm.manifest import RunManifest
+
+    # Lay out a run as written by the distributed embedding
+    input_paths = [tmp_path / f'input{i}.txt' for i in range(2)]
+    dataset_dir = tmp_path / 'run' / 'embeddings'
+    output_dirs = [dataset_dir / f'output{i}' for i in range(2)]
+    for input_path, output_dir in zip(input_paths, output_dirs):
+        input_path.write_text('text')
+        output_dir.mkdir(parents=True)
+    manifest = RunManifest(tmp_path / 'run' / 'manifest')
+
+    # A running output is neither skipped nor merged
+    for input_path, output_dir in zip(input_paths, output_dirs):
+        manifest.start(input_path, output_dir)
+        (output_dir / 'data.arrow').write_bytes(b'embeddings')
+    assert not manifest.is_committed(input_paths[0])
+    assert filter_committed(output_dirs, dataset_dir) == []
+
+    # Once committed, the output is skipped by a rerun and merged
+    manifest.commit(input_paths[0], output_dirs[0])
+    manifest.commit(input_paths[1], output_dirs[1], checksum=True)
+    assert manifest.is_committed(input_paths[0])
+    assert filter_committed(output_dirs, dataset_dir, verify=True) == (
+        output_dirs
+    )
+
+    # A corrupted output fails the verification, by its size or checksum
+    (output_dirs[0] / 'data.arrow').write_bytes(b'embed')
+    (output_dirs[1] / 'data.arrow').write_bytes(b'EMBEDDINGS')
+    assert filter_committed(output_dirs, dataset_dir) == output_dirs
+    assert filter_committed(output_dirs, dataset_dir, verify=True) == []
+
+    # A changed input is embedded again by a rerun
+    stat = input_paths[1].stat()
+    os.utime(input_paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert manifest.is_committed(input_paths[0])
+    assert not manifest.is_committed(input_paths[1])
+
+
+def test_sharded_faiss_index(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test merging the shard results by their global indices."""
+    import numpy as np
+
+    from distllm.rag.search import ShardedFaissIndex
+
+    # Split the corpus into chunks of different sizes
+    embeddings = _unit_embeddings(120)
+    texts = [f'doc {i}' for i in range(len(embeddings))]
+    bounds = [0, 50, 60, 120]
+    chunk_paths = []
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        chunk_paths.append(tmp_path / f'chunk{i}')
+        _write_embedding_dataset(
+            chunk_paths[-1],
+            embeddings[start:end],
+            text=texts[start:end],
+        )
+    index = ShardedFaissIndex(chunk_paths, tmp_path / 'index')
+
+    # The merged results match a search of the whole corpus
+    queries = _unit_embeddings(8, seed=1)
+    top_k = 5
+    scores = queries @ embeddings.T
+    expected = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+    results = index.search(queries.copy(), top_k=top_k, score_threshold=-1)
+    assert results.total_indices == expected.tolist()
+    np.testing.assert_allclose(
+        results.total_scores,
+        np.take_along_axis(scores, expected, axis=1),
+        atol=1e-5,
+    )
+
+    # The global indices are read from their shards in the given order
+    indices = [119, 0, 55, 49, 50, 60, 0]
+    assert index.get(indices, 'text') == [texts[i] for i in indices]
+
+
+def test_virtual_dataset(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test searching the embedding shards through a virtual dataset."""
+    import numpy as np
+
+    from distllm.cli import virtual_merge
+    from distllm.rag.search import FaissIndexV2
+
+    # Write shards of different sizes, the paths cycle across their bounds
+    embeddings = _unit_embeddings(90)
+    texts = [f'doc {i}' for i in range(len(embeddings))]
+    paths = [['a.txt', 'b.txt', 'c.txt'][i % 3] for i in range(len(texts))]
+    bounds = [0, 40, 47, 90]
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        _write_embedding_dataset(
+            tmp_path / 'embeddings' / f'shard{i}',
+            embeddings[start:end],
+            text=texts[start:end],
+            path=paths[start:end],
+        )
+
+    # View the shards as one corpus
+    virtual_merge(
+        dataset_dir=tmp_path / 'embeddings',
+        output_path=tmp_path / 'virtual.json',
+        manifest_dir=None,
+    )
+    index = FaissIndexV2(
+        tmp_path / 'virtual.json',
+        tmp_path / 'virtual.index',
+        filter_fields=['path'],
+    )
+
+    # Each document is found at its global row
+    rows = [0, 39, 40, 46, 47, 89]
+    results = index.search(embeddings[rows], top_k=1)
+    assert results.total_indices == [[row] for row in rows]
+
+    # The global rows are read from their shards
+    indices = [89, 0, 45, 39, 47, 40, 0]
+    assert index.get(indices, 'text') == [texts[i] for i in indices]
+    assert index.get(indices, 'path') == [paths[i] for i in indices]
+    assert index.check_key_exists('path')
+    assert not index.check_key_exists('missing')
+
+    # The filtered results match a search of the allowed rows of all shards
+    queries, top_k = _unit_embeddings(4, seed=1), 20
+    allowed = np.array([path == 'b.txt' for path in paths])
+    scores = queries @ embeddings.T
+    scores[:, ~allowed] = -np.inf
+    expected = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+    results = index.search(
+        queries,
+        top_k=top_k,
+        score_threshold=-1,
+        filters={'path': 'b.txt'},
+    )
+    assert results.total_indices == expected.tolist()
+    shards = np.searchsorted(bounds, results.total_indices, side='right')
+    assert len(np.unique(shards)) == len(bounds) - 1
+
+
+def test_query_encoder(tmp_path, monkeypatch) -> None:  # type: ignore[no-untyped-def]
+    """Test micro-batching concurrent queries and sharing warm encoders."""
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+
+    from distllm.embed import get_pooler
+    from distllm.rag import query_encoder as query_encoder_module
+    from distllm.rag.query_encoder import QueryEncoder
+    from distllm.rag.query_encoder import QueryEncoderConfig
+
+    class _BlockingEncoder(_StubEncoder):
+        """Encoder that holds its first forward pass until released."""
+
+        def __init__(self, tokenizer: Any) -> None:
+            super().__init__(tokenizer)
+            self.entered = threading.Event()
+            self.released = threading.Event()
+
+        def encode(self, batch_encoding: Any) -> Any:
+            self.entered.set()
+            self.released.wait()
+            return super().encode(batch_encoding)
+
+    tokenizer = _word_tokenizer(tmp_path)
+    requests = [_random_texts(n, seed=n) for n in (1, 2, 3, 4)]
+    reference_encoder = _StubEncoder(tokenizer)
+    expected = [_reference_embeddings(reference_encoder, r) for r in requests]
+    encoder = _BlockingEncoder(tokenizer)
+    query_encoder = QueryEncoder(encoder, get_pooler({'name': 'mean'}), 8)
+
+    # The requests queued during a forward pass are encoded together, in
+    # batches of up to batch_size queries
+    with ThreadPoolExecutor(len(requests)) as pool:
+        futures = [pool.submit(query_encoder.encode, requests[0])]
+        encoder.entered.wait()
+        futures += [pool.submit(query_encoder.encode, r) for r in requests[1:]]
+        while query_encoder._requests.qsize() < len(requests) - 1:
+            time.sleep(0.01)
+        encoder.released.set()
+        embeddings = [future.result() for future in futures]
+    assert [batch_size for batch_size, _ in encoder.shapes] == [1, 8, 1]
+    for actual, reference in zip(embeddings, expected):
+        np.testing.assert_allclose(actual, reference, atol=1e-6)
+
+    # The warm encoders are shared by the configurations that match
+    monkeypatch.setattr(
+        query_encoder_module,
+        'get_encoder',
+        lambda _: _StubEncoder(tokenizer),
+    )
+    config = {
+        'encoder_config': {
+            'name': 'auto',
+            'pretrained_model_name_or_path': 'stub',
+        },
+        'pooler_config': {'name': 'mean'},
+    }
+    warm = QueryEncoderConfig(**config).get_query_encoder()
+    assert QueryEncoderConfig(**config).get_query_encoder() is warm
+    batch_size = 4
+    other = QueryEncoderConfig(**config, batch_size=batch_size)
+    assert other.get_query_encoder() is not warm
+    assert other.get_query_encoder().batch_size == batch_size
+
+
+def test_configure_thread_budget(monkeypatch) -> None:  # type: ignore[no-untyped-def]
+    """Test splitting the CPUs of a node between its worker processes."""
+    import faiss
+    import torch
+
+    from distllm import threads
+
+    # The gunicorn workers share the CPUs of the node, and one thread pool
+    # size is already set by the environment
+    num_cpus, num_workers = 16, 4
+    num_threads = num_cpus // num_workers
+    unset = ('OMP_NUM_THREADS', 'RAYON_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+    monkeypatch.setattr(threads, 'available_cpus', lambda: num_cpus)
+    monkeypatch.setattr(threads.os, 'cpu_count', lambda: num_cpus)
+    monkeypatch.setenv('WEB_CONCURRENCY', str(num_workers))
+    for var in unset:
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.delenv('TOKENIZERS_PARALLELISM', raising=False)
+    monkeypatch.setenv('MKL_NUM_THREADS', '1')
+
+    # Check the thread pools of the imported libraries are sized too
+    torch_threads = torch.get_num_threads()
+    faiss_threads = faiss.omp_get_max_threads()
+    try:
+        budget = threads.configure_thread_budget()
+        assert torch.get_num_threads() == num_threads
+        assert faiss.omp_get_max_threads() == num_threads
+    finally:
+        torch.set_num_threads(torch_threads)
+        faiss.omp_set_num_threads(faiss_threads)
+
+    assert budget['workers'] == num_workers
+    assert budget['threads'] == num_threads
+    for var in unset:
+        assert threads.os.environ[var] == str(num_threads)
+    assert threads.os.environ['TOKENIZERS_PARALLELISM'] == 'true'
+    assert threads.os.environ['MKL_NUM_THREADS'] == '1'
+
+
+def test_write_batches(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test writing the embeddings incrementally and merging the shards."""
+    import numpy as np
+    from datasets import Dataset
+
+    from distllm.embed.embedders.base import EmbedderResult
+    from distllm.embed.writers.huggingface import HuggingFaceWriter
+    from distllm.embed.writers.huggingface import HuggingFaceWriterConfig
+    from distllm.embed.writers.numpy import _merge_arrays
+    from distllm.embed.writers.numpy import NumpyWriter
+    from distllm.embed.writers.numpy import NumpyWriterConfig
+
+    # Batches of different sizes, as they come off the encoder
+    rng = np.random.default_rng(0)
+    results = [
+        EmbedderResult(
+            embeddings=rng.standard_normal((n, 8)).astype(np.float32),
+            text=[f'batch {n} doc {i}' for i in range(n)],
+            metadata=[{'path': f'{n}.txt'} for _ in range(n)],
+        )
+        for n in (3, 5, 2)
+    ]
+    embeddings = np.concatenate([r.embeddings for r in results])
+    text = [t for r in results for t in r.text]
+    metadata = [m for r in results for m in r.metadata]
+    for name in ('numpy', 'hf'):
+        (tmp_path / name).mkdir()
+
+    # The numpy header is patched with the final shape of the embeddings
+    numpy_writer = NumpyWriter(NumpyWriterConfig())
+    numpy_writer.write_batches(tmp_path / 'numpy', iter(results))
+    np.testing.assert_array_equal(
+        np.load(tmp_path / 'numpy' / 'embeddings.npy'),
+        embeddings,
+    )
+    assert np.load(tmp_path / 'numpy' / 'text.npy').tolist() == text
+    loaded = np.load(tmp_path / 'numpy' / 'metadata.npy', allow_pickle=True)
+    assert loaded.tolist() == metadata
+
+    # The Arrow record batches are saved as one dataset, in batch order
+    hf_writer = HuggingFaceWriter(HuggingFaceWriterConfig(write_batch_size=4))
+    hf_writer.write_batches(tmp_path / 'hf', iter(results))
+    assert not (tmp_path / 'hf' / 'tmp').exists()
+    dataset = Dataset.load_from_disk(tmp_path / 'hf')
+    assert dataset['text'] == text
+    assert dataset['path'] == [m['path'] for m in metadata]
+    np.testing.assert_array_equal(
+        np.array(dataset['embeddings'], dtype=np.float32),
+        embeddings,
+    )
+
+    # The shards (and an empty one) are concatenated along the first axis
+    shards = [embeddings[:4], embeddings[4:4], embeddings[4:]]
+    for i, shard in enumerate(shards):
+        np.save(tmp_path / f'shard{i}.npy', shard)
+    _merge_arrays(
+        [tmp_path / f'shard{i}.npy' for i in range(len(shards))],
+        tmp_path / 'merged.npy',
+    )
+    merged = np.load(tmp_path / 'merged.npy')
+    np.testing.assert_array_equal(merged, embeddings)
+
+    # The writer merges the embeddings, text and metadata of the shards
+    numpy_writer.merge([tmp_path / 'numpy'] * 2, tmp_path / 'numpy_merged')
+    merged = np.load(tmp_path / 'numpy_merged' / 'embeddings.npy')
+    np.testing.assert_array_equal(merged, np.concatenate([embeddings] * 2))
+    merged_text = np.load(tmp_path / 'numpy_merged' / 'text.npy')
+    assert merged_text.tolist() == text * 2
+
+
+def test_merge_embeddings(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test merging the embedding shards with the embed writers."""
+    import numpy as np
+    from datasets import Dataset
+
+    from distllm.cli import merge
+
+    # Write shards of different sizes
+    embeddings = _unit_embeddings(30)
+    texts = [f'doc {i}' for i in range(len(embeddings))]
+    paths = [['a.txt', None][i % 2] for i in range(len(texts))]
+    bounds = [0, 12, 13, 30]
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        _write_embedding_dataset(
+            tmp_path / 'embeddings' / f'shard{i}',
+            embeddings[start:end],
+            text=texts[start:end],
+            path=paths[start:end],
+        )
+
+    # Merge into one file per process, with the files of `save_to_disk`
+    num_proc = 2
+    merge(
+        writer_name='huggingface',
+        source='embed',
+        num_proc=num_proc,
+        dataset_dir=tmp_path / 'embeddings',
+        output_dir=tmp_path / 'merged',
+        dedup=False,
+        dedup_threshold=0.8,
+        manifest_dir=None,
+        verify_checksums=False,
+    )
+    assert len(list((tmp_path / 'merged').glob('*.arrow'))) == num_proc
+    assert (tmp_path / 'merged' / 'state.json').exists()
+
+    # Every row of the shards is loaded from the merged dataset
+    dataset = Dataset.load_from_disk(tmp_path / 'merged')
+    order = np.argsort([int(text.split()[1]) for text in dataset['text']])
+    assert [dataset['text'][i] for i in order] == texts
+    assert [dataset['path'][i] for i in order] == paths
+    np.testing.assert_allclose(
+        np.array(dataset['embeddings'])[order],
+        embeddings,
+        rtol=1e-6,
+    )
+
+    # The numpy shards are merged by the numpy writer of `embed`
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        shard_dir = tmp_path / 'numpy' / f'shard{i}'
+        shard_dir.mkdir(parents=True)
+        np.save(shard_dir / 'embeddings.npy', embeddings[start:end])
+        np.save(shard_dir / 'text.npy', texts[start:end])
+    merge(
+        writer_name='numpy',
+        source='embed',
+        num_proc=None,
+        dataset_dir=tmp_path / 'numpy',
+        output_dir=tmp_path / 'numpy_merged',
+        dedup=False,
+        dedup_threshold=0.8,
+        manifest_dir=None,
+        verify_checksums=False,
+    )
+    merged_text = np.load(tmp_path / 'numpy_merged' / 'text.npy').tolist()
+    order = np.argsort([int(text.split()[1]) for text in merged_text])
+    merged = np.load(tmp_path / 'numpy_merged' / 'embeddings.npy')
+    np.testing.assert_array_equal(merged[order], embeddings)
+
+
+def test_write_batches_metadata_types(tmp_path) -> None:  # type: ignore[no-untyped-def]
+    """Test writing metadata fields that are null in some batches."""
+    import numpy as np
+    from datasets import Dataset
+
+    from distllm.embed.embedders.base import EmbedderResult
+    from distllm.embed.writers.huggingface import HuggingFaceWriter
+    from distllm.embed.writers.huggingface import HuggingFaceWriterConfig
+
+    # The path is null in the first batch and a string in the later ones
+    paths = [[None, None], ['a.txt', 'b.txt'], [None, 'c.txt']]
+    results = [
+        EmbedderResult(
+            embeddings=np.full((2, 4), i, dtype=np.float32),
+            text=[f'batch {i} doc {j}' for j in range(2)],
+            metadata=[{'path': path} for path in batch_paths],
+        )
+        for i, batch_paths in enumerate(paths)
+    ]
+
+    # The batches are gathered into one record batch, or each is written
+    # as its own record batch
+    for write_batch_size in (4096, 1):
+        output_dir = tmp_path / f'{write_batch_size}'
+        output_dir.mkdir()
+        writer = HuggingFaceWriter(
+            HuggingFaceWriterConfig(write_batch_size=write_batch_size),
+        )
+        writer.write_batches(output_dir, iter(results))
+        dataset = Dataset.load_from_disk(output_dir)
+        assert dataset.features['path'].dtype == 'string'
+        assert dataset['path'] == [path for batch in paths for path in batch]
+        assert dataset['text'] == [
+            t for result in results for t in result.text
+        ]
+        np.testing.assert_array_equal(
+            np.array(dataset['embeddings'], dtype=np.float32),
+            np.concatenate([result.embeddings for result in results]),
+        )
+
+
+def test_bfloat16_round_trip() -> None:
+    """Test storing embeddings as bfloat16 and upcasting them back."""
+    import numpy as np
+    import torch
+
+    from distllm.embed.precision import cast_embeddings
+    from distllm.embed.precision import upcast_embeddings
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((16, 32)).astype(np.float32)
+
+    # The bits match the bfloat16 rounding of torch, stored as uint16
+    stored = cast_embeddings(embeddings, 'bfloat16')
+    assert stored.dtype == np.uint16
+    expected = torch.from_numpy(embeddings).to(torch.bfloat16)
+    np.testing.assert_array_equal(
+        stored,
+        expected.view(torch.int16).numpy().view(np.uint16),
+    )
+
+    # Upcasting is exact, and the stored embeddings are not cast twice
+    upcast = upcast_embeddings(stored)
+    assert upcast.dtype == np.float32
+    np.testing.assert_array_equal(upcast, expected.float().numpy())
+    assert cast_embeddings(stored, 'bfloat16') is stored
+
+    # The values read back as Python ints are upcast as well
+    as_ints = np.array(stored.tolist())
+    np.testing.assert_array_equal(upcast_embeddings(as_ints), upcast)
+    assert cast_embeddings(upcast, 'float32') is upcast
+
+
+def test_jsonl_streaming(tmp_path, monkeypatch) -> None:  # type: ignore[no-untyped-def]
+    """Test sharding a streamed file and restoring its order."""
+    import json
+    from types import SimpleNamespace
+
+    import numpy as np
+    import pytest
+    from torch.utils.data import DataLoader
+
+    from distllm.embed import get_pooler
+    from distllm.embed.datasets import utils
+    from distllm.embed.datasets.jsonl import JsonlDataset
+    from distllm.embed.datasets.jsonl import JsonlDatasetConfig
+    from distllm.embed.embedders.full_sequence import iter_embeddings
+    from distllm.embed.embedders.full_sequence import stream_embeddings
+
+    # Write a file of texts of random lengths
+    texts = _random_texts(30)
+    data_file = tmp_path / 'texts.jsonl'
+    data_file.write_text(
+        '\n'.join(json.dumps({'text': text}) for text in texts),
+    )
+    encoder = _StubEncoder(_word_tokenizer(tmp_path))
+    expected = _reference_embeddings(encoder, texts)
+    pooler = get_pooler({'name': 'mean'})
+
+    # Each data worker streams a disjoint shard of the records
+    num_workers = 3
+    config = JsonlDatasetConfig(
+        num_data_workers=num_workers,
+        batch_size=4,
+        streaming=True,
+    )
+    dataset = JsonlDataset(config).get_dataloader(data_file, encoder).dataset
+    items = []
+    for worker_id in range(num_workers):
+        worker = SimpleNamespace(num_workers=num_workers, id=worker_id)
+        monkeypatch.setattr(utils, 'get_worker_info', lambda w=worker: w)
+        shard = list(dataset)
+        assert all(pos % num_workers == worker_id for (pos, _), _, _ in shard)
+        items.extend(shard)
+    monkeypatch.undo()
+    assert sorted(pos for pos, _, _ in items) == [(i, 0) for i in range(30)]
+    assert all(text == texts[pos] for (pos, _), text, _ in items)
+
+    # The interleaved batches of the data workers are put in file order,
+    # the workers are spawned since forking after the threads of the
+    # libraries have started can deadlock
+    dataloader = JsonlDataset(config).get_dataloader(data_file, encoder)
+    dataloader = DataLoader(
+        dataloader.dataset,
+        batch_size=config.batch_size,
+        num_workers=num_workers,
+        collate_fn=dataloader.collate_fn,
+        multiprocessing_context='spawn',
+        persistent_workers=True,
+    )
+    result = stream_embeddings(dataloader, encoder, pooler)
+    assert result.text == texts
+    np.testing.assert_allclose(result.embeddings, expected, atol=1e-6)
+
+    # The batches are yielded as they come, each text with its embedding
+    batches = list(iter_embeddings(dataloader, encoder, pooler))
+    embedded = {t: e for b in batches for t, e in zip(b.text, b.embeddings)}
+    assert sorted(t for b in batches for t in b.text) == sorted(texts)
+    for text, embedding in zip(texts, expected):
+        np.testing.assert_allclose(embedded[text], embedding, atol=1e-6)
+
+    # Streaming cannot bucket or pack the batches by token length
+    with pytest.raises(ValueError, match='not supported with streaming'):
+        JsonlDatasetConfig(streaming=True, length_bucketing=True)
+    with pytest.raises(ValueError, match='not supported with streaming'):
+        JsonlDatasetConfig(streaming=True, max_tokens_per_batch=64)
+
+
+def test_hybrid_rag_fusion(monkeypatch) -> None:  # type: ignore[no-untyped-def]
+    """Test fusing, deduplicating and packing the hybrid RAG rankings."""
+    import pytest
+
+    # The RAG handlers live next to the distllm package
+    monkeypatch.syspath_prepend(str(Path(__file__).parents[2]))
+    import rag
+
+    # Count whitespace separated words instead of tiktoken tokens
+    monkeypatch.setattr(
+        rag,
+        'count_tokens',
+        lambda texts: [len(text.split()) for text in texts],
+    )
+
+    def hit(text: str, **ids: int) -> dict[str, Any]:
+        return {'text': text, 'document': text, **ids}
+
+    # The second ranking repeats a chunk id and a normalized text
+    tfidf = [
+        hit('Alpha beta', doc_id=1, chunk_index=0),
+        hit('Gamma delta'),
+        hit('Epsilon', doc_id=3, chunk_index=0),
+    ]
+    dense = [
+        hit('Epsilon, reformatted', doc_id=3, chunk_index=0),
+        hit('  gamma   DELTA ', doc_id=9, chunk_index=0),
+        hit('Zeta', doc_id=4, chunk_index=0),
+    ]
+    rrf_k = 60
+    fused = rag.reciprocal_rank_fusion([tfidf, dense], rrf_k=rrf_k)
+
+    # Each chunk is kept once, scored by its ranks in both lists
+    expected = [
+        ('Epsilon', 1 / (rrf_k + 3) + 1 / (rrf_k + 1)),
+        ('Gamma delta', 1 / (rrf_k + 2) + 1 / (rrf_k + 2)),
+        ('Alpha beta', 1 / (rrf_k + 1)),
+        ('Zeta', 1 / (rrf_k + 3)),
+    ]
+    assert [h['document'] for h in fused] == [d for d, _ in expected]
+    scores = [h['rrf_score'] for h in fused]
+    assert scores == pytest.approx([score for _, score in expected])
+
+    # A document over the budget is skipped for the smaller ones after it
+    hits = [
+        hit('one two three'),
+        hit(' '.join(['word'] * 10)),
+        hit('four five'),
+        hit('six seven'),
+        hit('eight nine'),
+    ]
+    packed = rag.pack_documents(hits, token_budget=8, top_n=10)
+    assert packed == ['one two three', 'four five', 'six seven']
+
+    # At most top_n documents are packed
+    packed = rag.pack_documents(hits, token_budget=100, top_n=2)
+    assert packed == ['one two three', ' '.join(['word'] * 10)]
@@ -1,10 +1,18 @@
 import json
+import hashlib
 import requests
 import os
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from mongo_helper import get_rag_configs
 from distllm.chat import distllm_chat
 from tfidf_vectorizer.tfidf_vectorizer import tfidf_search
+from tokenizer import count_tokens
+
+# Defaults for fusing the TF-IDF and distLLM rankings, a rag config can
+# override them with a 'hybrid' entry, e.g. {"rrf_k": 60, "token_budget": 4000}
+DEFAULT_RRF_K = 60
+DEFAULT_TOKEN_BUDGET = 4000
+DEFAULT_TOP_N = 10
 
 def load_config():
     """Load configuration from config.json file"""
@@ -22,7 +30,7 @@ def load_config():
         print(f"Error loading config file: {e}")
         return {}
 
-def rag_handler(query, rag_db, user_id, model, num_docs, session_id):
+def rag_handler(query, rag_db, user_id, model, num_docs, session_id, filters: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None):
     """
     Main RAG handler that queries MongoDB for configuration and dispatches to 
     the appropriate RAG function based on the 'program' field.
@@ -34,6 +42,10 @@ def rag_handler(query, rag_db, user_id, model, num_docs, session_id):
         model: Model name to use
         num_docs: Number of documents to retrieve
         session_id: Session identifier
+        filters: Optional metadata filters for the distLLM search, mapping a
+            dataset column (e.g. 'source') to an allowed value or list of values
+        token_budget: Optional maximum number of tokens of the returned
+            documents, overrides the rag config 'token_budget'
         
     Returns:
         Dict containing the response and any additional data
@@ -41,14 +53,14 @@ def rag_handler(query, rag_db, user_id, model, num_docs, session_id):
     try:
         # Query MongoDB for RAG configuration
         if rag_db == 'bvbrc_default':
-            return bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id)
+            return bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id, filters, token_budget)
         rag_config_list = get_rag_configs(rag_db)
 
         if not rag_config_list or len(rag_config_list) == 0:
             raise ValueError(f"No RAG configurations found for database '{rag_db}'")
 
         if len(rag_config_list) > 1:
-            return multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_config_list)
+            return multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_config_list, filters, token_budget)
         rag_config = rag_config_list[0]
 
         if not rag_config:
@@ -64,7 +76,7 @@ def rag_handler(query, rag_db, user_id, model, num_docs, session_id):
 
         # Dispatch to appropriate RAG function based on program field
         if program == 'distllm':
-            return distllm_rag(query, rag_db, user_id, model, num_docs, session_id, rag_config)
+            return distllm_rag(query, rag_db, user_id, model, num_docs, session_id, rag_config, filters=filters, token_budget=token_budget)
         elif program == 'tfidf':
             return tfidf_search_only(query, rag_db, user_id, model, num_docs, session_id, rag_config)
         else:
@@ -79,7 +91,88 @@ def rag_handler(query, rag_db, user_id, model, num_docs, session_id):
             'program': program if 'program' in locals() else 'unknown'
         }
 
-def multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_config_list):
+def document_keys(hit: Dict[str, Any]) -> List[str]:
+    """
+    Get the keys identifying a retrieved chunk for deduplication.
+
+    Two hits are duplicates if they share the same (doc_id, chunk_index)
+    or the same whitespace/case normalized text.
+
+    Args:
+        hit: Retrieval hit with a 'text' field and optional 'doc_id' and
+            'chunk_index' fields
+
+    Returns:
+        List of keys for the hit
+    """
+    keys = []
+    if hit.get('doc_id') is not None:
+        keys.append(f"id:{hit['doc_id']}:{hit.get('chunk_index')}")
+    text = ' '.join(str(hit.get('text') or '').lower().split())
+    if text:
+        keys.append('text:' + hashlib.sha1(text.encode('utf-8')).hexdigest())
+    return keys
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Dict[str, Any]]], rrf_k: int = DEFAULT_RRF_K) -> List[Dict[str, Any]]:
+    """
+    Fuse several rankings with reciprocal rank fusion, deduplicating chunks.
+
+    Each hit scores sum(1 / (rrf_k + rank)) over the rankings it appears in,
+    so chunks ranked well by both retrievers rise to the top.
+
+    Args:
+        ranked_lists: Rankings of hits, best first. Each hit has a 'document'
+            field (the text sent downstream) plus the fields used by
+            document_keys
+        rrf_k: RRF smoothing constant, larger values flatten the rank weights
+
+    Returns:
+        Deduplicated hits sorted by descending fused score, each with an
+        added 'rrf_score' field
+    """
+    fused = []
+    key_to_hit = {}
+    for ranking in ranked_lists:
+        for rank, hit in enumerate(ranking, start=1):
+            keys = document_keys(hit)
+            # Reuse the first occurrence of a duplicate chunk
+            match = next((key_to_hit[k] for k in keys if k in key_to_hit), None)
+            if match is None:
+                match = dict(hit, rrf_score=0.0)
+                fused.append(match)
+            match['rrf_score'] += 1.0 / (rrf_k + rank)
+            for key in keys:
+                key_to_hit.setdefault(key, match)
+    return sorted(fused, key=lambda hit: hit['rrf_score'], reverse=True)
+
+def pack_documents(hits: List[Dict[str, Any]], token_budget: int = DEFAULT_TOKEN_BUDGET, top_n: int = DEFAULT_TOP_N) -> List[str]:
+    """
+    Keep the best documents that fit in the token budget.
+
+    Args:
+        hits: Hits sorted best first, each with a 'document' field
+        token_budget: Maximum total number of tokens of the documents
+        top_n: Maximum number of documents
+
+    Returns:
+        List of document texts
+    """
+    documents = [hit['document'] for hit in hits]
+    token_counts = count_tokens(documents)
+    packed = []
+    used_tokens = 0
+    for document, num_tokens in zip(documents, token_counts):
+        if len(packed) >= top_n:
+            break
+        # Skip documents that do not fit, a shorter one may still fit
+        if used_tokens + num_tokens > token_budget:
+            continue
+        packed.append(document)
+        used_tokens += num_tokens
+    print(f"Packed {len(packed)} of {len(hits)} fused documents into {used_tokens} tokens")
+    return packed
+
+def multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_config_list, filters: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None):
     """
     Handle RAG requests using multiple RAG configurations.
     
@@ -91,7 +184,14 @@ def multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_c
         num_docs: Number of documents to retrieve
         session_id: Session identifier
         rag_config_list: List of RAG configurations
+        filters: Optional metadata filters for the distLLM search
+        token_budget: Optional maximum number of tokens of the returned documents
         
+    The TF-IDF and distLLM rankings are fused with reciprocal rank fusion,
+    deduplicated by doc/chunk id or text, and the top documents are packed
+    into a token budget. Either configuration may set a 'hybrid' entry with
+    'rrf_k', 'token_budget' and 'top_n' (defaults to num_docs).
+
     Returns:
         Dict containing the response
     """
@@ -121,8 +221,26 @@ def multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_c
         tfidf_results = tfidf_search_only(query, rag_db, user_id, model, num_docs, session_id, tfidf_config)
         text_list = tfidf_results['documents']
         tfidf_string = '\n\n'.join(text_list)
-        distllm_results = distllm_rag(query, rag_db, user_id, model, num_docs, session_id, distllm_config, tfidf_string)
-        documents = distllm_results['documents'] + text_list
+        distllm_results = distllm_rag(query, rag_db, user_id, model, num_docs, session_id, distllm_config, tfidf_string, filters, token_budget)
+
+        # Rank both result lists with the text that is sent downstream
+        tfidf_ranking = [dict(hit, document=hit['text']) for hit in tfidf_results.get('results', [])]
+        distllm_ranking = [
+            dict(hit, document=document)
+            for hit, document in zip(distllm_results.get('results', []), distllm_results['documents'])
+        ]
+
+        # Fuse the lexical and dense rankings and keep what fits the budget
+        hybrid = {**tfidf_config.get('hybrid', {}), **distllm_config.get('hybrid', {})}
+        fused = reciprocal_rank_fusion(
+            [distllm_ranking, tfidf_ranking],
+            rrf_k=hybrid.get('rrf_k', DEFAULT_RRF_K),
+        )
+        documents = pack_documents(
+            fused,
+            token_budget=token_budget or hybrid.get('token_budget', DEFAULT_TOKEN_BUDGET),
+            top_n=hybrid.get('top_n', num_docs or DEFAULT_TOP_N),
+        )
         # Combine results from all RAG configurations
         combined_response = {
             'message': 'success',
@@ -145,7 +263,7 @@ def multi_rag_handler(query, rag_db, user_id, model, num_docs, session_id, rag_c
 # - message: success
 # - response: the response from the RAG
 # - system_prompt: the system prompt used which contains the returned documents
-def distllm_rag(query, rag_db, user_id, model, num_docs, session_id, rag_config, extra_context: Optional[str] = None):
+def distllm_rag(query, rag_db, user_id, model, num_docs, session_id, rag_config, extra_context: Optional[str] = None, filters: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None):
     """
     Handle RAG requests using distLLM implementation.
     
@@ -157,6 +275,18 @@ def distllm_rag(query, rag_db, user_id, model, num_docs, session_id, rag_config,
         num_docs: Number of documents to retrieve
         session_id: Session identifier
         extra_context: Optional extra context to include in the system prompt
+        filters: Optional metadata filters, only documents whose dataset columns
+            match the filters are searched
+        token_budget: Optional maximum number of tokens of the returned documents,
+            defaults to the rag config 'token_budget'. The retrieved chunks are
+            packed into the budget by maximal marginal relevance
+
+    A rag config may set a 'query_encoder' entry to embed the queries in
+    process with a warm encoder instead of the remote embedding service, e.g.
+    {"encoder_config": {"name": "auto", "pretrained_model_name_or_path":
+    "pritamdeka/S-PubMedBert-MS-MARCO", "quantization": false},
+    "pooler_config": {"name": "mean"}, "batch_size": 32}
+
     Returns:
         Dict containing the response
     """
@@ -172,13 +302,16 @@ def distllm_rag(query, rag_db, user_id, model, num_docs, session_id, rag_config,
         faiss_index_path = rag_config['data']['faiss_index_path']
 
         # Call the distllm_chat function
-        result_json = distllm_chat(query, rag_db, data_path, faiss_index_path, extra_context)
+        # Pack the most relevant, least redundant chunks into the token budget
+        token_budget = token_budget or rag_config.get('token_budget', DEFAULT_TOKEN_BUDGET)
+        result_json = distllm_chat(query, rag_db, data_path, faiss_index_path, extra_context, filters, token_budget, count_tokens, rag_config.get('query_encoder'))
         result = json.loads(result_json)
         
         return {
             'message': 'success',
             'documents': result.get('documents', []),
-            'embedding': result.get('embedding', [])
+            'embedding': result.get('embedding', []),
+            'results': result.get('results', [])
         }
         
     except Exception as e:
@@ -251,7 +384,8 @@ def tfidf_search_only(query, rag_db, user_id, model, num_docs, session_id, rag_c
         return {
             'message': 'success',
             'documents': text_list,
-            'embedding': None
+            'embedding': None,
+            'results': results
         }
         
     except Exception as e:
@@ -354,7 +488,7 @@ def chat_only_request(query: str, model: str, system_prompt: Optional[str] = Non
             "message": "The server returned an invalid JSON response"
         }
 
-def bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id):
+def bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id, filters: Optional[Dict[str, Any]] = None, token_budget: Optional[int] = None):
     """
     Handle the default BVBRC RAG request by combining results from bvbrc_helpdesk 
     (using multi_rag_handler) and cepi_journals (using distllm_rag).
@@ -366,6 +500,9 @@ def bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id):
         model: Model name to use
         num_docs: Number of documents to retrieve
         session_id: Session identifier
+        filters: Optional metadata filters applied to both distLLM searches
+        token_budget: Optional maximum number of tokens of the combined
+            documents, split evenly between the two databases
         
     Returns:
         Dict containing the combined response with documents and embedding
@@ -383,10 +520,14 @@ def bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id):
         if not cepi_journals_configs or len(cepi_journals_configs) == 0:
             raise ValueError("No RAG configurations found for 'cepi_journals'")
         
+        # Split the token budget between the two databases so that the
+        # combined documents stay within it
+        source_budget = (token_budget or DEFAULT_TOKEN_BUDGET) // 2
+
         # Run bvbrc_helpdesk with multi_rag_handler
         print("Running bvbrc_helpdesk with multi_rag_handler...")
         bvbrc_helpdesk_result = multi_rag_handler(
-            query, 'bvbrc_helpdesk', user_id, model, num_docs, session_id, bvbrc_helpdesk_configs
+            query, 'bvbrc_helpdesk', user_id, model, num_docs, session_id, bvbrc_helpdesk_configs, filters, source_budget
         )
         
         # Check if bvbrc_helpdesk_result has an error
@@ -400,7 +541,7 @@ def bvbrc_default_rag(query, rag_db, user_id, model, num_docs, session_id):
         print("Running cepi_journals with distllm_rag...")
         cepi_config = cepi_journals_configs[0]
         cepi_result = distllm_rag(
-            query, 'cepi_journals', user_id, model, num_docs, session_id, cepi_config
+            query, 'cepi_journals', user_id, model, num_docs, session_id, cepi_config, filters=filters, token_budget=source_budget
         )
         
         # Check if cepi_result has an error
@@ -1,5 +1,11 @@
 from flask import Flask, request, jsonify
 import os, json
+from distllm.threads import configure_thread_budget
+
+# Split the CPUs between the gunicorn workers (WEB_CONCURRENCY) before
+# FAISS, torch and the HF tokenizers create their thread pools
+configure_thread_budget()
+
 import tfidf_vectorizer as tv
 from tokenizer import count_tokens
 from rag import rag_handler
@@ -93,7 +99,7 @@ def path_state():
 @app.route('/rag', methods=["POST"])
 def rag():
     data = request.get_json()
-    response = rag_handler(data['query'], data['rag_db'], data['user_id'], data['model'], data['num_docs'], data['session_id'])
+    response = rag_handler(data['query'], data['rag_db'], data['user_id'], data['model'], data['num_docs'], data['session_id'], data.get('filters'), data.get('token_budget'))
     return jsonify(response), 200
 
 if __name__ == "__main__":